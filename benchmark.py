@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Measures the performance of the media importer against a synthetic library.
+
+A library of tagged MP3 and FLAC files is generated in a scratch directory
+and imported into a fresh musik.db, exactly the way the import workers would:
+the directory is scanned with ImportThread.importDirectory, then the queued
+file tasks are claimed and processed until the queue is empty.
+The results are printed as JSON, so runs on different commits can be compared:
+
+	python benchmark.py --artists 20 --albums 3 --tracks 12 --tags full > before.json
+
+The files are written by hand rather than encoded, so the benchmark runs
+offline and without any audio tools. Every run with the same options produces
+byte for byte the same library.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from musik.library.importer import ImportThread
+from musik.library.parsing import createParserPool
+from musik.library.stats import importStats
+
+
+# the tags that are written at each density, named like the keys of mutagen.easyid3.EasyID3
+TAG_DENSITIES = {
+	'minimal': ('title', 'artist', 'album', 'tracknumber'),
+	'typical': ('title', 'artist', 'album', 'tracknumber', 'albumartist', 'date', 'genre', 'discnumber', 'composer'),
+	'full': ('title', 'artist', 'album', 'tracknumber', 'albumartist', 'date', 'genre', 'discnumber', 'composer',
+		'titlesort', 'artistsort', 'bpm', 'isrc', 'copyright', 'organization', 'media', 'conductor', 'encodedby',
+		'musicbrainz_artistid', 'musicbrainz_albumid', 'musicbrainz_albumartistid', 'musicbrainz_trackid'),
+}
+
+# ID3v2.4 text frames for each tag
+ID3_FRAMES = {
+	'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'tracknumber': 'TRCK', 'albumartist': 'TPE2',
+	'date': 'TDRC', 'genre': 'TCON', 'discnumber': 'TPOS', 'composer': 'TCOM', 'titlesort': 'TSOT',
+	'artistsort': 'TSOP', 'bpm': 'TBPM', 'isrc': 'TSRC', 'copyright': 'TCOP', 'organization': 'TPUB',
+	'media': 'TMED', 'conductor': 'TPE3', 'encodedby': 'TENC',
+}
+
+# ID3v2.4 user text frames for each tag, by description
+ID3_USER_FRAMES = {
+	'musicbrainz_artistid': u'MusicBrainz Artist Id',
+	'musicbrainz_albumid': u'MusicBrainz Album Id',
+	'musicbrainz_albumartistid': u'MusicBrainz Album Artist Id',
+}
+
+GENRES = (u'Rock', u'Jazz', u'Electronic', u'Classical', u'Hip-Hop', u'Folk')
+
+# a single MPEG-1 layer III frame: 128 kbps, 44.1 kHz, joint stereo
+MP3_FRAME = '\xff\xfb\x90\x44' + '\x00' * 413
+MP3_FRAMES_PER_SECOND = 44100 / 1152.0
+
+
+def synchsafe(n):
+	return struct.pack('>4B', (n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f)
+
+
+def id3Frame(frame_id, data):
+	return frame_id + synchsafe(len(data)) + '\x00\x00' + data
+
+
+def id3Tag(tags):
+	"""Returns an ID3v2.4 tag that holds the specified tags"""
+	frames = []
+	for key in sorted(tags.keys()):
+		value = tags[key].encode('utf-8')
+		if key in ID3_FRAMES:
+			frames.append(id3Frame(ID3_FRAMES[key], '\x03' + value))
+		elif key in ID3_USER_FRAMES:
+			frames.append(id3Frame('TXXX', '\x03' + ID3_USER_FRAMES[key].encode('utf-8') + '\x00' + value))
+		elif key == 'musicbrainz_trackid':
+			frames.append(id3Frame('UFID', 'http://musicbrainz.org\x00' + value))
+
+	body = ''.join(frames)
+	return 'ID3\x04\x00\x00' + synchsafe(len(body)) + body
+
+
+def writeMP3(path, tags, seconds, seed):
+	with open(path, 'wb') as f:
+		f.write(id3Tag(tags))
+		# the seed makes the audio of every file unique, just like real audio
+		f.write(MP3_FRAME[:4] + struct.pack('>I', seed) + MP3_FRAME[8:])
+		f.write(MP3_FRAME * max(int(seconds * MP3_FRAMES_PER_SECOND) - 1, 0))
+
+
+def flacBlock(block_type, data, last=False):
+	return struct.pack('>I', (0x80 if last else 0) << 24 | block_type << 24 | len(data)) + data
+
+
+def writeFLAC(path, tags, seconds, seed):
+	# STREAMINFO: 4096 sample blocks, 44.1 kHz, stereo, 16 bits per sample
+	samples = int(seconds * 44100)
+	packed = 44100 << 44 | 1 << 41 | 15 << 36 | samples
+	streaminfo = struct.pack('>HH', 4096, 4096) + '\x00' * 6 + struct.pack('>Q', packed) + '\x00' * 16
+
+	vendor = 'musik benchmark'
+	comments = [(u'%s=%s' % (key.upper(), tags[key])).encode('utf-8') for key in sorted(tags.keys())]
+	vorbis = struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+	vorbis += ''.join(struct.pack('<I', len(comment)) + comment for comment in comments)
+
+	with open(path, 'wb') as f:
+		f.write('fLaC' + flacBlock(0, streaminfo) + flacBlock(4, vorbis, last=True))
+		# stands in for the audio frames, at roughly the size of real ones. It
+		# starts with a frame sync code, which mutagen checks for
+		f.write('\xff\xf8' + struct.pack('>I', seed) + '\x00' * (samples * 2))
+
+
+def deterministicId(kind, *keys):
+	return unicode(uuid.uuid5(uuid.NAMESPACE_URL, 'musik-benchmark/%s/%s' % (kind, '/'.join(str(key) for key in keys))))
+
+
+def generateLibrary(root, artists, albums, tracks, density, shape, formats, seconds):
+	"""Writes a synthetic library below root. Returns the number of files written."""
+	keys = TAG_DENSITIES[density]
+	written = 0
+	for a, b, t in itertools.product(range(artists), range(albums), range(tracks)):
+		artist = u'Artist %03d' % a
+		album = u'Album %03d' % b
+		title = u'Track %03d' % t
+		ext = formats[(a + b + t) % len(formats)]
+
+		values = {
+			'title': title, 'artist': artist, 'album': album, 'tracknumber': u'%d/%d' % (t + 1, tracks),
+			'albumartist': artist, 'date': unicode(1970 + (a + b) % 50), 'genre': GENRES[a % len(GENRES)],
+			'discnumber': u'1/1', 'composer': u'Composer %03d' % (t % 7), 'titlesort': title, 'artistsort': artist,
+			'bpm': unicode(80 + t * 5), 'isrc': u'XX%03d%02d%05d' % (a, b, t), 'copyright': u'%d %s' % (1970 + b, artist),
+			'organization': u'Label %02d' % (a % 10), 'media': u'CD', 'conductor': u'Conductor %02d' % (b % 5),
+			'encodedby': u'musik benchmark', 'musicbrainz_artistid': deterministicId('artist', a),
+			'musicbrainz_albumid': deterministicId('album', a, b), 'musicbrainz_albumartistid': deterministicId('artist', a),
+			'musicbrainz_trackid': deterministicId('track', a, b, t),
+		}
+		tags = dict((key, values[key]) for key in keys)
+
+		if shape == 'deep':
+			directory = os.path.join(root, artist, album)
+			name = u'%02d %s.%s' % (t + 1, title, ext)
+		else:
+			directory = root
+			name = u'%s - %s - %02d %s.%s' % (artist, album, t + 1, title, ext)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		path = os.path.join(directory, name)
+		if ext == 'mp3':
+			writeMP3(path, tags, seconds, written)
+		else:
+			writeFLAC(path, tags, seconds, written)
+		written += 1
+
+	return written
+
+
+class StatementCounter(object):
+	"""Counts the SQL statements executed by every engine in the process"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.count = 0
+		event.listen(Engine, 'before_cursor_execute', self.executed)
+
+	def executed(self, conn, cursor, statement, parameters, context, executemany):
+		with self.lock:
+			self.count += 1
+
+
+class Phase(object):
+	"""Times a phase of the benchmark and counts the statements it executes"""
+
+	def __init__(self, name, results, counter):
+		self.name = name
+		self.results = results
+		self.counter = counter
+
+	def __enter__(self):
+		self.started = time.time()
+		self.statements = self.counter.count
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.results[self.name] = {
+			'seconds': round(time.time() - self.started, 4),
+			'statements': self.counter.count - self.statements,
+		}
+
+
+def peakRSS():
+	"""Returns the peak resident set size in kilobytes of this process and of its children"""
+	return {
+		'self_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		'children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+	}
+
+
+def currentCommit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def run(options):
+	workdir = options.workdir or tempfile.mkdtemp(prefix='musik-benchmark-')
+	library = os.path.join(workdir, 'library')
+	for name in ('musik.db', 'musik.db-wal', 'musik.db-shm'):
+		if os.path.exists(os.path.join(workdir, name)):
+			os.remove(os.path.join(workdir, name))
+
+	phases = {}
+	counter = StatementCounter()
+	formats = options.formats.split(',')
+
+	try:
+		with Phase('generate', phases, counter):
+			if os.path.isdir(library):
+				shutil.rmtree(library)
+			files = generateLibrary(library, options.artists, options.albums, options.tracks, options.tags,
+				options.shape, formats, options.seconds)
+
+		# the parser processes have to be forked before anything else gets going
+		parser = createParserPool(options.processes)
+
+		# musik.db is always created in the working directory
+		cwd = os.getcwd()
+		os.chdir(workdir)
+		try:
+			with Phase('setup', phases, counter):
+				importer = ImportThread(name='benchmark', parser=parser)
+				importStats.reset(0)
+			if options.batch_size:
+				importer.batch_size = options.batch_size
+			if not options.verbose:
+				logging.getLogger('musik.library.importer').setLevel(logging.WARNING)
+
+			with Phase('scan', phases, counter):
+				importer.importDirectory(library)
+
+			with Phase('import', phases, counter):
+				while True:
+					tasks = importer.claimTasks(importer.batch_size)
+					if len(tasks) == 0:
+						break
+					importer.processTasks(tasks)
+
+			with Phase('rescan', phases, counter):
+				# nothing changed, so this should not queue anything
+				importer.importDirectory(library)
+			importer.sa_session.close()
+		finally:
+			os.chdir(cwd)
+			if parser != None:
+				parser.terminate()
+				parser.join()
+
+		measured = phases['scan']['seconds'] + phases['import']['seconds']
+		statements = phases['scan']['statements'] + phases['import']['statements']
+		return {
+			'commit': currentCommit(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'cpus': multiprocessing.cpu_count(),
+			'options': {
+				'artists': options.artists, 'albums': options.albums, 'tracks': options.tracks, 'tags': options.tags,
+				'shape': options.shape, 'formats': formats, 'seconds': options.seconds,
+				'processes': options.processes, 'batch_size': importer.batch_size,
+			},
+			'files': files,
+			'files_per_second': round(files / max(measured, 0.0001), 2),
+			'statements_per_file': round(statements / float(max(files, 1)), 2),
+			'peak_rss': peakRSS(),
+			'phases': phases,
+		}
+	finally:
+		if not options.keep and not options.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks the media importer against a synthetic library.')
+	parser.add_argument('--artists', type=int, default=10, help='number of artists (default: %(default)s)')
+	parser.add_argument('--albums', type=int, default=3, help='albums per artist (default: %(default)s)')
+	parser.add_argument('--tracks', type=int, default=12, help='tracks per album (default: %(default)s)')
+	parser.add_argument('--tags', choices=sorted(TAG_DENSITIES.keys()), default='typical', help='tag density (default: %(default)s)')
+	parser.add_argument('--shape', choices=('deep', 'flat'), default='deep',
+		help='deep puts each album in an artist/album directory, flat puts every file in one directory (default: %(default)s)')
+	parser.add_argument('--formats', default='mp3,flac', help='comma separated list of mp3 and flac (default: %(default)s)')
+	parser.add_argument('--seconds', type=float, default=5, help='length of each track (default: %(default)s)')
+	parser.add_argument('--processes', type=int, default=None, help='parser processes, 0 to parse in the importer (default: one per cpu)')
+	parser.add_argument('--batch-size', type=int, default=None, help='files per transaction (default: the importer default)')
+	parser.add_argument('--workdir', default=None, help='directory for the library and musik.db (default: a temporary directory)')
+	parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+	parser.add_argument('--output', default=None, help='write the JSON results to this file instead of stdout')
+	parser.add_argument('--verbose', action='store_true', help='keep the importer log output')
+	options = parser.parse_args()
+
+	for ext in options.formats.split(','):
+		if ext not in ('mp3', 'flac'):
+			parser.error('unsupported format: %s' % ext)
+
+	results = json.dumps(run(options), indent=2, sort_keys=True)
+	if options.output:
+		with open(options.output, 'w') as f:
+			f.write(results + '\n')
+	else:
+		sys.stdout.write(results + '\n')
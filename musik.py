@@ -6,12 +6,13 @@ import os
 
 from musik import initLogging
 import musik.library.importer
+import musik.library.watcher
 import musik.web.application
 
 
 # cleans up and safely stops the application
 def cleanup(signum=None, frame=None):
-	global log, importThread, app
+	global log, importPool, app
 
 	if type(signum) == type(None):
 		pass
@@ -19,11 +20,11 @@ def cleanup(signum=None, frame=None):
 		log.info(u'Signal %i caught, saving and exiting...', int(signum))
 
 	log.info(u'Stopping worker threads')
-	if importThread != None:
-		importThread.stop()
-		importThread.join(5)
-		if importThread.isAlive():
-			log.error(u'Failed to clean up importThread')
+	if importPool != None:
+		importPool.stop()
+		importPool.join(5)
+		if importPool.isAlive():
+			log.error(u'Failed to clean up importPool')
 
 	log.info(u'Stopping CherryPy Engine')
 	app.stop()
@@ -34,7 +35,7 @@ def cleanup(signum=None, frame=None):
 
 # application entry - starts the database connection and dev server
 if __name__ == '__main__':
-	global log, importThread, app
+	global log, importPool, app
 
 	threads = []
 
@@ -47,9 +48,13 @@ if __name__ == '__main__':
 		signal.signal(sig, cleanup)
 
 	log.info(u'Starting worker threads')
-	importThread = musik.library.importer.ImportThread()
-	importThread.start()
-	threads.append(importThread)
+	importPool = musik.library.importer.ImportPool()
+	importPool.start()
+	threads.append(importPool)
+
+	watcherThread = musik.library.watcher.WatcherThread()
+	watcherThread.start()
+	threads.append(watcherThread)
 
 	# this is a blocking call
 	log.info(u'Starting Web App')
@@ -15,6 +15,11 @@ def initLogging(moduleName):
 	log = logging.getLogger(moduleName)
 	log.setLevel(logging.DEBUG)
 
+	# loggers are shared per module, so only attach handlers the first time
+	# around. Otherwise every new instance of a class duplicates every line.
+	if len(log.handlers) > 0:
+		return log
+
 	# create console handler and set level to debug
 	ch = logging.StreamHandler()
 	ch.setLevel(logging.DEBUG)
@@ -1,12 +1,18 @@
 from datetime import datetime
 import os
 import os.path
+import threading
 
-from sqlalchemy import Column, create_engine, ForeignKey
+from sqlalchemy import Column, create_engine, event, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.types import String, Integer, DateTime, Boolean, BigInteger
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.types import String, Integer, DateTime, Boolean, BigInteger, Float
 from sqlalchemy.orm import backref, relationship, sessionmaker
 
+from musik.library.search import rank
+from musik.migrations import migrate
+from musik.util import getSetting
+
 
 # Helper to map and register a Python class a db table
 Base = declarative_base()
@@ -19,13 +25,23 @@ class ImportTask(Base):
 	At this time, only local directories and files are supported, but in the
 	future we may support YouTube videos, SoundCloud files, or files hosted
 	on HTTP, FTP, and SSH servers.
+	A worker that claims a task holds a lease on it, which it has to renew
+	while it works. Tasks whose lease expires are handed to another worker,
+	and tasks that have been attempted too many times are quarantined.
+	Tasks with a higher priority are always claimed first.
 	"""
 	__tablename__ = 'import_tasks'
 	id = Column(Integer, primary_key=True)
-	uri = Column(String)
+	uri = Column(String, index=True)
+	kind = Column(String)
+	priority = Column(Integer, default=0)
 	created = Column(DateTime)
 	started = Column(DateTime)
 	completed = Column(DateTime)
+	worker = Column(String)
+	lease_expires = Column(DateTime)
+	attempts = Column(Integer, default=0)
+	quarantined = Column(DateTime)
 
 	def __init__(self, uri):
 		Base.__init__(self)
@@ -33,10 +49,12 @@ class ImportTask(Base):
 		self.created = datetime.utcnow()
 
 	def __unicode__(self):
-		if self.completed != None:
+		if self.quarantined != None:
+			return u'<ImportTask(uri=%s, created=%s, attempts=%s, quarantined=%s)>' % (self.uri, self.created, self.attempts, self.quarantined)
+		elif self.completed != None:
 			return u'<ImportTask(uri=%s, created=%s, started=%s, completed=%s)>' % (self.uri, self.created, self.started, self.completed)
 		elif self.started != None:
-			return u'<ImportTask(uri=%s, created=%s, started=%s)>' % (self.uri, self.created, self.started)
+			return u'<ImportTask(uri=%s, created=%s, started=%s, worker=%s)>' % (self.uri, self.created, self.started, self.worker)
 		else:
 			return u'<ImportTask(uri=%s, created=%s)>' % (self.uri, self.created)
 
@@ -44,6 +62,28 @@ class ImportTask(Base):
 		return unicode(self).encode('utf-8')
 
 
+class LibraryRoot(Base):
+	"""A library root is a directory that was imported into the library as a whole.
+	Library roots are watched for changes so that new, modified, moved and
+	deleted files are picked up without rescanning the whole directory.
+	"""
+	__tablename__ = 'library_roots'
+	id = Column(Integer, primary_key=True)
+	uri = Column(String)
+	created = Column(DateTime)
+
+	def __init__(self, uri):
+		Base.__init__(self)
+		self.uri = uri
+		self.created = datetime.utcnow()
+
+	def __unicode__(self):
+		return u'<LibraryRoot(uri=%s)>' % self.uri
+
+	def __str__(self):
+		return unicode(self).encode('utf-8')
+
+
 class Artist(Base):
 	"""An artist is the person or persons responsible for creating some
 	aspect of a Track.
@@ -51,10 +91,12 @@ class Artist(Base):
 	Internally, all are treated as artists and foreign key to this table.
 	"""
 	__tablename__ = 'artists'
-	id = Column(Integer, primary_key=True)	 # unique id
-	name = Column(String)					 # artist name
-	name_sort = Column(String)				 # sortable artist name
-	musicbrainz_artistid = Column(String)	 # unique 36-digit musicbrainz hex string
+	id = Column(Integer, primary_key=True)				 # unique id
+	name = Column(String, index=True)					 # artist name
+	name_sort = Column(String, index=True)				 # sortable artist name
+	musicbrainz_artistid = Column(String, index=True)	 # unique 36-digit musicbrainz hex string
+	album_count = Column(Integer, default=0)			 # summary: number of albums by the artist
+	track_count = Column(Integer, default=0)			 # summary: number of tracks by the artist
 
 	# TODO: make musicbrainz_artistid unique!
 
@@ -82,19 +124,26 @@ class Album(Base):
 	collection of related songs that may or may not have a physical representation.
 	"""
 	__tablename__ = 'albums'
+	__table_args__ = (Index('ix_albums_title_artist_id', 'title', 'artist_id'), )
 	id = Column(Integer, primary_key=True)					 # unique id
 	title = Column(String)									 # the title of the album
-	title_sort = Column(String)								 # sortable title of the album
-	artist_id = Column(Integer, ForeignKey('artists.id'))	 # the artist that recorded this album
+	title_sort = Column(String, index=True)					 # sortable title of the album
+	artist_id = Column(Integer, ForeignKey('artists.id'), index=True)	 # the artist that recorded this album
 	asin = Column(String)									 # amazon standard identification number - only if physical
 	barcode = Column(String)								 # physical album barcode
 	compilation = Column(Boolean)							 # whether or not this album is a compilation
 	media_type = Column(String)								 # the type of media (CD, etc)
-	musicbrainz_albumid = Column(String)					 # unique 36-digit musicbrainz hex string
+	musicbrainz_albumid = Column(String, index=True)		 # unique 36-digit musicbrainz hex string
 	musicbrainz_albumstatus = Column(String)				 # unique 36-digit musicbrainz hex string
 	musicbrainz_albumtype = Column(String)					 # unique 36-digit musicbrainz hex string
 	organization = Column(String)							 # organization that released the album (usually a record company)
 	releasecountry = Column(String)							 # the country that this album was released in
+	art_hash = Column(String)								 # hash of the album art, see musik.library.artwork
+	artist_name = Column(String)							 # summary: name of the artist that recorded this album
+	year = Column(Integer)									 # summary: year of the earliest track
+	track_count = Column(Integer, default=0)				 # summary: number of tracks on the album
+	disc_count = Column(Integer, default=0)					 # summary: number of discs in the album
+	duration = Column(BigInteger, default=0)				 # summary: total length of the tracks in milliseconds
 
 	artist = relationship('Artist', backref=backref('albums', order_by=id))
 
@@ -126,13 +175,14 @@ class Disc(Base):
 			for each side.
 	"""
 	__tablename__ = 'discs'
+	__table_args__ = (Index('ix_discs_album_id_discnumber', 'album_id', 'discnumber'), )
 
 	# columns
 	id = Column(Integer, primary_key=True)				 # unique id
 	album_id = Column(Integer, ForeignKey('albums.id'))	 # the album that this disc belongs to
 	discnumber = Column(String)							 # the play order of this disc in the collection
 	disc_subtitle = Column(String)						 # the subtitle (if applicable) of this disc
-	musicbrainz_discid = Column(String)					 # unique 36-digit musicbrainz hex string
+	musicbrainz_discid = Column(String, index=True)		 # unique 36-digit musicbrainz hex string
 
 	# relationships
 	album = relationship('Album', backref=backref('discs', order_by=discnumber, lazy='dynamic'))
@@ -161,9 +211,9 @@ class Track(Base):
 
 	# columns
 	id = Column(Integer, primary_key=True)						 # unique id
-	uri = Column(String)										 # physical location of the track file
-	artist_id = Column(Integer, ForeignKey('artists.id'))		 # the artist that recorded the track
-	album_id = Column(Integer, ForeignKey('albums.id'))			 # the album that contains the track
+	uri = Column(String, index=True)							 # physical location of the track file
+	artist_id = Column(Integer, ForeignKey('artists.id'), index=True)	 # the artist that recorded the track
+	album_id = Column(Integer, ForeignKey('albums.id'), index=True)	 # the album that contains the track
 	album_artist_id = Column(Integer, ForeignKey('artists.id'))	 # the artist that released the album
 	arranger_id = Column(Integer, ForeignKey('artists.id'))		 # the artist that arranged the track
 	author_id = Column(Integer, ForeignKey('artists.id'))		 # the author that wrote the track
@@ -177,6 +227,7 @@ class Track(Base):
 	genre = Column(String)										 # genre of track contents
 	isrc = Column(String) 										 # ISO 3901 12-character International Standard Recording Code
 	length = Column(BigInteger)									 # length of the track in milliseconds
+	bitrate = Column(Integer)									 # bitrate of the audio stream in bits per second
 	lyricist_id = Column(Integer, ForeignKey('artists.id'))		 # the artist that wrote the lyrics of the track
 	mood = Column(String)										 # description of the mood of the track
 	musicbrainz_trackid = Column(String)						 # unique 36-digit musicbrainz hex string
@@ -185,12 +236,17 @@ class Track(Base):
 	musicip_puid = Column(String)								 # unique musicip (gracenote) id
 	performer_id = Column(Integer, ForeignKey('artists.id'))	 # artist that performed the track
 	title = Column(String)										 # title of the track
-	title_sort = Column(String)									 # sortable title of the track
+	title_sort = Column(String, index=True)						 # sortable title of the track
 	tracknumber = Column(Integer)								 # order of the track on the disc
 	subtitle = Column(String)									 # sub title of the track
 	website = Column(String)									 # a website for the track
 	playcount = Column(Integer)									 # number of times the track was played
 	rating = Column(Integer)									 # rating of the track (0-255)
+	file_size = Column(BigInteger)								 # size of the file in bytes when it was last imported
+	file_mtime = Column(Float)									 # modification time of the file when it was last imported
+	file_inode = Column(BigInteger, index=True)					 # inode number of the file when it was last imported
+	file_device = Column(BigInteger)							 # device id of the file when it was last imported
+	audio_hash = Column(String, index=True)						 # hash of the audio payload, see musik.library.hashing
 
 	# relationships
 	artist = relationship('Artist', primaryjoin='Artist.id == Track.artist_id')
@@ -204,6 +260,9 @@ class Track(Base):
 	album = relationship('Album', backref=backref('tracks', order_by=tracknumber))
 	disc = relationship('Disc', backref=backref('tracks', order_by=tracknumber))
 
+	# the fields of as_dict that aren't columns, with the column that each is derived from
+	derived_fields = {'stream_uri': ('id', lambda id: Track.stream_uri_for(id))}
+
 	def __init__(self, uri):
 		Base.__init__(self)
 		self.uri = uri
@@ -214,16 +273,124 @@ class Track(Base):
 	def __str__(self):
 		return unicode(self).encode('utf-8')
 
+	def fingerprint(self):
+		"""Returns the file fingerprint that was recorded when the track was last imported"""
+		return (self.file_size, self.file_mtime, self.file_inode, self.file_device)
+
+	def set_fingerprint(self, fingerprint):
+		"""Records the file fingerprint of the track, as returned by musik.library.scanner.fingerprint"""
+		(self.file_size, self.file_mtime, self.file_inode, self.file_device) = fingerprint
+
+	@staticmethod
+	def stream_uri_for(id):
+		"""Returns the url that the track with the specified id is streamed from"""
+		#TODO: don't hardcode the url!
+		return 'http://localhost:8080/api/stream/track/' + str(id)
+
 	def as_dict(self):
 		"""Returns a representation of the track as a dictionary"""
 		fields = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+		fields['stream_uri'] = Track.stream_uri_for(fields['id'])
+		return fields
 
-		#TODO: don't hardcode the url!
-		fields['stream_uri'] = 'http://localhost:8080/api/stream/track/' + str(fields['id'])
 
+class MetadataConflict(Base):
+	"""A metadata conflict is recorded whenever a file disagrees with metadata
+	that is already in the library. The existing metadata is kept, and the
+	conflict is left for the user (or a future musicbrainz lookup) to resolve.
+	There is at most one conflict per entity and field; newer conflicts replace older ones.
+	"""
+	__tablename__ = 'metadata_conflicts'
+	__table_args__ = (UniqueConstraint('entity', 'entity_id', 'field'), )
+
+	id = Column(Integer, primary_key=True)	 # unique id
+	entity = Column(String)					 # table name of the conflicting entity (tracks, albums, ...)
+	entity_id = Column(Integer)				 # id of the conflicting entity
+	field = Column(String)					 # column or relationship that conflicts
+	current_value = Column(String)			 # the value that is in the library
+	incoming_value = Column(String)			 # the value that was read from the file
+	uri = Column(String)					 # the file that the incoming value was read from
+	created = Column(DateTime)				 # when the conflict was recorded
+
+	def __unicode__(self):
+		return u'<MetadataConflict(entity=%s, entity_id=%s, field=%s)>' % (self.entity, self.entity_id, self.field)
+
+	def __str__(self):
+		return unicode(self).encode('utf-8')
+
+	def as_dict(self):
+		"""Returns a representation of the conflict as a dictionary"""
+		fields = {c.name: getattr(self, c.name) for c in self.__table__.columns}
+		if fields['created'] != None:
+			fields['created'] = fields['created'].isoformat()
 		return fields
 
 
+class StorageProfile(object):
+	"""The SQLite settings that every connection is configured with.
+	The defaults suit a server: in WAL mode readers never wait for the writer,
+	so the web tier keeps answering while an import transaction is open, and
+	writers wait for each other for up to busy_timeout seconds instead of
+	failing straight away with "database is locked".
+	Every setting can be overridden with an environment variable.
+	"""
+
+	journal_mode = 'WAL'		 # MUSIK_DB_JOURNAL_MODE: DELETE, TRUNCATE, PERSIST, MEMORY, WAL or OFF
+	synchronous = 'NORMAL'		 # MUSIK_DB_SYNCHRONOUS: OFF, NORMAL, FULL or EXTRA. NORMAL is safe with WAL
+	cache_size = 16384			 # MUSIK_DB_CACHE_KB: page cache per connection in KiB
+	mmap_size = 256				 # MUSIK_DB_MMAP_MB: memory mapped I/O per connection in MiB, 0 to disable
+	busy_timeout = 30.0			 # MUSIK_DB_BUSY_TIMEOUT: seconds that a connection waits for a lock
+	pool_size = 10				 # MUSIK_DB_POOL_SIZE: connections kept open for the web and import threads
+	max_overflow = 10			 # MUSIK_DB_POOL_OVERFLOW: connections opened on top of that under load
+
+	def __init__(self):
+		self.journal_mode = getSetting('MUSIK_DB_JOURNAL_MODE', self.journal_mode).upper()
+		self.synchronous = getSetting('MUSIK_DB_SYNCHRONOUS', self.synchronous).upper()
+		self.cache_size = getSetting('MUSIK_DB_CACHE_KB', self.cache_size)
+		self.mmap_size = getSetting('MUSIK_DB_MMAP_MB', self.mmap_size)
+		self.busy_timeout = getSetting('MUSIK_DB_BUSY_TIMEOUT', self.busy_timeout)
+		self.pool_size = getSetting('MUSIK_DB_POOL_SIZE', self.pool_size)
+		self.max_overflow = getSetting('MUSIK_DB_POOL_OVERFLOW', self.max_overflow)
+
+		if self.journal_mode not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+			raise ValueError(u'Unsupported journal mode %s' % self.journal_mode)
+		if self.synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+			raise ValueError(u'Unsupported synchronous level %s' % self.synchronous)
+
+	def create_engine(self, db_path):
+		"""Creates an engine for the specified database file that applies the profile.
+		Connections are pooled, so the pragmas only run once per connection. A pooled
+		connection is only ever used by one thread at a time, but not always by the
+		thread that opened it, so pysqlite's same thread check is turned off.
+		"""
+		engine = create_engine('sqlite:///%s' % db_path, echo=False, poolclass=QueuePool,
+			pool_size=self.pool_size, max_overflow=self.max_overflow,
+			connect_args={'timeout': self.busy_timeout, 'check_same_thread': False})
+		event.listen(engine, 'connect', self.configure)
+		return engine
+
+	def configure(self, connection, record):
+		"""Runs the pragmas on a new connection and registers the application's SQL functions"""
+		cursor = connection.cursor()
+		cursor.execute('PRAGMA journal_mode=%s' % self.journal_mode)
+		cursor.execute('PRAGMA synchronous=%s' % self.synchronous)
+		# a negative cache size is in KiB rather than pages
+		cursor.execute('PRAGMA cache_size=-%d' % self.cache_size)
+		cursor.execute('PRAGMA mmap_size=%d' % (self.mmap_size * 1024 * 1024))
+		cursor.execute('PRAGMA busy_timeout=%d' % (self.busy_timeout * 1000))
+		cursor.execute('PRAGMA temp_store=MEMORY')
+		cursor.close()
+
+		# scores the matches of full text searches, see musik.library.search
+		connection.create_function('rank', -1, rank)
+
+
+# engines are shared by every DatabaseWrapper for the same file, so that all of
+# the threads in the application draw from one connection pool
+engines = {}
+engines_lock = threading.Lock()
+
+
 # Loosely wraps the SQLAlchemy database types and access methods.
 # The goal here isn't to encapsulate SQLAlchemy. Rather, we want dictate
 # to the process of connecting to and disconnecting from the db,
@@ -245,13 +412,20 @@ class DatabaseWrapper:
 
 	def get_engine(self):
 		"""Initializes and returns an instance of sqlalchemy.engine.base.Engine
+		The engine is configured with the StorageProfile and shared with every
+		other DatabaseWrapper for the same file.
 		"""
 		if self.sa_engine == None:
-			self.sa_engine = create_engine('sqlite:///%s' % self.db_path, echo=False)
+			with engines_lock:
+				if self.db_path not in engines:
+					engines[self.db_path] = StorageProfile().create_engine(self.db_path)
+				self.sa_engine = engines[self.db_path]
 		return self.sa_engine
 
 	def init_database(self):
 		"""Initializes the database schema
+		Tables that don't exist yet are created, then the existing ones are
+		upgraded in place by the migrations in musik.migrations.
 		This method is not thread-safe; users must take steps to ensure that it is
 		only called from one thread at a time.
 		If get_engine has not yet been called, this method will call it implicitly.
@@ -259,9 +433,11 @@ class DatabaseWrapper:
 		if self.sa_engine == None:
 			self.get_engine()
 		Base.metadata.create_all(self.sa_engine)
+		migrate(self.sa_engine)
 
-	def get_session(self):
-		"""Initializes and returns an instance of sqlalchemy.engine.base.Engine
+	def get_session(self, **kwargs):
+		"""Initializes and returns an instance of sqlalchemy.orm.session.Session
+		Any keyword arguments override the session configuration, e.g. expire_on_commit.
 		If get_engine has not yet been called, this method will call it implicitly.
 		"""
 		if self.sa_engine == None:
@@ -269,4 +445,4 @@ class DatabaseWrapper:
 
 		if self.sa_sessionmaker == None:
 			self.sa_sessionmaker = sessionmaker(bind=self.sa_engine)
-		return self.sa_sessionmaker()
+		return self.sa_sessionmaker(**kwargs)
@@ -0,0 +1,222 @@
+from cStringIO import StringIO
+import hashlib
+import os
+import threading
+import time
+
+import mutagen
+from mutagen.id3 import ID3
+
+from musik.util import getSetting
+
+# thumbnails are optional. Without PIL, the original image is served at every size.
+try:
+	from PIL import Image
+except ImportError:
+	try:
+		import Image
+	except ImportError:
+		Image = None
+
+
+# image files that hold the artwork of the album in the same directory, in order of preference
+FOLDER_IMAGES = ('cover.jpg', 'cover.png', 'folder.jpg', 'folder.png', 'front.jpg', 'front.png', 'album.jpg', 'album.png')
+
+# the sizes that thumbnails are generated at, in pixels
+THUMBNAIL_SIZES = (120, 300)
+
+# the picture type of a front cover in ID3 APIC frames and FLAC picture blocks
+FRONT_COVER = 3
+
+
+def imageType(data):
+	"""Returns the mime type of the specified image data, or None if it isn't a jpeg or png"""
+	if data.startswith('\xff\xd8'):
+		return 'image/jpeg'
+	if data.startswith('\x89PNG'):
+		return 'image/png'
+	return None
+
+
+def readFolderImage(directory):
+	"""Returns the contents of the first cover image in the specified directory, or None"""
+	try:
+		names = dict((name.lower(), name) for name in os.listdir(directory))
+	except OSError:
+		return None
+
+	for candidate in FOLDER_IMAGES:
+		if candidate in names:
+			try:
+				with open(os.path.join(directory, names[candidate]), 'rb') as f:
+					return f.read()
+			except IOError:
+				continue
+	return None
+
+
+def readEmbeddedImage(uri):
+	"""Returns the embedded cover image of the specified audio file, or None"""
+	try:
+		audio = mutagen.File(uri)
+	except Exception:
+		return None
+	if audio == None:
+		return None
+	return embeddedImage(audio)
+
+
+def embeddedImage(audio):
+	"""Returns the embedded cover image of an audio file that mutagen has already
+	parsed, or None. Front covers are preferred over any other picture.
+	"""
+	pictures = []
+	if isinstance(audio.tags, ID3):
+		pictures = [(frame.type, frame.data) for frame in audio.tags.getall('APIC')]
+	elif hasattr(audio, 'pictures'):
+		# FLAC picture blocks
+		pictures = [(picture.type, picture.data) for picture in audio.pictures]
+	elif audio.tags != None and 'covr' in audio.tags:
+		# MP4 cover atoms don't have a picture type
+		pictures = [(FRONT_COVER, str(cover)) for cover in audio.tags['covr']]
+
+	for (kind, data) in sorted(pictures, key=lambda picture: picture[0] != FRONT_COVER):
+		if imageType(data) != None:
+			return data
+	return None
+
+
+class ArtCache(object):
+	"""A content-addressed disk cache of album art thumbnails.
+	Every image is stored under the SHA-1 of its original contents, once for
+	each thumbnail size, so albums that share a cover share its thumbnails.
+	The cache is capped in size: when it grows past the cap, the least recently
+	used files are removed. Serving a file counts as a use.
+	"""
+
+	root = None							 # directory that the thumbnails are stored in
+	max_bytes = 512 * 1024 * 1024		 # size cap of the cache
+	touch_interval = 3600				 # seconds between updates of a file's last use
+
+	def __init__(self):
+		self.root = os.path.abspath(getSetting('MUSIK_ART_CACHE', os.path.join(os.curdir, 'art-cache')))
+		self.max_bytes = getSetting('MUSIK_ART_CACHE_MB', self.max_bytes / (1024 * 1024)) * 1024 * 1024
+		self.lock = threading.Lock()
+		self.total = None
+
+	def path(self, art_hash, size):
+		"""Returns the path of the thumbnail of the specified image, or None if it isn't cached"""
+		base = os.path.join(self.root, art_hash[:2], art_hash)
+		for candidate in ('%s-%d' % (base, size), '%s-0' % base):
+			if os.path.isfile(candidate):
+				return candidate
+		return None
+
+	def extract(self, uri, embedded=None):
+		"""Finds the album art for the specified audio file: a cover image in its
+		directory, or else a picture embedded in the file. If the embedded picture
+		has already been read, pass it in, so that the file isn't opened again.
+		The art is added to the cache. Returns its hash, or None if the file
+		doesn't have any art.
+		"""
+		data = readFolderImage(os.path.dirname(uri))
+		if data == None:
+			data = embedded if embedded != None else readEmbeddedImage(uri)
+		if data == None:
+			return None
+		return self.store(data)
+
+	def store(self, data):
+		"""Adds the thumbnails of the specified image to the cache. Returns its hash."""
+		art_hash = hashlib.sha1(data).hexdigest()
+		base = os.path.join(self.root, art_hash[:2], art_hash)
+		if self.path(art_hash, THUMBNAIL_SIZES[0]) != None:
+			return art_hash
+
+		try:
+			os.makedirs(os.path.dirname(base))
+		except OSError:
+			# it exists already, possibly because another parser process just made it
+			if not os.path.isdir(os.path.dirname(base)):
+				raise
+
+		files = {}
+		if Image != None:
+			try:
+				for size in THUMBNAIL_SIZES:
+					image = Image.open(StringIO(data))
+					if image.mode != 'RGB':
+						image = image.convert('RGB')
+					image.thumbnail((size, size), Image.ANTIALIAS)
+					thumbnail = StringIO()
+					image.save(thumbnail, 'JPEG', quality=85)
+					files['%s-%d' % (base, size)] = thumbnail.getvalue()
+			except (IOError, ValueError):
+				# PIL can't read it, so fall back to the original
+				files = {}
+		if len(files) == 0:
+			files['%s-0' % base] = data
+
+		written = 0
+		for (path, contents) in files.items():
+			# write to a temporary file first, so a half written file is never served.
+			# Parser processes may be storing the same image at the same time
+			temporary = '%s.%d-%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+			with open(temporary, 'wb') as f:
+				f.write(contents)
+			os.rename(temporary, path)
+			written += len(contents)
+
+		with self.lock:
+			if self.total != None:
+				self.total += written
+		if self.size() > self.max_bytes:
+			self.evict()
+		return art_hash
+
+	def touch(self, path):
+		"""Records a use of the specified file, for the purposes of eviction"""
+		try:
+			if time.time() - os.path.getmtime(path) > self.touch_interval:
+				os.utime(path, None)
+		except OSError:
+			pass
+
+	def size(self):
+		"""Returns the total size of the cache in bytes"""
+		with self.lock:
+			if self.total == None:
+				self.total = sum(size for (mtime, size, path) in self.entries())
+			return self.total
+
+	def entries(self):
+		"""Returns a (last use, size, path) tuple for every file in the cache"""
+		entries = []
+		for (directory, dirnames, filenames) in os.walk(self.root):
+			for name in filenames:
+				path = os.path.join(directory, name)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+		return entries
+
+	def evict(self):
+		"""Removes the least recently used files until the cache is 10% under its cap"""
+		with self.lock:
+			entries = sorted(self.entries())
+			total = sum(size for (mtime, size, path) in entries)
+			for (mtime, size, path) in entries:
+				if total <= self.max_bytes * 0.9:
+					break
+				try:
+					os.remove(path)
+					total -= size
+				except OSError:
+					pass
+			self.total = total
+
+
+# the cache that is shared by the web application and the import workers
+artCache = ArtCache()
@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+
+def normalizeName(name):
+	"""Normalizes an artist name or album title for lookups.
+	Tags frequently carry stray whitespace, so it is collapsed and trimmed.
+	"""
+	if name == None:
+		return None
+	return u' '.join(name.split())
+
+
+class LRUCache(object):
+	"""A size-bounded mapping that evicts the least recently used entry once it is full.
+	Every lookup is counted as either a hit or a miss.
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		"""Returns the value for the specified key, or None if it isn't cached"""
+		if key in self.entries:
+			# move the entry to the most recently used end
+			value = self.entries.pop(key)
+			self.entries[key] = value
+			self.hits += 1
+			return value
+
+		self.misses += 1
+		return None
+
+	def put(self, key, value):
+		"""Caches the value under the specified key, evicting old entries as needed"""
+		if key in self.entries:
+			del self.entries[key]
+		self.entries[key] = value
+
+		while len(self.entries) > self.size:
+			self.entries.popitem(last=False)
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self):
+		return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class DirectoryContext(object):
+	"""What an importer has learned about a directory from the files in it.
+	The files in an album folder nearly always carry the same artist, album and
+	disc tags, so every distinct set of tag values is resolved to an entity once
+	and reused by the siblings that share it. The same goes for the artist and
+	album derived from the path, which are only looked up at all if a file in
+	the directory is missing those tags.
+	"""
+
+	def __init__(self, uri):
+		self.uri = uri
+		self.resolved = {}
+
+	def resolve(self, key, find, *args):
+		"""Returns the entity that key resolved to earlier, or calls find with the
+		remaining arguments to resolve it and remembers the result.
+		"""
+		if key in self.resolved:
+			return self.resolved[key]
+
+		entity = find(*args)
+		self.resolved[key] = entity
+		return entity
+
+
+class EntityCache(object):
+	"""An identity cache of the artists, albums and discs that an importer has
+	resolved. Each entity is cached under every key that it can be looked up by:
+	- artists by musicbrainz_artistid and by normalized name
+	- albums by musicbrainz_albumid and by (normalized title, artist id)
+	- discs by musicbrainz_discid and by (album id, disc number)
+	It also keeps a DirectoryContext for each of the most recently seen directories.
+	The cached objects belong to a single session, so each importer needs its
+	own cache, and the cache must be cleared whenever that session is rolled back.
+	"""
+
+	def __init__(self, size=10000, directories=256):
+		self.artists = LRUCache(size)
+		self.albums = LRUCache(size)
+		self.discs = LRUCache(size)
+		self.directories = LRUCache(directories)
+
+	def getArtist(self, musicbrainz_id=None, name=None):
+		"""Returns the cached artist with the specified musicbrainz id or name"""
+		if musicbrainz_id != None:
+			return self.artists.get(('musicbrainz_id', musicbrainz_id))
+		if name != None:
+			return self.artists.get(('name', normalizeName(name)))
+		return None
+
+	def putArtist(self, artist):
+		if artist.musicbrainz_artistid != None:
+			self.artists.put(('musicbrainz_id', artist.musicbrainz_artistid), artist)
+		if artist.name != None:
+			self.artists.put(('name', normalizeName(artist.name)), artist)
+
+	def getAlbum(self, musicbrainz_id=None, title=None, artist=None):
+		"""Returns the cached album with the specified musicbrainz id, or title and artist"""
+		if musicbrainz_id != None:
+			return self.albums.get(('musicbrainz_id', musicbrainz_id))
+		if title != None and artist != None and artist.id != None:
+			return self.albums.get(('title', normalizeName(title), artist.id))
+		return None
+
+	def putAlbum(self, album, artist=None):
+		"""Caches the album. Pass the artist for albums whose artist_id hasn't been flushed yet."""
+		if album.musicbrainz_albumid != None:
+			self.albums.put(('musicbrainz_id', album.musicbrainz_albumid), album)
+
+		artist_id = album.artist_id
+		if artist_id == None and artist != None:
+			artist_id = artist.id
+		if album.title != None and artist_id != None:
+			self.albums.put(('title', normalizeName(album.title), artist_id), album)
+
+	def getDisc(self, musicbrainz_id=None, album=None, discnumber=None):
+		"""Returns the cached disc with the specified musicbrainz id, or album and disc number"""
+		if musicbrainz_id != None:
+			return self.discs.get(('musicbrainz_id', musicbrainz_id))
+		if album != None and album.id != None and discnumber != None:
+			return self.discs.get(('number', album.id, discnumber))
+		return None
+
+	def putDisc(self, disc, album=None):
+		"""Caches the disc. Pass the album for discs whose album_id hasn't been flushed yet."""
+		if disc.musicbrainz_discid != None:
+			self.discs.put(('musicbrainz_id', disc.musicbrainz_discid), disc)
+
+		album_id = disc.album_id
+		if album_id == None and album != None:
+			album_id = album.id
+		if album_id != None and disc.discnumber != None:
+			self.discs.put(('number', album_id, disc.discnumber), disc)
+
+	def getDirectory(self, uri):
+		"""Returns the context of the specified directory, creating it if needed"""
+		context = self.directories.get(uri)
+		if context == None:
+			context = DirectoryContext(uri)
+			self.directories.put(uri, context)
+		return context
+
+	def clear(self):
+		self.artists.clear()
+		self.albums.clear()
+		self.discs.clear()
+		self.directories.clear()
+
+	def stats(self):
+		"""Returns the size and hit/miss counters of each entity cache"""
+		return {'artists': self.artists.stats(), 'albums': self.albums.stats(), 'discs': self.discs.stats(),
+			'directories': self.directories.stats()}
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import struct
+
+# size of the chunks that files are read in
+CHUNK_SIZE = 64 * 1024
+
+
+def audioHash(uri):
+	"""Returns a hex digest of the audio payload of the specified file.
+	Tags are left out, so the hash survives retagging as well as moves and
+	copies: ID3 and APE tags anywhere, FLAC metadata blocks, the chunks of a WAV
+	file other than its audio data and the header pages of an Ogg stream, which
+	hold its comments. Other formats, e.g. MP4, are hashed whole apart from any
+	ID3 and APE tags, so retagging them changes the hash.
+	The file is read in chunks, so memory use doesn't depend on its size.
+	Raises IOError if the file cannot be read.
+	"""
+	digest = hashlib.sha1()
+	with open(uri, 'rb') as f:
+		f.seek(0, os.SEEK_END)
+		size = f.tell()
+		f.seek(0)
+		start = id3v2Size(f.read(10))
+		f.seek(start)
+		magic = f.read(12)
+
+		if magic.startswith('OggS'):
+			hashOggAudio(f, start, digest)
+			return digest.hexdigest()
+
+		if magic.startswith('fLaC'):
+			start = flacAudioOffset(f, start)
+			end = size
+		elif magic.startswith('RIFF') and magic[8:12] == 'WAVE':
+			(start, end) = waveAudioRange(f, start, size)
+		else:
+			end = size - trailingTagsSize(f, size)
+
+		f.seek(start)
+		remaining = end - start
+		while remaining > 0:
+			chunk = f.read(min(CHUNK_SIZE, remaining))
+			if not chunk:
+				break
+			digest.update(chunk)
+			remaining -= len(chunk)
+
+	return digest.hexdigest()
+
+
+def id3v2Size(header):
+	"""Returns the size of the ID3v2 tag at the start of a file, including its
+	header and footer, or 0 if there is none.
+	"""
+	if len(header) < 10 or not header.startswith('ID3'):
+		return 0
+
+	flags = ord(header[5])
+	(a, b, c, d) = struct.unpack('>4B', header[6:10])
+	size = 10 + (a << 21 | b << 14 | c << 7 | d)
+	if flags & 0x10:
+		# footer present
+		size += 10
+	return size
+
+
+def trailingTagsSize(f, size):
+	"""Returns the combined size of the ID3v1 and APEv2 tags at the end of a file"""
+	trailing = 0
+	if size >= 128:
+		f.seek(size - 128)
+		if f.read(3) == 'TAG':
+			trailing = 128
+
+	if size - trailing >= 32:
+		f.seek(size - trailing - 32)
+		footer = f.read(32)
+		if footer.startswith('APETAGEX'):
+			(length, count, flags) = struct.unpack('<III', footer[12:24])
+			trailing += length
+			if flags & 0x80000000:
+				# the tag has a header as well as a footer
+				trailing += 32
+
+	return min(trailing, size)
+
+
+def flacAudioOffset(f, start=0):
+	"""Returns the offset of the first audio frame of a FLAC file whose stream
+	starts at the specified offset, skipping the metadata blocks, which hold the
+	vorbis comments and pictures.
+	"""
+	f.seek(start + 4)
+	while True:
+		header = f.read(4)
+		if len(header) < 4:
+			return f.tell()
+
+		(value, ) = struct.unpack('>I', header)
+		f.seek(value & 0xffffff, os.SEEK_CUR)
+		if value & 0x80000000:
+			# last metadata block
+			return f.tell()
+
+
+def waveAudioRange(f, start, size):
+	"""Returns the (start, end) offsets of the audio data of a WAV file whose RIFF
+	header starts at the specified offset. The other chunks, e.g. LIST and id3,
+	hold the tags. Falls back to everything after the RIFF header if there is no
+	data chunk.
+	"""
+	offset = start + 12
+	while offset + 8 <= size:
+		f.seek(offset)
+		(chunk_id, length) = struct.unpack('<4sI', f.read(8))
+		if chunk_id == 'data':
+			return (offset + 8, min(offset + 8 + length, size))
+		# chunks are padded to an even length
+		offset += 8 + length + (length & 1)
+	return (start + 12, size)
+
+
+def hashOggAudio(f, start, digest):
+	"""Adds the audio packets of the Ogg stream that starts at the specified offset
+	to the digest. The header packets, which hold the comments, are on pages of
+	their own with a granule position of 0, and are skipped. Only the payload of
+	each page is hashed, because retagging can renumber the pages that follow.
+	"""
+	f.seek(start)
+	while True:
+		header = f.read(27)
+		if len(header) < 27 or not header.startswith('OggS'):
+			return
+
+		(granule, ) = struct.unpack('<q', header[6:14])
+		length = sum(ord(lacing) for lacing in f.read(ord(header[26])))
+		if granule == 0:
+			f.seek(length, os.SEEK_CUR)
+			continue
+
+		remaining = length
+		while remaining > 0:
+			chunk = f.read(min(CHUNK_SIZE, remaining))
+			if not chunk:
+				return
+			digest.update(chunk)
+			remaining -= len(chunk)
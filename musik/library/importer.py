@@ -1,74 +1,108 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import itertools
 import mimetypes
+import multiprocessing
 import os
-import re
 import threading
 import time
 
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3NoHeaderError
-from mutagen.mp3 import MP3
-
+from sqlalchemy import func, or_
 from sqlalchemy.exc import OperationalError
 
 from musik import initLogging
 from musik.db import DatabaseWrapper, ImportTask, Track, Album, Artist, Disc
-from musik.util import EasygoingDictionary
+from musik.library.artwork import artCache, THUMBNAIL_SIZES
+from musik.library.cache import EntityCache, normalizeName
+from musik.library.merge import MetadataMerger, ALBUM_FIELDS, TRACK_ARTISTS, TRACK_FIELDS
+from musik.library.parsing import createParserPool, parseChunk, parseFile, readMetadata
+from musik.library.scanner import fingerprint, isMimeTypeSupported, walkFiles
+from musik.library.search import SearchIndexer
+from musik.library.stats import importStats
+from musik.library.summary import SummaryTracker
+from musik.library.tags import TagReadError
+from musik.library.taskqueue import importQueue, KIND_FILE, PRIORITY_BULK, PRIORITY_INTERACTIVE
+from musik.library.throttle import importThrottle
+from musik.util import chunks, getSetting
 
 
 class ImportThread(threading.Thread):
 
 	running = True		 # whether or not the thread should continue to run
+	renewed = 0			 # when the lease on the current tasks was last renewed
 	sa_session = None	 # database session
+	cache = None		 # identity cache of artists, albums and discs
+	merger = None		 # merges metadata into the library and collects conflicts
+	summaries = None	 # album and artist summaries that need to be refreshed
+	indexer = None		 # tracks, albums and artists that need to be reindexed for search
+	parser = None		 # pool of processes that parse files
 	log = None			 # logging instance
 
-	def __init__(self):
+	scan_batch_size = 1000	 # number of import tasks inserted per transaction by a directory scan
+	batch_size = 200		 # number of files imported per transaction
+	max_backoff = 60		 # longest wait in seconds before retrying when the database is locked
+	parse_timeout = 120		 # seconds to wait for a parser process before it is taken for hung
+	handed = 0				 # when the throttle last handed a file to the parser processes
+
+	def __init__(self, name=__name__, parser=None):
 		"""Creates a new instance of ImportThread and connects to the database.
 		This design pattern is important: since the constructor runs synchonously,
 		it ensures that two threads don't attempt to initialize the database at
 		the same time.
+		Files are parsed by the specified pool of parser processes, or in the
+		thread itself if no pool is specified.
 		"""
-		super(ImportThread, self).__init__(name=__name__)
+		super(ImportThread, self).__init__(name=name)
 		self.log = initLogging(__name__)
+		self.parser = parser
+		self.scan_batch_size = getSetting('MUSIK_IMPORT_SCAN_BATCH', self.scan_batch_size)
+		self.batch_size = getSetting('MUSIK_IMPORT_BATCH_SIZE', self.batch_size)
+		self.parse_timeout = getSetting('MUSIK_IMPORT_PARSE_TIMEOUT', self.parse_timeout)
+		self.cache = EntityCache(getSetting('MUSIK_IMPORT_CACHE_SIZE', 10000), getSetting('MUSIK_IMPORT_DIRECTORY_CACHE_SIZE', 256))
+		self.merger = MetadataMerger()
+		self.summaries = SummaryTracker()
+		self.indexer = SearchIndexer()
+
+		# cached entities have to stay usable across commits, so don't expire them
 		db = DatabaseWrapper()
-		self.sa_session = db.get_session()
+		self.sa_session = db.get_session(expire_on_commit=False)
 
 	def run(self):
-		"""Checks for new import tasks once per second and passes them off to
-		the appropriate handler functions for completion.
+		"""Works through the import queue, passing each task off to the appropriate
+		handler function for completion. Tasks are processed back to back; when
+		the queue is empty the thread sleeps until another task is queued.
 		"""
+		backoff = 0
 		try:
 			# process 'till you drop
 			while self.running:
 
-				# find the first unprocessed import task
+				# remember where the queue was before looking at it, so that
+				# anything queued while we are busy wakes us straight back up
+				generation = importQueue.generation
+
+				# claim and process the next batch of unprocessed import tasks
 				try:
-					task = self.sa_session.query(ImportTask).filter(ImportTask.started == None).order_by(ImportTask.created).first()
-				except OperationalError:
-					# Ran into this when my SQLite database was locked.
-					self.log.error(u'Operational error accessing database. Ensure it is not open by another process.')
-					break
-				if task != None:
-					# start processing it
-					task.started = datetime.utcnow()
-					self.sa_session.commit()
-					self.log.info(u'%s is processing task %s', self.getName(), unicode(task))
-
-					# process the task
-					if os.path.isdir(task.uri):
-						self.log.info(u'Importing directory %s', task.uri)
-						self.importDirectory(task.uri)
-					elif os.path.isfile(task.uri):
-						self.log.info(u'Importing file %s', task.uri)
-						self.importFile(task.uri)
-					else:
-						self.log.warning(u'Unrecognized URI %s', task.uri)
-
-					task.completed = datetime.utcnow()
-					self.sa_session.commit()
-					self.log.info(u'%s has finished processing task %s', self.getName(), unicode(task))
-
-				time.sleep(1)
+					tasks = self.claimTasks(self.batch_size)
+					if len(tasks) > 0:
+						self.processTasks(tasks)
+					backoff = 0
+				except OperationalError as oe:
+					if not u'locked' in unicode(oe):
+						self.log.error(u'Operational error accessing database: %s', unicode(oe))
+						break
+
+					# somebody held on to the write lock for longer than the busy
+					# timeout. Put the tasks back and try again in a little while
+					backoff = min(backoff * 2 or 1, self.max_backoff)
+					self.log.warning(u'%s found the database locked. Retrying in %d seconds.', self.getName(), backoff)
+					self.rollback()
+					self.releaseTasks()
+					time.sleep(backoff)
+					continue
+
+				if len(tasks) == 0:
+					self.log.debug(u'%s is idle. Entity cache statistics: %s', self.getName(), self.cache.stats())
+					importQueue.wait(generation)
 
 		finally:
 			# always clean up - your mom doesn't work here
@@ -76,55 +110,458 @@ class ImportThread(threading.Thread):
 				self.sa_session.close()
 				self.sa_session = None
 
+	def claimTasks(self, limit, priority=None):
+		"""Claims up to limit of the oldest unstarted import tasks on behalf of this thread.
+		Tasks are claimed from the highest priority lane that has any, and a batch
+		never mixes lanes. If a priority is specified, lower lanes are left alone.
+		The claim is a conditional UPDATE that only matches tasks that are still
+		unstarted, so when several workers race for the same rows each row goes
+		to exactly one of them. Claiming a task takes out a lease on it and counts
+		an attempt. Tasks that have been attempted before are claimed on their own,
+		so that a file that crashes the importer can't take a whole batch down with it.
+		Returns the list of claimed tasks, which is empty if there is nothing left to do.
+		"""
+		while self.running:
+			q = self.sa_session.query(ImportTask.id, ImportTask.attempts, ImportTask.priority).filter(ImportTask.started == None,
+				ImportTask.completed == None, ImportTask.quarantined == None)
+			if priority != None:
+				q = q.filter(ImportTask.priority >= priority)
+			candidates = q.order_by(ImportTask.priority.desc(), ImportTask.created, ImportTask.id).limit(limit).all()
+			if len(candidates) == 0:
+				return []
+
+			if candidates[0][1] > 0:
+				ids = [candidates[0][0]]
+			else:
+				lane = candidates[0][2]
+				ids = [row[0] for row in itertools.takewhile(lambda row: not row[1] and row[2] == lane, candidates)]
+
+			started = datetime.utcnow()
+			claimed = self.sa_session.query(ImportTask).filter(ImportTask.id.in_(ids), ImportTask.started == None,
+				ImportTask.completed == None).update({
+				'started': started,
+				'worker': self.getName(),
+				'lease_expires': started + timedelta(seconds=importQueue.lease),
+				'attempts': func.coalesce(ImportTask.attempts, 0) + 1,
+			}, synchronize_session=False)
+			self.sa_session.commit()
+			self.renewed = time.time()
+
+			if claimed > 0:
+				# the session doesn't expire objects on commit, so make sure they are up to date
+				tasks = self.sa_session.query(ImportTask).populate_existing().filter(ImportTask.id.in_(ids),
+					ImportTask.worker == self.getName(), ImportTask.started == started).order_by(ImportTask.created, ImportTask.id).all()
+				importStats.claimed(self.getName(), [task.uri for task in tasks])
+				return tasks
+
+			self.log.debug(u'%s lost the race for %d tasks', self.getName(), len(ids))
+
+		return []
+
+	def releaseTasks(self):
+		"""Returns the unfinished tasks of this thread to the queue without counting
+		the attempt against them, since it wasn't their fault. Returns the number of
+		tasks that were released.
+		"""
+		try:
+			released = self.sa_session.query(ImportTask).filter(ImportTask.worker == self.getName(), ImportTask.completed == None,
+				ImportTask.started != None, ImportTask.quarantined == None).update({
+					'started': None,
+					'worker': None,
+					'lease_expires': None,
+					'attempts': ImportTask.attempts - 1,
+				}, synchronize_session=False)
+			self.sa_session.commit()
+		except OperationalError:
+			# the lease runs out eventually, and then the pool reclaims them
+			self.rollback()
+			return 0
+
+		importStats.released(self.getName())
+		importStats.queued(released)
+		return released
+
+	def heartbeat(self):
+		"""Renews the lease on every task that this thread is working on.
+		Renewing is rate limited, so this is cheap enough to call often. It commits
+		the session, so only call it between transactions.
+		"""
+		if time.time() - self.renewed < importQueue.lease / 3:
+			return
+
+		self.sa_session.query(ImportTask).filter(ImportTask.worker == self.getName(), ImportTask.completed == None,
+			ImportTask.started != None).update({'lease_expires': datetime.utcnow() + timedelta(seconds=importQueue.lease)},
+			synchronize_session=False)
+		self.sa_session.commit()
+		self.renewed = time.time()
+
+	def processTasks(self, tasks):
+		"""Processes a batch of claimed tasks. Directories are scanned one by one,
+		while all of the files in the batch are imported together.
+		"""
+		files = []
+		for task in tasks:
+			if os.path.isfile(task.uri):
+				files.append(task)
+				continue
+
+			self.heartbeat()
+
+			self.log.info(u'%s is processing task %s', self.getName(), unicode(task))
+			started = time.time()
+			if os.path.isdir(task.uri):
+				self.log.info(u'Importing directory %s', task.uri)
+				self.importDirectory(task.uri)
+			else:
+				self.log.warning(u'Unrecognized URI %s', task.uri)
+
+			task.completed = datetime.utcnow()
+			self.sa_session.commit()
+			importStats.finished(self.getName(), [task.uri], 0, time.time() - started)
+			self.log.info(u'%s has finished processing task %s', self.getName(), unicode(task))
+
+		if len(files) > 0:
+			self.heartbeat()
+			self.importFiles(files)
+
 	# adds a directory to the local library
-	# in practice, this is a breadth-first searche over the specified directory and its
-	# subdirectories that places appropriate files back into the import queue
-	# TODO: directory permissions. Make sure that we can read before we try to
+	# in practice, this is a depth-first search over the specified directory and its
+	# subdirectories that places appropriate files back into the import queue.
+	# new tasks are inserted in batches, one transaction per batch.
 	def importDirectory(self, uri):
-		searchQueue = [uri]
-		while len(searchQueue) > 0:
-			# this is the current working directory
-			baseuri = searchQueue.pop(0)
-			if os.path.isdir(baseuri) == False:
-				continue
+		started = time.time()
+		counter = [0]
+		queued = 0
+
+		batch = {}
+		for entry in walkFiles(uri, counter):
+			if self.isMimeTypeSupported(entry.path):
+				try:
+					batch[entry.path] = fingerprint(entry.stat())
+				except OSError:
+					# the file disappeared between listing and stat
+					continue
+
+				if len(batch) >= self.scan_batch_size:
+					queued += self.queueChangedFiles(batch)
+					batch = {}
+					self.heartbeat()
+
+					# a big scan can take a while, so don't keep anyone waiting
+					self.processInteractiveTasks()
+					importThrottle.pause()
+			else:
+				self.log.debug(u'Ignoring file %s', entry.path)
+
+		if len(batch) > 0:
+			queued += self.queueChangedFiles(batch)
 
-			# iterate over the subdirectories and files in the current working directory
-			entries = os.listdir(baseuri)
-			for subdir in entries:
-
-				# if we found a directory, put it back on the queue. otherwise, process it
-				newuri = os.path.join(baseuri, subdir)
-				if os.path.isdir(newuri):
-					searchQueue.append(newuri)
-				elif os.path.isfile(newuri):
-					if self.isMimeTypeSupported(newuri):
-						# create a new import task for useful files
-						newtask = ImportTask(newuri)
-						self.sa_session.add(newtask)
-						self.sa_session.commit()
-					else:
-						self.log.debug(u'Ignoring file %s', newuri)
+		elapsed = max(time.time() - started, 0.001)
+		self.log.info(u'Scanned %d entries in %s in %.2fs (%.0f entries/s), queued %d new or changed files',
+			counter[0], uri, elapsed, counter[0] / elapsed, queued)
+
+	def queueChangedFiles(self, fingerprints):
+		"""Creates import tasks for the files in the specified uri -> fingerprint
+		dictionary, skipping any file whose fingerprint matches the one recorded in
+		the library. Files that haven't changed are never opened.
+		Returns the number of files that were queued.
+		"""
+		uris = fingerprints.keys()
+		known = {}
+
+		for chunk in chunks(uris):
+			for row in self.sa_session.query(Track.uri, Track.file_size, Track.file_mtime, Track.file_inode, Track.file_device).filter(Track.uri.in_(chunk)):
+				known[row[0]] = tuple(row[1:])
+
+		changed = [uri for uri in uris if known.get(uri) != fingerprints[uri]]
+		return importQueue.enqueueMany(self.sa_session, changed, KIND_FILE, PRIORITY_BULK)
+
+	def processInteractiveTasks(self):
+		"""Processes the tasks in the interactive lane, if there are any.
+		Called in between the batches of a directory scan.
+		"""
+		tasks = self.claimTasks(self.batch_size, PRIORITY_INTERACTIVE)
+		if len(tasks) > 0:
+			self.log.info(u'%s is interrupting a directory scan for %d interactive tasks', self.getName(), len(tasks))
+			self.processTasks(tasks)
 
 	# returns True if the mime type of the specified uri is supported
 	# this should only support audio files
 	# TODO: query gstreamer (or whatever other backend we're using) to determine support up front
 	def isMimeTypeSupported(self, uri):
-		mtype = mimetypes.guess_type(uri)[0]
-		if mtype in (u'audio/mpeg', u'audio/flac', u'audio/ogg', u'audio/x-wav'):
-			return True
-		else:
-			return False
+		return isMimeTypeSupported(uri)
 
 	def importFile(self, uri):
 		self.log.debug(u'ImportFile called with uri %s', uri)
 
-		mtype = mimetypes.guess_type(uri)[0]
-		if mtype != u'audio/mpeg':
-			self.log.info(u'Unsupported mime type %s. Ignoring file.', mtype)
+		if not self.isMimeTypeSupported(uri):
+			self.log.info(u'Unsupported mime type %s. Ignoring file %s.', mimetypes.guess_type(uri)[0], uri)
+			return
 
 		# Try to read the metadata appropriately.
 		self.createTrack(uri)
 
+	def importFiles(self, tasks):
+		"""Imports the files of a batch of file tasks in a single transaction.
+		Unchanged files are skipped, and the remaining files are parsed by the
+		parser processes (or in this thread if there are none). Nothing is written
+		until every file has been parsed, so that the throttle never sleeps while
+		the transaction holds the write lock, and then the results are merged and
+		committed in one go.
+		Files that are new to the library are checked against the tracks whose
+		files have gone missing, first by inode and then by audio hash, so that
+		moving a file updates its track instead of creating a duplicate.
+		"""
+		started = time.time()
+		self.log.info(u'%s is importing a batch of %d files', self.getName(), len(tasks))
+
+		fingerprints = {}
+		for task in tasks:
+			if not self.isMimeTypeSupported(task.uri):
+				self.log.info(u'Unsupported mime type %s. Ignoring file %s.', mimetypes.guess_type(task.uri)[0], task.uri)
+				continue
+			try:
+				fingerprints[task.uri] = fingerprint(os.stat(task.uri))
+			except OSError as ose:
+				self.log.error(u'Cannot stat %s. It cannot be added to the library at this time: %s', task.uri, unicode(ose))
+
+		# look up all of the existing tracks in one go, and only parse the files that changed
+		tracks = {}
+		uris = fingerprints.keys()
+		for chunk in chunks(uris):
+			for track in self.sa_session.query(Track).filter(Track.uri.in_(chunk)):
+				tracks[track.uri] = track
+
+		# moves within a filesystem keep the inode, so they are caught without reading the file.
+		# The tracks get their new uris along with everything else that is written
+		moved = self.findMovedTracks(dict((uri, fingerprints[uri]) for uri in uris if uri not in tracks))
+		tracks.update(moved)
+
+		changed = [uri for uri in uris if uri not in tracks or tracks[uri].fingerprint() != fingerprints[uri]]
+
+		# unchanged files are parsed again if the art of their album has been evicted
+		# from the art cache, which puts it back. The art endpoint queues them for that
+		evicted = self.findEvictedArt(set(track.album_id for (uri, track) in tracks.items() if uri not in changed))
+		changed += [uri for uri in uris if uri in tracks and uri not in changed and tracks[uri].album_id in evicted]
+
+		(results, lost) = self.parseFiles(changed, fingerprints)
+		if len(lost) > 0:
+			# one of the files hung or crashed its parser, but there is no telling which
+			failed = [task for task in tasks if task.uri in lost]
+			self.failTasks(failed)
+			tasks = [task for task in tasks if task.uri not in lost]
+
+		# everything from here on is written in one short transaction, so make
+		# sure that the tasks are still ours before starting it
+		self.heartbeat()
+
+		imported = 0
+		try:
+			for uri, track in moved.items():
+				self.log.info(u'Track %s was moved to %s', track.uri, uri)
+				track.uri = uri
+
+			# the album art is taken from the files again. If they don't have it
+			# anymore, the albums shouldn't point at it either
+			for uri in changed:
+				track = tracks.get(uri)
+				if track != None and track.album_id in evicted and track.album != None:
+					track.album.art_hash = None
+
+			new = []
+			for (uri, metadata, error) in results:
+				if error != None:
+					self.log.error(u'Cannot read metadata from %s. It cannot be added to the library at this time.' % uri)
+					self.log.error(u'Exception message: %s' % error)
+					continue
+
+				if uri not in tracks:
+					# wait until all of the hashes are in, so they can be looked up in one go
+					new.append((uri, metadata))
+					continue
+
+				self.importMetadata(tracks[uri], fingerprints[uri], metadata)
+				imported += 1
+
+			# anything else that is new may still have been moved across filesystems
+			moved = self.findTracksByHash([metadata['audio_hash'] for (uri, metadata) in new])
+			for (uri, metadata) in new:
+				track = moved.pop(metadata['audio_hash'], None)
+				if track != None:
+					self.log.info(u'Track %s was moved to %s', track.uri, uri)
+					track.uri = uri
+				else:
+					track = Track(uri)
+					self.sa_session.add(track)
+
+				self.importMetadata(track, fingerprints[uri], metadata)
+				imported += 1
+
+			now = datetime.utcnow()
+			for task in tasks:
+				task.completed = now
+
+			conflicts = self.merger.save(self.sa_session)
+			self.summaries.save(self.sa_session)
+			self.indexer.save(self.sa_session)
+			self.sa_session.commit()
+		except OperationalError:
+			raise
+		except Exception as e:
+			# one bad file shouldn't sink the whole batch. Start over one file at a time,
+			# so that only the bad file is rolled back and it is retried on the next rescan
+			self.log.exception(u'Importing a batch of %d files failed. Retrying them one by one: %s', len(tasks), unicode(e))
+			self.rollback()
+			for task in tasks:
+				self.heartbeat()
+				try:
+					self.importFile(task.uri)
+				except Exception as e:
+					self.log.exception(u'Unexpected error importing %s: %s', task.uri, unicode(e))
+					self.rollback()
+				task.completed = datetime.utcnow()
+				self.sa_session.commit()
+			importStats.finished(self.getName(), [task.uri for task in tasks], len(tasks), time.time() - started)
+			return
+
+		elapsed = max(time.time() - started, 0.001)
+		importStats.finished(self.getName(), [task.uri for task in tasks], len(tasks), elapsed)
+		self.log.info(u'%s imported %d of %d files in %.2fs (%.1f files/s), %d were unchanged, %d metadata conflicts recorded',
+			self.getName(), imported, len(tasks), elapsed, len(tasks) / elapsed, len(uris) - len(changed), conflicts)
+
+	def importMetadata(self, track, fingerprint, metadata):
+		"""Updates the track with the fingerprint and metadata of its file.
+		The fingerprint is set last, so that a track that could not be merged is
+		never taken for up to date. Errors are passed on, and the caller has to
+		roll back.
+		"""
+		track.audio_hash = metadata['audio_hash']
+		self.updateTrack(track, metadata)
+		track.set_fingerprint(fingerprint)
+
+	def findMovedTracks(self, fingerprints):
+		"""Finds the tracks that the files in the specified uri -> fingerprint
+		dictionary used to belong to before they were moved. A track matches if
+		its file has gone missing and it has exactly the same fingerprint, inode
+		and device included. Returns a uri -> track dictionary.
+		"""
+		inodes = dict((fingerprint[2], uri) for uri, fingerprint in fingerprints.items())
+
+		moved = {}
+		for chunk in chunks(inodes.keys()):
+			for track in self.sa_session.query(Track).filter(Track.file_inode.in_(chunk)):
+				uri = inodes[track.file_inode]
+				if uri not in moved and track.fingerprint() == fingerprints[uri] and not os.path.exists(track.uri):
+					moved[uri] = track
+		return moved
+
+	def findEvictedArt(self, album_ids):
+		"""Returns the ids of the albums, out of the specified ones, whose art has
+		been evicted from the art cache.
+		"""
+		album_ids = [album_id for album_id in album_ids if album_id != None]
+
+		evicted = set()
+		for chunk in chunks(album_ids):
+			for (album_id, art_hash) in self.sa_session.query(Album.id, Album.art_hash).filter(Album.id.in_(chunk), Album.art_hash != None):
+				if artCache.path(art_hash, THUMBNAIL_SIZES[0]) == None:
+					evicted.add(album_id)
+		return evicted
+
+	def findTracksByHash(self, hashes):
+		"""Finds the tracks with the specified audio hashes whose files have gone
+		missing. Returns a hash -> track dictionary.
+		"""
+		hashes = [audio_hash for audio_hash in hashes if audio_hash != None]
+
+		found = {}
+		for chunk in chunks(hashes):
+			for track in self.sa_session.query(Track).filter(Track.audio_hash.in_(chunk)):
+				if track.audio_hash not in found and not os.path.exists(track.uri):
+					found[track.audio_hash] = track
+		return found
+
+	def throttle(self, uris, fingerprints):
+		"""Yields the uris no faster than the import throttle allows"""
+		for uri in uris:
+			importThrottle.acquire(1, fingerprints[uri][0])
+			self.handed = time.time()
+			yield uri
+
+	def parseFiles(self, uris, fingerprints):
+		"""Parses the files with the specified uris and returns a list of
+		(uri, metadata, error) tuples, along with the set of uris whose results
+		never came back. The throttle paces the files as they are handed out, so
+		parsing never reads faster than the configured rates.
+		If the parser processes don't return anything for parse_timeout seconds
+		while no file is waiting for the throttle, one of them has hung or died.
+		The pool is restarted then, and the files that it was working on are lost.
+		Nothing may be waiting to be written while this runs: the lease on the
+		tasks is renewed as the results come in, and renewing it commits.
+		"""
+		throttled = self.throttle(uris, fingerprints)
+		if self.parser == None:
+			parsed = []
+			for result in itertools.imap(parseFile, throttled):
+				parsed.append(result)
+				self.heartbeat()
+			return (parsed, set())
+
+		# the pool only lets results be waited on with a timeout when it hands out
+		# one item at a time, so the files are grouped into chunks up front
+		(generation, results) = self.parser.imap_unordered(parseChunk, chunks(throttled, 8))
+		parsed = []
+		received = time.time()
+		while True:
+			try:
+				chunk = results.next(1)
+			except StopIteration:
+				break
+			except multiprocessing.TimeoutError:
+				self.heartbeat()
+				if time.time() - max(received, self.handed) < self.parse_timeout:
+					continue
+				lost = set(uris) - set(uri for (uri, metadata, error) in parsed)
+				self.log.error(u'%s got no results from the parser processes for %d seconds. Restarting them and giving up on %d files.',
+					self.getName(), self.parse_timeout, len(lost))
+				self.parser.restart(generation)
+				return (parsed, lost)
+
+			received = time.time()
+			parsed.extend(chunk)
+			self.heartbeat()
+		return (parsed, set())
+
+	def failTasks(self, tasks):
+		"""Gives up on the specified tasks for now, counting the attempt against them.
+		They go back into the queue, unless they have used up all of their attempts,
+		in which case they are quarantined. Commits the session.
+		"""
+		now = datetime.utcnow()
+		requeued = 0
+		for task in tasks:
+			self.log.error(u'%s failed to import %s (attempt %d of %d)', self.getName(), task.uri, task.attempts, importQueue.max_attempts)
+			if task.attempts >= importQueue.max_attempts:
+				task.quarantined = now
+			else:
+				task.started = None
+				task.worker = None
+				task.lease_expires = None
+				requeued += 1
+		self.sa_session.commit()
+
+		if requeued > 0:
+			importStats.queued(requeued)
+			importQueue.notify()
+
+	def rollback(self):
+		"""Rolls back the session, along with everything that remembers objects from it"""
+		self.sa_session.rollback()
+		self.cache.clear()
+		self.merger.clear()
+		self.summaries.clear()
+		self.indexer.clear()
+
 	def createTrack(self, uri):
 		"""Creates a track object out of the specified URI.
 		Returns a fully populated musik.db.Track object that has already been
@@ -146,372 +583,183 @@ class ImportThread(threading.Thread):
 			self.log.error(u"An error occurred accessing the database: %s" % error_text)
 			return
 
+		try:
+			current = fingerprint(os.stat(uri))
+		except OSError as ose:
+			self.log.error(u'Cannot stat %s. It cannot be added to the library at this time: %s', uri, unicode(ose))
+			return False
+
 		if track == None:
-			track = Track(uri)
-			self.sa_session.add(track)
+			# the file may have been moved here within the same filesystem
+			track = self.findMovedTracks({uri: current}).get(uri)
+			if track != None:
+				self.log.info(u'Track %s was moved to %s', track.uri, uri)
+				track.uri = uri
+				self.sa_session.commit()
+				return track
+		elif track.fingerprint() == current:
+			self.log.debug(u'Track with uri %s is already in the library and has not changed. Skipping it.', uri)
+			return
 		else:
-			self.log.info(u'Track with uri %s is already in the library. Updating metadata...')
+			self.log.info(u'Track with uri %s is already in the library. Updating metadata...', uri)
+
+		# the session has nothing to write yet, so the throttle can't keep the write lock held
+		importThrottle.acquire(1, current[0])
 
 		try:
-			# get id3 data from the file
-			easyid3 = EasyID3(uri)
-		except ID3NoHeaderError as nhe:
-			self.log.error(u'Cannot read ID3 data from %s. It cannot be added to the library at this time.' % uri)
-			self.log.error(u'Exception message: %s' % unicode(nhe))
+			# get the tags, stream info and audio hash from the file in one go
+			metadata = readMetadata(uri)
+		except TagReadError as tre:
+			self.log.error(u'Cannot read metadata from %s. It cannot be added to the library at this time.' % uri)
+			self.log.error(u'Exception message: %s' % unicode(tre))
 			return False
 
-		metadata = EasygoingDictionary()
-		for key in easyid3.keys():
-			if type(easyid3[key]) == list:
-				metadata[key] = easyid3[key][0]
+		if track == None:
+			# or it may have been moved here from another filesystem
+			track = self.findTracksByHash([metadata['audio_hash']]).get(metadata['audio_hash'])
+			if track != None:
+				self.log.info(u'Track %s was moved to %s', track.uri, uri)
+				track.uri = uri
 			else:
-				metadata[key] = easyid3[key]
+				track = Track(uri)
+				self.sa_session.add(track)
+
+		self.importMetadata(track, current, metadata)
+
+		#commit the transaction
+		self.merger.save(self.sa_session)
+		self.summaries.save(self.sa_session)
+		self.indexer.save(self.sa_session)
+		self.sa_session.commit()
+		return track
+
+	def updateTrack(self, track, metadata):
+		"""Merges the metadata read from a file into the specified track, resolving
+		its artists, album and disc along the way. The session is not committed.
+		Entities are resolved through the context of the file's directory, so
+		siblings with the same tags share a single lookup.
+		"""
+		uri = track.uri
+		merger = self.merger
+		(dirName, fileName) = os.path.split(uri)
+		context = self.cache.getDirectory(dirName)
 
 		# artist
-		artist = self.findArtist(metadata['artist'], metadata['artistsort'], metadata['musicbrainz_artistid'])
-		if artist != None:
-			if track.artist == None:
-				track.artist = artist
-				self.sa_session.add(artist)
-			elif track.artist.id != artist.id:
-				# TODO: conflict!
-				self.log.warning(u'Artist conflict for track %s: %s != %s', track, track.artist, artist)
+		artist = self.resolveArtist(context, metadata['artist'], metadata['artistsort'], metadata['musicbrainz_artistid'], uri)
+		merger.mergeRelation(track, 'artist', artist, uri)
 
 		# album artist - use the artist if metadata isn't set
-		album_artist = self.findArtist(metadata['albumartist'], metadata['albumartistsort'])
-		if album_artist != None:
-			if track.album_artist == None:
-				track.album_artist = album_artist
-				self.sa_session.add(album_artist)
-			elif track.album_artist.id != album_artist.id:
-				# TODO: conflict!
-				self.log.warning(u'Album artist conflict for track %s: %s != %s', track, track.album_artist, album_artist)
-		elif artist != None:
-			if track.album_artist == None:
-				track.album_artist = artist
-				self.sa_session.add(artist)
-			elif track.album_artist.id != artist.id:
-				# TODO: conflict!
-				self.log.warning(u'Album artist conflict for track %s: %s != %s', track, track.album_artist, artist)
-
-		# arranger
-		arranger = self.findArtist(metadata['arranger'])
-		if arranger != None:
-			if track.arranger == None:
-				track.arranger = arranger
-				self.sa_session.add(arranger)
-			elif track.arranger.id != arranger.id:
-				# TODO: conflict!
-				self.log.warning(u'Arranger conflict for track %s: %s != %s', track, track.arranger, arranger)
-
-		# author
-		author = self.findArtist(metadata['author'])
-		if author != None:
-			if track.author == None:
-				track.author = author
-				self.sa_session.add(author)
-			elif track.author.id != author.id:
-				# TODO: conflict!
-				self.log.warning(u'Author conflict for track %s: %s != %s', track, track.author, author)
-
-		# composer
-		composer = self.findArtist(metadata['composer'], metadata['composersort'])
-		if composer != None:
-			if track.composer == None:
-				track.composer = composer
-				self.sa_session.add(composer)
-			elif track.composer.id != composer.id:
-				# TODO: conflict!
-				self.log.warning(u'Composer conflict for track %s: %s != %s', track, track.composer, composer)
-
-		# conductor
-		conductor = self.findArtist(metadata['conductor'])
-		if conductor != None:
-			if track.conductor == None:
-				track.conductor = conductor
-				self.sa_session.add(conductor)
-			elif track.conductor.id != conductor.id:
-				# TODO: conflict!
-				self.log.warning(u'Conductor conflict for track %s: %s != %s', track, track.conductor, conductor)
-
-		# lyricist
-		lyricist = self.findArtist(metadata['lyricist'])
-		if lyricist != None:
-			if track.lyricist == None:
-				track.lyricist = lyricist
-				self.sa_session.add(lyricist)
-			elif track.lyricist.id != lyricist.id:
-				# TODO: conflict!
-				self.log.warning(u'Lyricist conflict for track %s: %s != %s', track, track.lyricist, lyricist)
-
-		# performer
-		performer = self.findArtist(metadata['performer'])
-		if performer != None:
-			if track.performer == None:
-				track.performer = performer
-				self.sa_session.add(performer)
-			elif track.performer.id != performer.id:
-				# TODO: conflict!
-				self.log.warning(u'Performer conflict for track %s: %s != %s', track, track.performer, performer)
-
-		# album
-		album = self.findAlbum(metadata['album'], metadata['albumsort'], metadata['musicbrainz_albumid'], track.artist, metadata)
-		if album != None:
-			if track.album == None:
-				track.album = album
-				self.sa_session.add(album)
-			elif track.album.id != album.id:
-				# TODO: conflict!
-				self.log.warning(u'Album conflict for track %s: %s != %s', track, track.album, album)
-
-		# disc
+		album_artist = self.resolveArtist(context, metadata['albumartist'], metadata['albumartistsort'], None, uri)
+		merger.mergeRelation(track, 'album_artist', album_artist if album_artist != None else artist, uri)
+
+		# arranger, author, composer, conductor, lyricist and performer
+		for (relation, key, sortkey) in TRACK_ARTISTS:
+			if metadata[key] != None:
+				other = self.resolveArtist(context, metadata[key], metadata[sortkey] if sortkey != None else None, None, uri)
+				merger.mergeRelation(track, relation, other, uri)
+
+		# album - the album fields are part of the key, so that a sibling that
+		# disagrees about them still gets merged (and its conflicts recorded)
+		fields = tuple(metadata[key] for (column, key) in ALBUM_FIELDS)
+		album = context.resolve(('album', metadata['album'], metadata['albumsort'], metadata['musicbrainz_albumid'], track.artist, fields),
+			self.findAlbum, metadata['album'], metadata['albumsort'], metadata['musicbrainz_albumid'], track.artist, metadata, uri)
+		merger.mergeRelation(track, 'album', album, uri)
+
+		# disc - findDisc links new discs to the album, so there is no need to
+		# go through the album's (dynamic) disc collection here
 		if track.album != None:
-			disc = self.findDisc(track.album, metadata['discnumber'], metadata['discsubtitle'], metadata['musicbrainz_discid'])
-			for d in track.album.discs:
-				if d.id == disc.id:
-					# found disc is already linked - don't add it again
-					disc = None
-			if disc != None:
-				track.album.discs.append(disc)
-
-		#bpm
-		if metadata['bpm'] != None:
-			if track.bpm == None:
-				track.bpm = metadata['bpm']
-			elif track.bpm != metadata['bpm']:
-				# TODO: conflict!
-				self.log.warning(u'Track bpm conflict for track %s: %s != %s', track, track.bpm, metadata['bpm'])
-
-		#copyright
-		if metadata['copyright'] != None:
-			if track.copyright == None:
-				track.copyright = metadata['copyright']
-			elif track.copyright != metadata['copyright']:
-				# TODO: conflict!
-				self.log.warning(u'Track copyright conflict for track %s: %s != %s', track, track.copyright, metadata['copyright'])
-
-		#date
-		if metadata['date'] != None:
-			if track.date == None:
-				track.date = metadata['date']
-			elif track.date != metadata['date']:
-				# TODO: conflict!
-				self.log.warning(u'Track date conflict for track %s: %s != %s', track, track.date, metadata['date'])
-
-		#encodedby
-		if metadata['encodedby'] != None:
-			if track.encodedby == None:
-				track.encodedby = metadata['encodedby']
-			elif track.encodedby != metadata['encodedby']:
-				# TODO: conflict!
-				self.log.warning(u'Track encodedby conflict for track %s: %s != %s', track, track.encodedby, metadata['encodedby'])
-
-		#genre
-		if metadata['genre'] != None:
-			if track.genre == None:
-				track.genre = metadata['genre']
-			elif track.genre != metadata['genre']:
-				# TODO: conflict!
-				self.log.warning(u'Track genre conflict for track %s: %s != %s', track, track.genre, metadata['genre'])
-
-		#isrc
-		if metadata['isrc'] != None:
-			if track.isrc == None:
-				track.isrc = metadata['isrc']
-			elif track.isrc != metadata['isrc']:
-				# TODO: conflict!
-				self.log.warning(u'Track isrc conflict for track %s: %s != %s', track, track.isrc, metadata['isrc'])
-
-		#length
-		if metadata['length'] != None:
-			if track.length == None:
-				track.length = metadata['length']
-			elif track.length != metadata['length']:
-				# TODO: conflict!
-				self.log.warning(u'Track length conflict for track %s: %s != %s', track, track.length, metadata['length'])
-
-		#mood
-		if metadata['mood'] != None:
-			if track.mood == None:
-				track.mood = metadata['mood']
-			elif track.mood != metadata['mood']:
-				# TODO: conflict!
-				self.log.warning(u'Track mood conflict for track %s: %s != %s', track, track.mood, metadata['mood'])
-
-		#musicbrainz_trackid
-		if metadata['musicbrainz_trackid'] != None:
-			if track.musicbrainz_trackid == None:
-				track.musicbrainz_trackid = metadata['musicbrainz_trackid']
-			elif track.musicbrainz_trackid != metadata['musicbrainz_trackid']:
-				# TODO: conflict!
-				self.log.warning(u'Track musicbrainz_trackid conflict for track %s: %s != %s', track, track.musicbrainz_trackid, metadata['musicbrainz_trackid'])
-
-		#musicbrainz_trmid
-		if metadata['musicbrainz_trmid'] != None:
-			if track.musicbrainz_trmid == None:
-				track.musicbrainz_trmid = metadata['musicbrainz_trmid']
-			elif track.musicbrainz_trmid != metadata['musicbrainz_trmid']:
-				# TODO: conflict!
-				self.log.warning(u'Track musicbrainz_trmid conflict for track %s: %s != %s', track, track.musicbrainz_trmid, metadata['musicbrainz_trmid'])
-
-		#musicip_fingerprint
-		if metadata['musicip_fingerprint'] != None:
-			if track.musicip_fingerprint == None:
-				track.musicip_fingerprint = metadata['musicip_fingerprint']
-			elif track.musicip_fingerprint != metadata['musicip_fingerprint']:
-				# TODO: conflict!
-				self.log.warning(u'Track musicip_fingerprint conflict for track %s: %s != %s', track, track.musicip_fingerprint, metadata['musicip_fingerprint'])
-
-		#musicip_puid
-		if metadata['musicip_puid'] != None:
-			if track.musicip_puid == None:
-				track.musicip_puid = metadata['musicip_puid']
-			elif track.musicip_puid != metadata['musicip_puid']:
-				# TODO: conflict!
-				self.log.warning(u'Track musicip_puid conflict for track %s: %s != %s', track, track.musicip_puid, metadata['musicip_puid'])
-
-		# title
-		if metadata['title'] != None:
-			if track.title == None:
-				track.title = metadata['title']
-			elif track.title != metadata['title']:
-				# TODO: conflict!
-				self.log.warning(u'Track title conflict for track %s: %s != %s', track, track.title, metadata['title'])
-
-		# titlesort
-		if metadata['titlesort'] != None:
-			if track.title_sort == None:
-				track.title_sort = metadata['titlesort']
-			elif track.title_sort != metadata['titlesort']:
-				# TODO: conflict!
-				self.log.warning(u'Track titlesort conflict for track %s: %s != %s', track, track.title_sort, metadata['titlesort'])
-
-		# tracknumber
-		if metadata['tracknumber'] != None:
-			if track.tracknumber == None:
-				track.tracknumber = metadata['tracknumber']
-			elif track.tracknumber != metadata['tracknumber']:
-				# TODO: conflict!
-				self.log.warning(u'Track tracknumber conflict for track %s: %s != %s', track, track.tracknumber, metadata['tracknumber'])
-
-		# version
-		if metadata['version'] != None:
-			if track.subtitle == None:
-				track.subtitle = metadata['version']
-			elif track.subtitle != metadata['version']:
-				# TODO: conflict!
-				self.log.warning(u'Track version conflict for track %s: %s != %s', track, track.subtitle, metadata['version'])
-
-		# website
-		if metadata['website'] != None:
-			if track.website == None:
-				track.website = metadata['website']
-			elif track.website != metadata['website']:
-				# TODO: conflict!
-				self.log.warning(u'Track website conflict for track %s: %s != %s', track, track.website, metadata['website'])
-
-		# get id3 data from the file
-		id3 = MP3(uri)
-
-		metadata = EasygoingDictionary()
-		for key in id3.keys():
-			if type(id3[key]) == list:
-				metadata[key] = id3[key][0]
-			else:
-				metadata[key] = id3[key]
+			disc = context.resolve(('disc', track.album, metadata['discnumber'], metadata['discsubtitle'], metadata['musicbrainz_discid']),
+				self.findDisc, track.album, metadata['discnumber'], metadata['discsubtitle'], metadata['musicbrainz_discid'], uri)
+			merger.mergeRelation(track, 'disc', disc, uri)
 
-		# play count can be stored in either the PCNT or the POPM frames.
-		# choose the largest of the two values as our official playcount.
-		playcount = 0
-		if metadata['PCNT'] != None and metadata['PCNT'].count != None:
-			playcount = int(metadata['PCNT'].count)
+		# album art - the parser has already added it to the art cache, and the first
+		# file of the album that has any art decides it
+		if track.album != None and track.album.art_hash == None and metadata['art_hash'] != None:
+			track.album.art_hash = metadata['art_hash']
 
-		if metadata['POPM'] != None and metadata['POPM'].count != None:
-			if int(metadata['POPM'].count) > playcount:
-				playcount = int(metadata['POPM'].count)
+		# all of the plain columns
+		merger.mergeFields(track, TRACK_FIELDS, metadata, uri)
 
 		# always take the largest playcount
+		playcount = metadata['playcount'] or 0
 		if track.playcount == None or track.playcount < playcount:
 			track.playcount = playcount
 
-		# rating is stored in the POPM frame
 		# only ever set the rating if it is currently None - we never want to overwrite a user's rating
-		if metadata['POPM'] != None and metadata['POPM'].rating != None:
+		if metadata['rating'] != None:
 			if track.rating == None:
-				track.rating = int(metadata['POPM'].rating)
+				track.rating = metadata['rating']
 
 		# if we couldn't determine track, album, artist from metadata, try
 		# to snag it from the path
 		# track name = file name, album title = last directory in path,
 		# artist name = second last directory in path.
-		(dirName, fileName) = os.path.split(uri)
+		# well tagged files never get this far, and the rest of the directory
+		# shares the lookups through its context
 		(fileBaseName, fileExtension) = os.path.splitext(fileName)
 		if track.title == None:
 			track.title = fileBaseName
 			track.title_sort = fileBaseName
 
-		dirs = re.split(os.sep, dirName)
-		if len(dirs) > 0:
-			album = self.findAlbum(dirs[-1])
-			if album != None:
-				if track.album == None:
-					track.album = album
-					self.sa_session.add(album)
+		albumName = os.path.basename(dirName)
+		artistName = os.path.basename(os.path.dirname(dirName))
 
-		if len(dirs) > 1:
-			artist = self.findArtist(dirs[-2])
+		if track.artist == None and artistName:
+			artist = context.resolve(('path artist',), self.findArtist, artistName)
 			if artist != None:
-				if track.artist == None:
-					track.artist = artist
-					track.album_artist = artist
-					self.sa_session.add(artist)
+				track.artist = artist
+				track.album_artist = artist
 
-		self.log.info(u'Added track %s to the current session.', track)
+		if track.album == None and albumName:
+			album = context.resolve(('path album', track.artist), self.findAlbum, albumName, None, None, track.artist)
+			if album != None:
+				track.album = album
 
-		#commit the transaction
-		self.sa_session.commit()
+		# its album and artist summaries and search index rows are refreshed along with the batch
+		self.summaries.touch(track)
+		self.indexer.touch(track)
 
-	def findArtist(self, name=None, name_sort=None, musicbrainz_id=None):
-		"""Searches the database for an existing artist that matches the specified criteria.
-		If no existing artist can be found, a new artist is created with the criteria.
+		self.log.debug(u'Added track %s to the current session.', track)
+
+	def resolveArtist(self, context, name=None, name_sort=None, musicbrainz_id=None, uri=None):
+		"""Finds an artist through the specified directory context"""
+		if name == None and musicbrainz_id == None:
+			return None
+		return context.resolve(('artist', name, name_sort, musicbrainz_id), self.findArtist, name, name_sort, musicbrainz_id, uri)
+
+	def findArtist(self, name=None, name_sort=None, musicbrainz_id=None, uri=None):
+		"""Searches the cache, then the database for an existing artist that matches the
+		specified criteria. If no existing artist can be found, a new artist is created
+		with the criteria.
 		When a new artist is created, it is not added to the database. This is the responsibility
 		of the calling function.
 		"""
+		name = normalizeName(name)
+
 		artist = None
 		if musicbrainz_id != None:
 			# we trust musicbrainz_artistid the most because it infers that
 			# some other tagger has already verified the metadata.
-			artist = self.sa_session.query(Artist).filter(Artist.musicbrainz_artistid == musicbrainz_id).first()
+			artist = self.cache.getArtist(musicbrainz_id=musicbrainz_id)
+			if artist == None:
+				artist = self.sa_session.query(Artist).filter(Artist.musicbrainz_artistid == musicbrainz_id).first()
 			if artist != None:
 				# found an existing artist in our db - compare its metadata
 				# to the new info. Always prefer existing metadata over new.
-				self.log.debug(u'Artist name musicbrainz_artistid search found existing artist %s in database' % artist)
-				if name != None:
-					if artist.name == None:
-						artist.name = name
-					elif artist.name != name:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Artist name conflict for musicbrainz_artistid %s: %s != %s', artist.musicbrainz_artistid, artist.name, name)
-				if name_sort != None:
-					if artist.name_sort == None:
-						artist.name_sort = name_sort
-					elif artist.name_sort != name_sort:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Artist sort name conflict for musicbrainz_artistid %s: %s != %s', artist.musicbrainz_artistid, artist.name_sort, name_sort)
+				# TODO: conflict -> schedule musicbrainz task!
+				self.merger.merge(artist, 'name', name, uri)
+				self.merger.merge(artist, 'name_sort', name_sort, uri)
 
 		if artist == None and name != None:
 			# if we don't have musicbrainz_artistid or there is no matching
 			# artist in our db, try to find an existing artist by name
-			artist = self.sa_session.query(Artist).filter(Artist.name == name).first()
+			artist = self.cache.getArtist(name=name)
+			if artist == None:
+				artist = self.sa_session.query(Artist).filter(Artist.name == name).first()
 			if artist != None:
-				self.log.debug(u'Artist name search found existing artist %s in database' % artist)
 				# found an existing artist in our db - compare its metadata
 				# to the new info. Always prefer existing metadata over new.
-				if name_sort != None:
-					if artist.name_sort == None:
-						artist.name_sort = name_sort
-					elif artist.name_sort != name_sort:
-						self.log.warning(u'Artist sort name conflict for artist %s: %s != %s', artist.name, artist.name_sort, name_sort)
+				self.merger.merge(artist, 'name_sort', name_sort, uri)
 			else:
 				# an existing artist could not be found in our db. Make a new one
 				artist = Artist(name)
@@ -519,60 +767,55 @@ class ImportThread(threading.Thread):
 					artist.name_sort = name_sort
 				if musicbrainz_id != None:
 					artist.musicbrainz_artistid = musicbrainz_id
-				# add the artist object to the DB
 				self.log.debug(u'Artist not found in database. Created new artist %s' % artist)
 
+		# remember the artist that we found and/or created under all of its keys
+		if artist != None:
+			self.cache.putArtist(artist)
+
 		# return the artist that we found and/or created
 		return artist
 
 	# TODO: Need support for album artist?
-	def findAlbum(self, title=None, title_sort=None, musicbrainz_id=None, artist=None, metadata=None):
-		"""Searches the database for an existing album that matches the specified criteria.
-		If no existing album can be found, a new album is created with the criteria.
+	def findAlbum(self, title=None, title_sort=None, musicbrainz_id=None, artist=None, metadata=None, uri=None):
+		"""Searches the cache, then the database for an existing album that matches the
+		specified criteria. If no existing album can be found, a new album is created
+		with the criteria.
 		When a new album is created, it is not added to the database. This is the responsibility of
 		the calling function.
 		"""
+		title = normalizeName(title)
+
 		album = None
 		if musicbrainz_id != None:
 			# we trust musicbrainz_albumid the most because it infers that
 			# some other tagger has already verified the metadata.
-			album = self.sa_session.query(Album).filter(Album.musicbrainz_albumid == musicbrainz_id).first()
+			album = self.cache.getAlbum(musicbrainz_id=musicbrainz_id)
+			if album == None:
+				album = self.sa_session.query(Album).filter(Album.musicbrainz_albumid == musicbrainz_id).first()
 			if album != None:
 				# found an existing album in our db - compare its metadata
 				# to the new info. Always prefer existing metadata over new.
-				self.log.debug(u'Album musicbrainz_albumid search found existing album %s in database' % album)
-				if title != None:
-					if album.title == None:
-						album.title = title
-					elif album.title != title:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Album title conflict for musicbrainz_albumid %s: %s != %s', album.musicbrainz_albumid, album.title, title)
-				if title_sort != None:
-					if album.title_sort == None:
-						album.title_sort = title_sort
-					elif album.title_sort != title_sort:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Album sort title conflict for musicbrainz_albumid %s: %s != %s', album.musicbrainz_albumid, album.title_sort, title_sort)
-				if artist != None:
-					if album.artist == None:
-						album.artist = artist
-					elif album.artist_id != artist.id:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Album artist conflict for musicbrainz_albumid %s: %s != %s', album.musicbrainz_albumid, album.artist, artist)
+				# TODO: conflict -> schedule musicbrainz task!
+				self.merger.merge(album, 'title', title, uri)
+				self.merger.merge(album, 'title_sort', title_sort, uri)
+				self.merger.mergeRelation(album, 'artist', artist, uri)
 
 		if album == None and title != None and artist != None:
 			# if we don't have musicbrainz_albumid or there is no matching
-			# album in our db, try to find an existing album by title and artist
-			album = self.sa_session.query(Album).filter(Album.title == title, Album.artist_id == artist.id).first()
+			# album in our db, try to find an existing album by title and artist.
+			# the artist needs an id for that, so make sure that new artists are flushed
+			if artist.id == None:
+				self.sa_session.add(artist)
+				self.sa_session.flush()
+
+			album = self.cache.getAlbum(title=title, artist=artist)
+			if album == None:
+				album = self.sa_session.query(Album).filter(Album.title == title, Album.artist_id == artist.id).first()
 			if album != None:
 				# found an existing album in our db - compare its metadata
 				# to the new info. Always prefer existing metadata over new.
-				self.log.debug(u'Album title/artist search found existing album %s in database' % album)
-				if title_sort != None:
-					if album.title_sort == None:
-						album.title_sort = title_sort
-					elif album.title_sort != title_sort:
-						self.log.warning(u'Album sort title conflict for album %s: %s != %s', album.title, album.title_sort, title_sort)
+				self.merger.merge(album, 'title_sort', title_sort, uri)
 			else:
 				# an existing album could not be found in our db. Make a new one
 				album = Album(title)
@@ -580,161 +823,222 @@ class ImportThread(threading.Thread):
 					album.title_sort = title_sort
 				if musicbrainz_id != None:
 					album.musicbrainz_albumid = musicbrainz_id
-				if artist != None:
-					album.artist = artist
+				album.artist = artist
 				self.log.debug(u'Album not found in database. Created new album %s' % album)
 
 		# we either found or created the album. now verify its metadata
+		# TODO: conflict -> schedule musicbrainz task!
 		if album != None and metadata != None:
-			if metadata['asin'] != None:
-				if album.asin == None:
-					album.asin = metadata['asin']
-				elif album.asin != metadata['asin']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album ASIN conflict for album %s: %s != %s', album, album.asin, metadata['asin'])
-			if metadata['barcode'] != None:
-				if album.barcode == None:
-					album.barcode = metadata['barcode']
-				elif album.barcode != metadata['barcode']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album barcode conflict for album %s: %s != %s', album, album.barcode, metadata['barcode'])
-			if metadata['compilation'] != None:
-				if album.compilation == None:
-					album.compilation = metadata['compilation']
-				elif album.compilation != metadata['compilation']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album compilation conflict for album %s: %s != %s', album, album.compilation, metadata['compilation'])
-			if metadata['media'] != None:
-				if album.media_type == None:
-					album.media_type = metadata['media']
-				if album.media_type != metadata['media']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album media type conflict for album %s: %s != %s', album, album.media_type, metadata['media'])
-			if metadata['musicbrainz_albumstatus'] != None:
-				if album.musicbrainz_albumstatus == None:
-					album.musicbrainz_albumstatus = metadata['musicbrainz_albumstatus']
-				elif album.musicbrainz_albumstatus != metadata['musicbrainz_albumstatus']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album musicbrainz_albumstatus conflict for album %s: %s != %s', album, album.musicbrainz_albumstatus, metadata['musicbrainz_albumstatus'])
-			if metadata['musicbrainz_albumtype'] != None:
-				if album.musicbrainz_albumtype == None:
-					album.musicbrainz_albumtype = metadata['musicbrainz_albumtype']
-				elif album.musicbrainz_albumtype != metadata['musicbrainz_albumtype']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album musicbrainz_albumtype conflict for album %s: %s != %s', album, album.musicbrainz_albumtype, metadata['musicbrainz_albumtype'])
-			if metadata['organization'] != None:
-				if album.organization == None:
-					album.organization = metadata['organization']
-				elif album.organization != metadata['organization']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album organization conflict for album %s: %s != %s', album, album.organization, metadata['organization'])
-			if metadata['releasecountry'] != None:
-				if album.releasecountry == None:
-					album.releasecountry = metadata['releasecountry']
-				elif album.releasecountry != metadata['releasecountry']:
-					# TODO: conflict -> schedule musicbrainz task!
-					self.log.warning(u'Album release country conflict for album %s: %s != %s', album, album.releasecountry, metadata['releasecountry'])
+			self.merger.mergeFields(album, ALBUM_FIELDS, metadata, uri)
+
+		# remember the album that we found and/or created under all of its keys
+		if album != None:
+			self.cache.putAlbum(album, artist)
 
 		return album
 
-	def findDisc(self, album=None, discnumber=None, discsubtitle=None, musicbrainz_id=None):
+	def findDisc(self, album=None, discnumber=None, discsubtitle=None, musicbrainz_id=None, uri=None):
 		"""Tries to find an existing disc that matches the specified criteria.
 		If an existing disc cannot be found, creates a new disc with the specified criteria.
 		"""
-		# first see if there's a disc that's already linked to the album that
-		# has either the specified musicbrainz_discid or discnumber.
+		# the album needs an id to look up its discs, so make sure that new albums are flushed
+		if album != None and album.id == None:
+			self.sa_session.add(album)
+			self.sa_session.flush()
+
 		disc = None
-		if album != None:
-			for d in album.discs:
-				if musicbrainz_id != None:
-					if d.musicbrainz_id == musicbrainz_id:
-						disc = d
-				if discnumber != None:
-					if d.discnumber == discnumber:
-						disc = d
-
-		# if we found a disc in the existing album's collection that matches
-		# the specified criteria, update any missing metadata
-		if disc != None:
-			self.log.debug(u'Disc musicbrainz_discid/discnumber search found existing disc %s in database' % disc)
-			if discnumber != None:
-				if d.discnumber == None:
-					d.discnumber = discnumber
-				elif d.discnumber != discnumber:
-					# TODO: conflict!
-					self.log.warning(u'Disc number conflict for disc %s: %s != %s', disc, disc.discnumber, discnumber)
-			if discsubtitle != None:
-				if d.subtitle == None:
-					d.subtitle = discsubtitle
-				elif d.subtitle != discsubtitle:
-					# TODO: Conflict!
-					self.log.warning(u'Disc subtitle conflict for disc %s: %s != %s', disc, disc.subtitle, discsubtitle)
-			if musicbrainz_id != None:
-				if d.musicbrainz_discid == None:
-					d.musicbrainz_discid = musicbrainz_id
-				elif d.musicbrainz_discid != musicbrainz_id:
-					# TODO: conflict!
-					self.log.warning(u'Disc musicbrainz_discid conflict for disc %s: %s != %s', disc, disc.musicbrainz_discid, musicbrainz_id)
-
-		if disc == None and musicbrainz_id != None:
-			# search for an existing unlinked disc in the database.
+		if musicbrainz_id != None:
+			# search for an existing disc in the database.
 			# we trust musicbrainz_discid the most because it infers that
 			# some other tagger has already verified the metadata.
-			disc = self.sa_session.query(Disc).filter(Disc.musicbrainz_discid == musicbrainz_id).first()
+			disc = self.cache.getDisc(musicbrainz_id=musicbrainz_id)
+			if disc == None:
+				disc = self.sa_session.query(Disc).filter(Disc.musicbrainz_discid == musicbrainz_id).first()
 			if disc != None:
-				self.log.debug(u'Disc musicbrainz_discid search found existing disc %s in database' % disc)
-				if album != None:
-					if disc.album == None:
-						disc.album = album
-					elif disc.album.id != album.id:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Disc album conflict for disc %s: %s != %s', disc, disc.album, album)
-				if discnumber != None:
-					if disc.discnumber == None:
-						disc.discnumber = discnumber
-					elif disc.discnumber != discnumber:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Disc number conflict for disc %s: %s != %s', disc, disc.discnumber, discnumber)
-				if discsubtitle != None:
-					if disc.discsubtitle == None:
-						disc.discsubtitle = discsubtitle
-					elif disc.discsubtitle != discsubtitle:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Disc subtitle conflict for disc %s: %s != %s', disc, disc.discsubtitle, discsubtitle)
+				# TODO: conflict -> schedule musicbrainz task!
+				self.merger.mergeRelation(disc, 'album', album, uri)
+				self.merger.merge(disc, 'discnumber', discnumber, uri)
+				self.merger.merge(disc, 'disc_subtitle', discsubtitle, uri)
 
 		if disc == None and album != None and discnumber != None:
 			# musicbrainz_discid wasn't supplied or didn't yield an existing album.
 			# try to search with album id and disc number instead.
-			disc = self.sa_session.query(Disc).filter(Disc.album_id == album.id, Disc.discnumber == discnumber).first()
+			disc = self.cache.getDisc(album=album, discnumber=discnumber)
+			if disc == None:
+				disc = self.sa_session.query(Disc).filter(Disc.album_id == album.id, Disc.discnumber == discnumber).first()
 			if disc != None:
-				self.log.debug(u'Disc album/number search found existing disc %s in database' % disc)
-				if discsubtitle != None:
-					if disc.discsubtitle == None:
-						disc.discsubtitle = discsubtitle
-					elif disc.discsubtitle != discsubtitle:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Disc subtitle conflict for disc %s: %s != %s', disc, disc.discsubtitle, discsubtitle)
-				if musicbrainz_id != None:
-					if disc.musicbrainz_discid == None:
-						disc.musicbrainz_discid = musicbrainz_id
-					elif disc.musicbrainz_discid != musicbrainz_id:
-						# TODO: conflict -> schedule musicbrainz task!
-						self.log.warning(u'Disc musicbrainz_discid conflict for disc %s: %s != %s', disc, disc.musicbrainz_discid, musicbrainz_id)
+				# TODO: conflict -> schedule musicbrainz task!
+				self.merger.merge(disc, 'disc_subtitle', discsubtitle, uri)
+				self.merger.merge(disc, 'musicbrainz_discid', musicbrainz_id, uri)
 			else:
 				# could not find the disc in question. Create a new one instead
 				disc = Disc(discnumber)
-				if album != None:
-					disc.album = album
+				disc.album = album
 				if discsubtitle != None:
-					disc.discsubtitle = discsubtitle
+					disc.disc_subtitle = discsubtitle
 				if musicbrainz_id != None:
 					disc.musicbrainz_discid = musicbrainz_id
 				self.log.debug(u'Could not find disc in database. Created new disc %s' % disc)
 				self.sa_session.add(disc)
 
+		# remember the disc that we found and/or created under all of its keys
+		if disc != None:
+			self.cache.putDisc(disc, album)
+
 		return disc
 
 	def stop(self):
 		"""Cleans up the thread"""
 		self.log.info(u'%s.stop has been called', self.getName())
 		self.running = False
+
+		# wake the thread up if it is waiting for work so that it can exit
+		importQueue.notify()
+
+
+class ImportPool(threading.Thread):
+	"""Supervises a configurable number of ImportThread workers.
+	Each worker claims tasks from the import queue on its own, so the pool
+	itself only has to keep the workers alive. When a worker dies, any task it
+	had claimed but not completed is handed back to the queue and a
+	replacement worker is started.
+	Parsing files is CPU-bound, so it is farmed out to a pool of parser
+	processes that is shared by all workers. The workers themselves only
+	write to the database, which is why a single worker is usually enough.
+	"""
+
+	running = True		 # whether or not the pool should continue to run
+	size = 1			 # number of import workers to keep alive
+	workers = None		 # list of ImportThread instances
+	parser = None		 # pool of processes that parse files for the workers
+	sa_session = None	 # database session
+	log = None			 # logging instance
+
+	check_interval = 5	 # seconds between worker health checks
+	reclaimed = 0		 # when expired leases were last reclaimed
+
+	def __init__(self, size=None, processes=None):
+		"""Creates the pool, its workers and the parser processes.
+		The number of workers defaults to the MUSIK_IMPORT_WORKERS environment
+		variable and the number of parser processes to MUSIK_IMPORT_PROCESSES,
+		or one per cpu if that isn't set. Tasks orphaned by a previous run of
+		the application are reclaimed before any worker is created.
+		This must be called before any other threads are started, because the
+		parser processes are forked from the calling process.
+		"""
+		super(ImportPool, self).__init__(name=__name__ + u'.pool')
+		self.log = initLogging(__name__)
+		self.size = size if size != None else getSetting('MUSIK_IMPORT_WORKERS', 1)
+		self.stopped = threading.Event()
+
+		if processes == None:
+			processes = getSetting('MUSIK_IMPORT_PROCESSES', multiprocessing.cpu_count())
+		self.parser = createParserPool(processes, importThrottle.niceness, importThrottle.idle_io)
+
+		db = DatabaseWrapper()
+		self.sa_session = db.get_session()
+
+		# nothing is running yet, so every claimed but unfinished task is an orphan,
+		# no matter what its lease says
+		self.reclaimTasks()
+
+		# this is the only time the pending tasks are counted. From here on,
+		# the queue and the workers keep the statistics up to date as they go
+		importStats.reset(self.sa_session.query(ImportTask).filter(ImportTask.started == None, ImportTask.quarantined == None).count())
+
+		self.workers = []
+		for index in range(max(self.size, 1)):
+			self.workers.append(self.createWorker(index))
+
+	def createWorker(self, index):
+		"""Creates a new, unstarted worker with a stable name for the specified slot"""
+		return ImportThread(name=u'%s-%d' % (__name__, index + 1), parser=self.parser)
+
+	def run(self):
+		"""Starts the workers and replaces any that die until the pool is stopped"""
+		self.log.info(u'Starting %d import workers', len(self.workers))
+		for worker in self.workers:
+			worker.start()
+
+		try:
+			while self.running:
+				self.stopped.wait(self.check_interval)
+				if not self.running:
+					break
+
+				for index, worker in enumerate(self.workers):
+					if worker.is_alive():
+						continue
+
+					self.log.error(u'Import worker %s died unexpectedly. Restarting it.', worker.getName())
+					importStats.released(worker.getName())
+					self.workers[index] = self.createWorker(index)
+					self.workers[index].start()
+					try:
+						self.reclaimTasks([worker.getName()])
+					except OperationalError as oe:
+						# the lease of its tasks runs out eventually, and then they are reclaimed below
+						self.log.warning(u'Could not reclaim the tasks of %s: %s', worker.getName(), unicode(oe))
+						self.sa_session.rollback()
+
+				# catch workers that are alive but stuck
+				if time.time() - self.reclaimed > importQueue.lease / 2:
+					try:
+						self.reclaimTasks(expired=True)
+					except OperationalError as oe:
+						# try again on the next check
+						self.log.warning(u'Could not reclaim expired import tasks: %s', unicode(oe))
+						self.sa_session.rollback()
+		finally:
+			for worker in self.workers:
+				if worker.is_alive():
+					worker.stop()
+			for worker in self.workers:
+				if worker.is_alive():
+					worker.join(5)
+
+			if self.parser != None:
+				self.parser.terminate()
+				self.parser.join()
+				self.parser = None
+
+			if self.sa_session != None:
+				self.sa_session.close()
+				self.sa_session = None
+
+	def reclaimTasks(self, workers=None, expired=False):
+		"""Returns claimed but unfinished tasks to the queue so that another worker
+		can pick them up. If a list of worker names is specified, only tasks claimed
+		by those workers are reclaimed. If expired is True, only tasks whose lease
+		has expired are reclaimed. Otherwise all unfinished tasks are.
+		Tasks that have used up all of their attempts are quarantined instead, so
+		that a file that keeps crashing the importer can't block the queue.
+		"""
+		now = datetime.utcnow()
+		q = self.sa_session.query(ImportTask).filter(ImportTask.started != None, ImportTask.completed == None, ImportTask.quarantined == None)
+		if workers != None:
+			q = q.filter(ImportTask.worker.in_(workers))
+		if expired:
+			q = q.filter(or_(ImportTask.lease_expires == None, ImportTask.lease_expires < now))
+
+		quarantined = q.filter(ImportTask.attempts >= importQueue.max_attempts).update({'quarantined': now}, synchronize_session=False)
+		reclaimed = q.filter(ImportTask.quarantined == None).update({'started': None, 'worker': None, 'lease_expires': None}, synchronize_session=False)
+		self.sa_session.commit()
+		self.reclaimed = time.time()
+
+		if quarantined > 0:
+			self.log.error(u'Quarantined %d import tasks that failed %d times', quarantined, importQueue.max_attempts)
+		if reclaimed > 0:
+			self.log.info(u'Returned %d unfinished import tasks to the queue', reclaimed)
+			importStats.queued(reclaimed)
+			# idle workers only look at the queue when they are woken up
+			importQueue.notify()
+		return reclaimed
+
+	def stop(self):
+		"""Stops the pool and all of its workers"""
+		self.log.info(u'%s.stop has been called', self.getName())
+		self.running = False
+		self.stopped.set()
+		for worker in self.workers:
+			worker.stop()
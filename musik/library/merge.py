@@ -0,0 +1,123 @@
+from datetime import datetime
+
+from musik.db import MetadataConflict
+
+
+# Maps track columns to the metadata keys that they are read from
+TRACK_FIELDS = (
+	('bpm', 'bpm'),
+	('bitrate', 'bitrate'),
+	('copyright', 'copyright'),
+	('date', 'date'),
+	('encodedby', 'encodedby'),
+	('genre', 'genre'),
+	('isrc', 'isrc'),
+	('length', 'length'),
+	('mood', 'mood'),
+	('musicbrainz_trackid', 'musicbrainz_trackid'),
+	('musicbrainz_trmid', 'musicbrainz_trmid'),
+	('musicip_fingerprint', 'musicip_fingerprint'),
+	('musicip_puid', 'musicip_puid'),
+	('title', 'title'),
+	('title_sort', 'titlesort'),
+	('tracknumber', 'tracknumber'),
+	('subtitle', 'version'),
+	('website', 'website'),
+)
+
+# Maps track artist relationships to the metadata keys of the artist's name and sort name
+TRACK_ARTISTS = (
+	('arranger', 'arranger', None),
+	('author', 'author', None),
+	('composer', 'composer', 'composersort'),
+	('conductor', 'conductor', None),
+	('lyricist', 'lyricist', None),
+	('performer', 'performer', None),
+)
+
+# Maps album columns to the metadata keys that they are read from
+ALBUM_FIELDS = (
+	('asin', 'asin'),
+	('barcode', 'barcode'),
+	('compilation', 'compilation'),
+	('media_type', 'media'),
+	('musicbrainz_albumstatus', 'musicbrainz_albumstatus'),
+	('musicbrainz_albumtype', 'musicbrainz_albumtype'),
+	('organization', 'organization'),
+	('releasecountry', 'releasecountry'),
+)
+
+
+class MetadataMerger(object):
+	"""Merges incoming metadata into library entities.
+	Existing metadata always wins: a field is only written if it is currently
+	empty, so unchanged entities never produce an UPDATE. When a field already
+	holds a different value, the disagreement is recorded as a conflict instead.
+	Conflicts are kept in memory and written to the metadata_conflicts table in
+	bulk by save().
+	"""
+
+	def __init__(self):
+		self.conflicts = []
+
+	def mergeFields(self, entity, fields, metadata, uri=None):
+		"""Merges the metadata into the entity according to a table of (column, key) pairs"""
+		for (column, key) in fields:
+			self.merge(entity, column, metadata[key], uri)
+
+	def merge(self, entity, column, incoming, uri=None):
+		"""Merges a single incoming value into a column of the entity"""
+		if incoming == None:
+			return
+
+		current = getattr(entity, column)
+		if current == None:
+			setattr(entity, column, incoming)
+		elif current != incoming:
+			self.conflicts.append((entity, column, current, incoming, uri))
+
+	def mergeRelation(self, entity, relation, incoming, uri=None):
+		"""Merges a related entity (e.g. a track's artist) into the entity.
+		Related entities are compared by identity rather than by value.
+		"""
+		if incoming == None:
+			return
+
+		current = getattr(entity, relation)
+		if current == None:
+			setattr(entity, relation, incoming)
+		elif current is not incoming and (current.id == None or current.id != incoming.id):
+			self.conflicts.append((entity, relation, current, incoming, uri))
+
+	def save(self, session):
+		"""Writes all pending conflicts to the database in a single statement.
+		A conflict replaces any earlier conflict for the same entity and field,
+		so importing the same files again doesn't pile up duplicates.
+		The session is flushed first so that every entity has an id, but it is
+		not committed. Returns the number of conflicts that were written.
+		"""
+		if len(self.conflicts) == 0:
+			return 0
+
+		session.flush()
+
+		now = datetime.utcnow()
+		rows = []
+		for (entity, field, current, incoming, uri) in self.conflicts:
+			rows.append({
+				'entity': entity.__tablename__,
+				'entity_id': entity.id,
+				'field': field,
+				'current_value': unicode(current),
+				'incoming_value': unicode(incoming),
+				'uri': uri,
+				'created': now,
+			})
+
+		session.execute(MetadataConflict.__table__.insert().prefix_with('OR REPLACE'), rows)
+		self.conflicts = []
+		return len(rows)
+
+	def clear(self):
+		"""Forgets all pending conflicts, e.g. after a rollback"""
+		self.conflicts = []
@@ -0,0 +1,142 @@
+import multiprocessing
+import os
+import signal
+import threading
+
+from musik.library.artwork import artCache, THUMBNAIL_SIZES
+from musik.library.hashing import audioHash
+from musik.library.tags import readTags, TagReadError
+from musik.library.throttle import lowerPriority
+
+
+def initParserProcess(niceness=0, idle_io=False):
+	"""Runs once in every parser process.
+	The processes are forked from the main application, so they inherit its
+	signal handlers. Shutdown is managed by the parent process, so they ignore
+	interrupts and go back to the default behaviour for termination.
+	Parsing should never compete with playback, so the processes also lower
+	their cpu and io priority.
+	"""
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	signal.signal(signal.SIGHUP, signal.SIG_DFL)
+	signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+	lowerPriority(niceness, idle_io)
+
+
+# the album art that was found last, as ((directory, album), hash). The files of an
+# album arrive one after the other, so this saves reading its cover image for each of them
+lastArt = (None, None)
+
+
+def readArt(uri, record):
+	"""Adds the album art of the specified file to the art cache, from the image
+	files in its directory or the picture embedded in it. Returns its hash, or
+	None if the file doesn't have any art.
+	"""
+	global lastArt
+	key = (os.path.dirname(uri), record['album'])
+	(last, art_hash) = lastArt
+	if key == last and (art_hash == None or artCache.path(art_hash, THUMBNAIL_SIZES[0]) != None):
+		return art_hash
+
+	try:
+		art_hash = artCache.extract(uri, record['picture'])
+	except (IOError, OSError):
+		# the importer looks for it again with the next file of the album
+		return None
+	lastArt = (key, art_hash)
+	return art_hash
+
+
+def readMetadata(uri):
+	"""Reads the tags and stream info of the specified file, along with the hash
+	of its audio payload. The album art is added to the art cache, and only its
+	hash is returned in art_hash. Raises TagReadError if the file cannot be read.
+	"""
+	record = readTags(uri)
+	try:
+		record['audio_hash'] = audioHash(uri)
+	except IOError as ioe:
+		raise TagReadError(u'Could not hash %s: %s' % (uri, unicode(ioe)))
+	record['art_hash'] = readArt(uri, record)
+	# the picture itself doesn't need to go back to the importer
+	record.pop('picture', None)
+	return record
+
+
+def parseFile(uri):
+	"""Reads the metadata of the specified file.
+	Runs in a parser process, so both the argument and the return value have
+	to be picklable, and exceptions must not escape.
+	Returns a (uri, record, error) tuple, where exactly one of record and error is None.
+	"""
+	try:
+		return (uri, readMetadata(uri), None)
+	except TagReadError as tre:
+		return (uri, None, unicode(tre))
+	except Exception as e:
+		return (uri, None, u'Unexpected error reading %s: %s' % (uri, unicode(e)))
+
+
+def parseChunk(uris):
+	"""Parses a chunk of files with parseFile. Handing the files to the parser
+	processes in chunks saves a round trip for every file.
+	"""
+	return [parseFile(uri) for uri in uris]
+
+
+class ParserPool(object):
+	"""The pool of processes that parse files with parseFile, shared by the import
+	workers. A parser process that hangs or dies takes the files that it was
+	working on with it, and their results never arrive. A worker that gives up
+	waiting for them restarts the pool, which gets rid of the hung processes.
+	"""
+
+	def __init__(self, size, niceness=0, idle_io=False):
+		self.size = size
+		self.niceness = niceness
+		self.idle_io = idle_io
+		self.lock = threading.Lock()
+		self.generation = 0		 # incremented every time the processes are replaced
+		self.pool = multiprocessing.Pool(size, initParserProcess, (niceness, idle_io))
+
+	def imap_unordered(self, func, iterable, chunksize=1):
+		"""Returns the generation of the pool and an iterator over the results of func
+		for every item of iterable, in the order that they come in. Pass the
+		generation to restart() if the results stop coming in.
+		"""
+		with self.lock:
+			return (self.generation, self.pool.imap_unordered(func, iterable, chunksize))
+
+	def restart(self, generation):
+		"""Replaces the processes of the pool, unless somebody else has already
+		replaced them since the specified generation.
+		"""
+		with self.lock:
+			if generation != self.generation:
+				return
+			self.pool.terminate()
+			self.pool.join()
+			self.pool = multiprocessing.Pool(self.size, initParserProcess, (self.niceness, self.idle_io))
+			self.generation += 1
+
+	def terminate(self):
+		with self.lock:
+			self.pool.terminate()
+
+	def join(self):
+		self.pool.join()
+
+
+def createParserPool(size=None, niceness=0, idle_io=False):
+	"""Creates a ParserPool of processes that parse files with parseFile.
+	The pool defaults to one process per cpu. Returns None if size is 0, in
+	which case files should be parsed in the calling thread.
+	Must be called before any other threads are started.
+	"""
+	if size == None:
+		size = multiprocessing.cpu_count()
+	if size <= 0:
+		return None
+	return ParserPool(size, niceness, idle_io)
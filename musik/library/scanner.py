@@ -0,0 +1,95 @@
+import mimetypes
+import os
+import stat
+
+# scandir reports the type of each directory entry straight from the directory
+# listing, which saves a stat call per entry. It is part of the standard library
+# from Python 3.5 on and available from PyPI as 'scandir' before that.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+class StatEntry(object):
+	"""A minimal stand-in for scandir's DirEntry, used when scandir is unavailable.
+	Each entry costs exactly one stat call, which is cached for later use.
+	"""
+
+	def __init__(self, directory, name):
+		self.name = name
+		self.path = os.path.join(directory, name)
+		self._stat = None
+
+	def stat(self):
+		if self._stat == None:
+			self._stat = os.stat(self.path)
+		return self._stat
+
+	def is_dir(self):
+		try:
+			return stat.S_ISDIR(self.stat().st_mode)
+		except OSError:
+			return False
+
+	def is_file(self):
+		try:
+			return stat.S_ISREG(self.stat().st_mode)
+		except OSError:
+			return False
+
+
+# mime types of the files that the importer knows how to handle
+SUPPORTED_MIME_TYPES = (u'audio/mpeg', u'audio/flac', u'audio/ogg', u'audio/x-wav')
+
+
+def isMimeTypeSupported(uri):
+	"""Returns True if the mime type of the specified uri is supported.
+	This should only support audio files.
+	"""
+	return mimetypes.guess_type(uri)[0] in SUPPORTED_MIME_TYPES
+
+
+def fingerprint(st):
+	"""Returns a cheap fingerprint of a file from the result of a stat call.
+	If the size, modification time, inode and device of a file are all unchanged,
+	its contents are assumed to be unchanged as well.
+	"""
+	return (st.st_size, float(st.st_mtime), st.st_ino, st.st_dev)
+
+
+def listDirectory(uri):
+	"""Returns an iterator over the entries of the specified directory"""
+	if scandir != None:
+		return scandir(uri)
+	return (StatEntry(uri, name) for name in os.listdir(uri))
+
+
+def walkFiles(uri, counter=None):
+	"""Yields the entry of every regular file below the specified directory.
+	The walk is depth-first and lazy: directory listings are consumed as they
+	are read and only the paths of directories that are still to be visited
+	are held in memory, so very wide or very deep trees do not blow up memory.
+	If a counter list is passed, its first element is incremented for every
+	directory entry that is examined.
+	"""
+	pending = [uri]
+	while len(pending) > 0:
+		baseuri = pending.pop()
+		try:
+			entries = listDirectory(baseuri)
+		except OSError:
+			# TODO: directory permissions. Report unreadable directories to the user
+			continue
+
+		for entry in entries:
+			if counter != None:
+				counter[0] += 1
+
+			if entry.is_dir():
+				pending.append(entry.path)
+			elif entry.is_file():
+				yield entry
@@ -0,0 +1,200 @@
+import re
+import struct
+
+from sqlalchemy.sql import column, literal_column, select, table
+
+from musik.util import chunks
+
+# The search index is an FTS4 table with one row per track, album and artist.
+# Its docid encodes both the kind and the id of the row, so rows can be replaced
+# and removed without a lookup: docid = id * KINDS + kind
+KIND_TRACK = 0
+KIND_ALBUM = 1
+KIND_ARTIST = 2
+KINDS = 4
+KIND_NAMES = {KIND_TRACK: u'track', KIND_ALBUM: u'album', KIND_ARTIST: u'artist'}
+
+# the indexed columns, and how much a match in each of them counts towards the relevance of a row
+COLUMNS = ('title', 'artist', 'album', 'genre')
+WEIGHTS = (4.0, 2.0, 2.0, 1.0)
+
+# the relations of a track that point at artists
+ARTIST_RELATIONS = ('artist', 'album_artist', 'arranger', 'author', 'composer', 'conductor', 'lyricist', 'performer')
+
+search_index = table('search_index', column('docid'), *[column(name) for name in COLUMNS])
+
+# the statements that copy the library into the index. They are restricted to
+# some ids by appending a WHERE clause. The docids are spelled out with KINDS = 4.
+INDEX_TRACKS = """INSERT INTO search_index (docid, title, artist, album, genre)
+	SELECT tracks.id * 4, tracks.title, artists.name, albums.title, tracks.genre
+	FROM tracks
+	LEFT OUTER JOIN artists ON artists.id = tracks.artist_id
+	LEFT OUTER JOIN albums ON albums.id = tracks.album_id"""
+INDEX_ALBUMS = """INSERT INTO search_index (docid, title, artist, album, genre)
+	SELECT albums.id * 4 + 1, albums.title, albums.artist_name, NULL, NULL
+	FROM albums"""
+INDEX_ARTISTS = """INSERT INTO search_index (docid, title, artist, album, genre)
+	SELECT artists.id * 4 + 2, NULL, artists.name, NULL, NULL
+	FROM artists"""
+
+
+def rank(matchinfo, *weights):
+	"""SQLite function that scores a row of the search index against a query.
+	Takes the result of matchinfo(search_index, 'pcx') and the weight of each
+	column. Every phrase that matches a column counts as often as it occurs in
+	the row, weighted by the column and by how rare the phrase is in the index,
+	so a title that contains an unusual word outranks one that contains a common one.
+	"""
+	info = str(matchinfo)
+	values = struct.unpack('@%dI' % (len(info) / 4), info)
+	(phrases, columns) = values[:2]
+
+	score = 0.0
+	for phrase in range(phrases):
+		for col in range(min(columns, len(weights))):
+			(row_hits, total_hits, documents) = values[2 + 3 * (phrase * columns + col):5 + 3 * (phrase * columns + col)]
+			if row_hits > 0:
+				score += weights[col] * row_hits / float(total_hits)
+	return score
+
+
+def matchQuery(value, columns=None):
+	"""Turns search terms into an FTS query that matches every word of the terms
+	as a prefix, optionally only in the specified columns. Returns None if the
+	terms don't contain any words.
+	"""
+	# only words make it into the query, so the FTS syntax can't be injected,
+	# and lowercase words are never taken for the AND, OR and NOT operators
+	words = re.findall(r'\w+', value, re.UNICODE)
+	if len(words) == 0:
+		return None
+
+	terms = []
+	for word in words:
+		word = word.lower()
+		if columns == None:
+			terms.append(u'%s*' % word)
+		elif len(columns) == 1:
+			terms.append(u'%s:%s*' % (columns[0], word))
+		else:
+			terms.append(u'(%s)' % u' OR '.join(u'%s:%s*' % (name, word) for name in columns))
+	return u' '.join(terms)
+
+
+def matchingIds(kind, value, columns=None):
+	"""Returns a select of the ids of the rows of the specified kind that match
+	the search terms, for use with in_(). Returns None if the terms don't contain
+	any words.
+	"""
+	query = matchQuery(value, columns)
+	if query == None:
+		return None
+	docid = search_index.c.docid
+	return select([docid / KINDS]).where(literal_column('search_index').match(query)).where(docid.op('%')(KINDS) == kind)
+
+
+def search(session, value, kind=None, limit=50):
+	"""Searches the index for the specified terms and returns the best matches
+	as dictionaries of their kind, id and indexed columns, most relevant first.
+	Only the index is read, so this stays fast no matter how large the library is.
+	"""
+	query = matchQuery(value)
+	if query == None:
+		return []
+
+	sql = 'SELECT docid, %s, rank(matchinfo(search_index, \'pcx\'), %s) AS score FROM search_index WHERE search_index MATCH :query' % (
+		', '.join(COLUMNS), ', '.join(str(weight) for weight in WEIGHTS))
+	if kind != None:
+		sql += ' AND docid %% %d = %d' % (KINDS, kind)
+	sql += ' ORDER BY score DESC LIMIT %d' % limit
+
+	results = []
+	for row in session.execute(sql, {'query': query}):
+		result = {'kind': KIND_NAMES.get(row[0] % KINDS), 'id': row[0] / KINDS, 'score': row['score']}
+		for (index, name) in enumerate(COLUMNS):
+			result[name] = row[index + 1]
+		results.append(result)
+	return results
+
+
+def reindex(session, kind, statement, key, ids=None):
+	"""Replaces the rows of the specified kind in the index, for the specified ids or for all of them"""
+	if ids == None:
+		session.execute('DELETE FROM search_index WHERE docid %% %d = %d' % (KINDS, kind))
+		session.execute(statement)
+		return
+
+	for chunk in chunks(int(id) for id in ids):
+		session.execute('DELETE FROM search_index WHERE docid IN (%s)' % ', '.join(str(id * KINDS + kind) for id in chunk))
+		session.execute('%s WHERE %s IN (%s)' % (statement, key, ', '.join(str(id) for id in chunk)))
+
+
+def indexTracks(session, ids=None):
+	reindex(session, KIND_TRACK, INDEX_TRACKS, 'tracks.id', ids)
+
+
+def indexAlbums(session, ids=None):
+	reindex(session, KIND_ALBUM, INDEX_ALBUMS, 'albums.id', ids)
+
+
+def indexArtists(session, ids=None):
+	reindex(session, KIND_ARTIST, INDEX_ARTISTS, 'artists.id', ids)
+
+
+def unindexTracks(session, ids):
+	"""Removes the specified tracks from the index"""
+	for chunk in chunks(int(id) for id in ids):
+		session.execute('DELETE FROM search_index WHERE docid IN (%s)' % ', '.join(str(id * KINDS + KIND_TRACK) for id in chunk))
+
+
+def rebuild(session):
+	"""Rebuilds the whole index from the library. The session is not committed."""
+	session.execute('DELETE FROM search_index')
+	session.execute(INDEX_TRACKS)
+	session.execute(INDEX_ALBUMS)
+	session.execute(INDEX_ARTISTS)
+	session.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+
+
+class SearchIndexer(object):
+	"""Keeps the search index up to date as tracks are imported. Tracks are
+	remembered as they are touched, and save() reindexes them along with their
+	albums and artists, a few statements per batch.
+	"""
+
+	def __init__(self):
+		self.tracks = []
+
+	def touch(self, track):
+		self.tracks.append(track)
+
+	def save(self, session):
+		"""Reindexes every touched track, album and artist. The session is flushed
+		first so that every entity has an id, but it is not committed. Albums are
+		indexed with their summarized artist name, so refresh the summaries first.
+		"""
+		if len(self.tracks) == 0:
+			return
+
+		session.flush()
+
+		track_ids = set()
+		album_ids = set()
+		artist_ids = set()
+		for track in self.tracks:
+			track_ids.add(track.id)
+			if track.album != None:
+				album_ids.add(track.album.id)
+			for relation in ARTIST_RELATIONS:
+				artist = getattr(track, relation)
+				if artist != None:
+					artist_ids.add(artist.id)
+
+		indexTracks(session, track_ids)
+		indexAlbums(session, album_ids)
+		indexArtists(session, artist_ids)
+		self.tracks = []
+
+	def clear(self):
+		"""Forgets all touched tracks, e.g. after a rollback"""
+		self.tracks = []
@@ -0,0 +1,108 @@
+from collections import deque
+import threading
+import time
+
+
+class ImportStats(object):
+	"""In-memory counters that describe the progress of the importer.
+	The counters are maintained by the import queue and the import workers as
+	they go, so reporting progress never has to scan the import_tasks table.
+	All methods are thread-safe.
+	"""
+
+	window = 300			 # default period in seconds that throughput is measured over
+	history = 1000			 # number of batches that the average time per file is calculated from
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.pending = 0				 # tasks that are waiting to be claimed
+		self.completed = 0				 # tasks completed since startup
+		self.files = 0					 # files imported since startup
+		self.running = {}				 # worker name -> list of uris it is working on
+		self.durations = deque(maxlen=self.history)	 # seconds per file of recent batches
+		self.completions = deque()		 # (timestamp, number of files) of recent batches
+		self.started = time.time()
+
+	def reset(self, pending):
+		"""Starts counting from scratch, with the specified number of pending tasks"""
+		with self.lock:
+			self.pending = pending
+			self.running = {}
+
+	def queued(self, count=1):
+		"""Records that tasks were added to the queue"""
+		with self.lock:
+			self.pending += count
+
+	def claimed(self, worker, uris):
+		"""Records that a worker claimed tasks for the specified uris"""
+		with self.lock:
+			self.pending = max(self.pending - len(uris), 0)
+			self.running[worker] = list(uris)
+
+	def released(self, worker):
+		"""Records that a worker stopped working on its tasks without finishing them.
+		If the tasks go back into the queue, that has to be recorded with queued().
+		"""
+		with self.lock:
+			self.running.pop(worker, None)
+
+	def finished(self, worker, uris, files, elapsed):
+		"""Records that a worker completed the tasks for the specified uris,
+		importing the specified number of files in the specified number of seconds.
+		"""
+		now = time.time()
+		done = set(uris)
+		with self.lock:
+			self.completed += len(uris)
+			self.running[worker] = [uri for uri in self.running.get(worker, []) if uri not in done]
+			if files > 0:
+				self.files += files
+				self.durations.append(elapsed / files)
+				self.completions.append((now, files))
+
+			# nothing older than the longest sensible window is ever needed
+			while len(self.completions) > 0 and self.completions[0][0] < now - 3600:
+				self.completions.popleft()
+
+	def snapshot(self, window=None, max_uris=20):
+		"""Returns a dictionary that describes the current state of the importer:
+		task counts, the average time per file, the files per second over the last
+		window seconds, the estimated number of seconds until the queue is empty,
+		and (up to max_uris of) the uris that are currently being processed.
+		"""
+		if window == None:
+			window = self.window
+		now = time.time()
+
+		with self.lock:
+			recent = sum(files for (when, files) in self.completions if when >= now - window)
+			average = sum(self.durations) / len(self.durations) if len(self.durations) > 0 else None
+			current = [uri for uris in self.running.values() for uri in uris]
+
+			status = {
+				'pending': self.pending,
+				'running': len(current),
+				'completed': self.completed,
+				'files_imported': self.files,
+				'seconds_per_file': average,
+				'files_per_second': float(recent) / min(window, max(now - self.started, 1)),
+				'window': window,
+				'current_uris': current[:max_uris],
+			}
+
+		# prefer measured throughput, which accounts for parallelism; fall back to the average
+		if status['pending'] == 0:
+			status['eta'] = 0
+		elif status['files_per_second'] > 0:
+			status['eta'] = int(status['pending'] / status['files_per_second'])
+		elif average != None:
+			status['eta'] = int(status['pending'] * average)
+		else:
+			status['eta'] = None
+
+		return status
+
+
+# the statistics that are shared by the web application and the import workers
+importStats = ImportStats()
@@ -0,0 +1,91 @@
+from sqlalchemy import cast, func, select, Integer
+
+from musik.db import Album, Artist, Disc, Track
+from musik.util import chunks
+
+albums = Album.__table__
+artists = Artist.__table__
+discs = Disc.__table__
+tracks = Track.__table__
+
+
+def refreshAlbums(session, ids=None):
+	"""Recomputes the summary columns of the albums with the specified ids, or of
+	every album if ids is None: track count, total duration, disc count, artist
+	name and year. The session is not committed.
+	"""
+	if ids != None and len(ids) == 0:
+		return
+
+	stmt = albums.update().values(
+		track_count=select([func.count(tracks.c.id)]).where(tracks.c.album_id == albums.c.id).as_scalar(),
+		duration=select([func.coalesce(func.sum(tracks.c.length), 0)]).where(tracks.c.album_id == albums.c.id).as_scalar(),
+		disc_count=select([func.count(discs.c.id)]).where(discs.c.album_id == albums.c.id).as_scalar(),
+		artist_name=select([artists.c.name]).where(artists.c.id == albums.c.artist_id).as_scalar(),
+		year=select([cast(func.substr(func.min(tracks.c.date), 1, 4), Integer)]).where(tracks.c.album_id == albums.c.id).as_scalar(),
+	)
+	execute(session, stmt, albums.c.id, ids)
+
+
+def refreshArtists(session, ids=None):
+	"""Recomputes the summary columns of the artists with the specified ids, or of
+	every artist if ids is None: album count and track count. The session is not committed.
+	"""
+	if ids != None and len(ids) == 0:
+		return
+
+	stmt = artists.update().values(
+		album_count=select([func.count(albums.c.id)]).where(albums.c.artist_id == artists.c.id).as_scalar(),
+		track_count=select([func.count(tracks.c.id)]).where(tracks.c.artist_id == artists.c.id).as_scalar(),
+	)
+	execute(session, stmt, artists.c.id, ids)
+
+
+def execute(session, stmt, column, ids):
+	if ids == None:
+		session.execute(stmt)
+		return
+
+	for chunk in chunks(ids):
+		session.execute(stmt.where(column.in_(chunk)))
+
+
+class SummaryTracker(object):
+	"""Keeps the album and artist summaries up to date as tracks are imported.
+	Tracks are remembered as they are touched, and save() refreshes the summaries
+	of just the albums and artists that they belong to, a few statements per batch.
+	"""
+
+	def __init__(self):
+		self.tracks = []
+
+	def touch(self, track):
+		self.tracks.append(track)
+
+	def save(self, session):
+		"""Refreshes the summaries of every album and artist that a touched track
+		belongs to. The session is flushed first so that every entity has an id,
+		but it is not committed.
+		"""
+		if len(self.tracks) == 0:
+			return
+
+		session.flush()
+
+		album_ids = set()
+		artist_ids = set()
+		for track in self.tracks:
+			if track.album != None:
+				album_ids.add(track.album.id)
+				if track.album.artist_id != None:
+					artist_ids.add(track.album.artist_id)
+			if track.artist != None:
+				artist_ids.add(track.artist.id)
+
+		refreshAlbums(session, album_ids)
+		refreshArtists(session, artist_ids)
+		self.tracks = []
+
+	def clear(self):
+		"""Forgets all touched tracks, e.g. after a rollback"""
+		self.tracks = []
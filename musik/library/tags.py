@@ -0,0 +1,131 @@
+import wave
+
+import mutagen
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3
+
+from musik.library.artwork import embeddedImage
+from musik.util import EasygoingDictionary
+
+
+class TagReadError(Exception):
+	"""Raised when the metadata of a file cannot be read"""
+	pass
+
+
+def readTags(uri):
+	"""Reads the metadata of the specified file in a single pass.
+	The file is opened and parsed exactly once, no matter what it contains.
+	Returns an EasygoingDictionary with the following keys, any of which may be missing:
+	- text fields, named like the keys of mutagen.easyid3.EasyID3 (artist, album,
+	  musicbrainz_albumid, ...). Vorbis comments use the same names.
+	- playcount and rating, from the ID3 PCNT and POPM frames
+	- length in milliseconds and bitrate in bits per second, from the stream info
+	- picture, the contents of the embedded cover image
+	Raises TagReadError if the file cannot be parsed.
+	"""
+	try:
+		audio = mutagen.File(uri)
+	except Exception as e:
+		raise TagReadError(u'Could not parse %s: %s' % (uri, unicode(e)))
+
+	record = EasygoingDictionary()
+	if audio == None:
+		# mutagen doesn't know about wav files, but the standard library does
+		if uri.lower().endswith('.wav'):
+			readWave(uri, record)
+			return record
+		raise TagReadError(u'Unsupported file format: %s' % uri)
+
+	if isinstance(audio.tags, ID3):
+		readID3(audio.tags, record)
+	elif audio.tags != None:
+		readVorbisComments(audio.tags, record)
+
+	# the stream info is more trustworthy than a TLEN frame
+	if getattr(audio.info, 'length', None):
+		record['length'] = int(audio.info.length * 1000)
+	if getattr(audio.info, 'bitrate', None):
+		record['bitrate'] = int(audio.info.bitrate)
+
+	# the picture is picked up here so that the file doesn't have to be parsed
+	# again to extract the album art
+	record['picture'] = embeddedImage(audio)
+
+	normalize(record)
+	return record
+
+
+def readID3(id3, record):
+	"""Copies the text frames of an ID3 tag into the record under their EasyID3
+	names, along with the play count and rating.
+	"""
+	# EasyID3 maps its key names to frames through its Get table. Calling the
+	# getters directly lets us reuse the tag that was already parsed.
+	for key, getter in EasyID3.Get.items():
+		if u':' in key:
+			# wildcard keys such as performer:* can't be read directly
+			continue
+		try:
+			values = getter(id3, key)
+		except KeyError:
+			continue
+		if len(values) > 0:
+			record[key] = values[0]
+
+	# play count can be stored in either the PCNT or the POPM frames.
+	# choose the largest of the two values as our official playcount.
+	playcount = None
+	for frame in id3.getall('PCNT') + id3.getall('POPM'):
+		count = getattr(frame, 'count', None)
+		if count != None and (playcount == None or int(count) > playcount):
+			playcount = int(count)
+	record['playcount'] = playcount
+
+	# rating is stored in the POPM frame
+	for frame in id3.getall('POPM'):
+		if getattr(frame, 'rating', None) != None:
+			record['rating'] = int(frame.rating)
+			break
+
+
+def readVorbisComments(tags, record):
+	"""Copies vorbis comments (FLAC, Ogg) into the record. Vorbis comment names
+	already match the EasyID3 key names once they are lower cased.
+	"""
+	for key in tags.keys():
+		values = tags[key]
+		if len(values) > 0:
+			record[key.lower()] = values[0]
+
+
+def readWave(uri, record):
+	"""Reads the stream info of a wav file, which doesn't carry any tags"""
+	try:
+		w = wave.open(uri, 'rb')
+	except (wave.Error, EOFError, IOError) as e:
+		raise TagReadError(u'Could not parse %s: %s' % (uri, unicode(e)))
+
+	try:
+		rate = w.getframerate()
+		if rate > 0:
+			record['length'] = int(w.getnframes() * 1000 / rate)
+			record['bitrate'] = rate * w.getnchannels() * w.getsampwidth() * 8
+	finally:
+		w.close()
+
+
+def normalize(record):
+	"""Converts numeric fields to the types that the library stores them as.
+	Track and disc numbers are frequently stored as 'number/total'.
+	"""
+	for key in ('tracknumber', 'discnumber'):
+		if record[key] != None:
+			record[key] = record[key].split(u'/')[0].strip() or None
+
+	for key in ('tracknumber', 'bpm'):
+		if record[key] != None:
+			try:
+				record[key] = int(float(record[key]))
+			except ValueError:
+				del record[key]
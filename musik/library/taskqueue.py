@@ -0,0 +1,152 @@
+from collections import OrderedDict
+from datetime import datetime
+import os
+import threading
+
+from musik.db import ImportTask
+from musik.library.stats import importStats
+from musik.util import chunks, getSetting, startsWith
+
+# the kinds of import tasks
+KIND_DIRECTORY = u'directory'
+KIND_FILE = u'file'
+
+# import task priorities. Each priority is a separate lane: workers always
+# drain the higher lanes first, so a file that somebody is waiting for never
+# sits behind the thousands of files that a directory scan turned up.
+PRIORITY_BULK = 0			 # files found by directory scans
+PRIORITY_SCAN = 1			 # directory scans
+PRIORITY_INTERACTIVE = 2	 # individual files, e.g. from the watcher
+
+
+def isSameOrInside(uri, parent):
+	"""Returns True if uri is the same as parent or somewhere underneath it"""
+	return uri == parent or uri.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+class ImportQueue(object):
+	"""The import queue is backed by the import_tasks table, but workers should
+	not have to poll it. Anything that queues a task signals the queue once the
+	task has been committed, and idle workers block until that happens.
+	A generation counter guards against lost wakeups: a worker remembers the
+	generation before it looks for work, and only goes to sleep if nothing has
+	been queued since.
+	"""
+
+	generation = 0		 # incremented every time new work is queued
+	lease = 300			 # seconds that a claimed task belongs to a worker without a heartbeat
+	max_attempts = 3	 # number of times a task is attempted before it is quarantined
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.lease = getSetting('MUSIK_IMPORT_LEASE', self.lease)
+		self.max_attempts = getSetting('MUSIK_IMPORT_MAX_ATTEMPTS', self.max_attempts)
+
+	def enqueue(self, session, uri):
+		"""Queues the specified uri for import, commits the session and wakes up
+		any idle workers. Requests are coalesced with the tasks that are already
+		pending (see enqueueMany), in which case nothing new is queued.
+		Returns the number of tasks that were queued.
+		"""
+		return self.enqueueMany(session, [uri])
+
+	def enqueueMany(self, session, uris, kind=None, priority=None):
+		"""Queues all of the specified uris, commits the session and wakes up any
+		idle workers. Files are inserted with a single multi-row INSERT that skips
+		the ORM entirely, so this is the way to go for large numbers of tasks.
+		If kind is None, each uri is checked to see whether it is a directory.
+		Unless a priority is specified, directories go in the scan lane and files
+		in the interactive lane.
+		Requests are coalesced with the tasks that are already pending:
+		- files that already have a pending task are not queued again, but are
+		  moved up to the requested priority
+		- files inside a pending directory scan are dropped, since the scan picks them up
+		- directories that are covered by a pending directory scan are dropped
+		- pending scans of directories inside a new directory scan are merged into it
+		Returns the number of tasks that were queued.
+		"""
+		if len(uris) == 0:
+			return 0
+
+		now = datetime.utcnow()
+		files = []
+		queued = 0
+		for uri in uris:
+			if kind == KIND_DIRECTORY or (kind == None and os.path.isdir(uri)):
+				queued += self.coalesceDirectory(session, uri, now, PRIORITY_SCAN if priority == None else priority)
+			else:
+				files.append(uri)
+
+		if len(files) > 0 and kind == None:
+			scans = [row[0] for row in session.query(ImportTask.uri).filter(ImportTask.kind == KIND_DIRECTORY,
+				ImportTask.started == None, ImportTask.quarantined == None)]
+			files = [uri for uri in files if not any(isSameOrInside(uri, scan) for scan in scans)]
+
+		if priority == None:
+			priority = PRIORITY_INTERACTIVE
+		files = self.unqueued(session, files, priority)
+		if len(files) > 0:
+			session.execute(ImportTask.__table__.insert(), [{'uri': uri, 'kind': KIND_FILE, 'priority': priority, 'created': now, 'attempts': 0} for uri in files])
+			queued += len(files)
+
+		session.commit()
+		if queued > 0:
+			importStats.queued(queued)
+			self.notify()
+		return queued
+
+	def coalesceDirectory(self, session, uri, now, priority):
+		"""Adds a pending scan of the specified directory to the session, unless a
+		pending scan already covers it. Pending scans of directories below it are
+		removed, since the new scan covers them. Returns the number of tasks added.
+		"""
+		uri = uri.rstrip(os.sep) or os.sep
+		pending = session.query(ImportTask).filter(ImportTask.kind == KIND_DIRECTORY, ImportTask.started == None, ImportTask.quarantined == None)
+
+		for task in pending:
+			if isSameOrInside(uri, task.uri):
+				task.priority = max(task.priority, priority)
+				return 0
+
+		nested = pending.filter(startsWith(ImportTask.uri, uri.rstrip(os.sep) + os.sep)).delete(synchronize_session=False)
+		importStats.queued(-nested)
+
+		task = ImportTask(uri)
+		task.kind = KIND_DIRECTORY
+		task.priority = priority
+		task.created = now
+		session.add(task)
+		return 1
+
+	def unqueued(self, session, uris, priority):
+		"""Returns the uris that don't have a pending task yet, without duplicates.
+		Pending tasks for the other uris are raised to the specified priority.
+		"""
+		uris = list(OrderedDict.fromkeys(uris))
+
+		pending = set()
+		for chunk in chunks(uris):
+			q = session.query(ImportTask).filter(ImportTask.uri.in_(chunk), ImportTask.started == None, ImportTask.quarantined == None)
+			for row in q.with_entities(ImportTask.uri):
+				pending.add(row[0])
+			q.filter(ImportTask.priority < priority).update({'priority': priority}, synchronize_session=False)
+
+		return [uri for uri in uris if uri not in pending]
+
+	def notify(self):
+		"""Wakes up every worker that is waiting for new tasks"""
+		with self.condition:
+			self.generation += 1
+			self.condition.notify_all()
+
+	def wait(self, generation):
+		"""Blocks until something has been queued since the specified generation.
+		Returns immediately if that has already happened.
+		"""
+		with self.condition:
+			while self.generation == generation:
+				self.condition.wait()
+
+
+# the queue that is shared by the web application and the import workers
+importQueue = ImportQueue()
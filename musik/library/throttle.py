@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+from musik.util import getSetting
+
+# io priorities are optional. Without psutil, parser processes are only niced.
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+
+def lowerPriority(niceness, idle_io=True):
+	"""Lowers the cpu and io priority of the calling process, so that the importer
+	only uses the capacity that playback leaves over. Runs in the parser processes.
+	"""
+	if niceness > 0:
+		os.nice(niceness)
+
+	if idle_io and psutil != None and hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+		try:
+			psutil.Process(os.getpid()).ionice(psutil.IOPRIO_CLASS_IDLE)
+		except (psutil.Error, OSError):
+			# not every kernel or io scheduler supports the idle class
+			pass
+
+
+class RateLimit(object):
+	"""Spaces out units of work so that no more than rate units are used per second.
+	A rate of 0 means unlimited.
+	"""
+
+	def __init__(self):
+		self.ready = 0		 # when the next unit of work may start
+
+	def reserve(self, amount, rate):
+		"""Reserves capacity for amount units. Returns the number of seconds that
+		the caller has to wait before it may use them.
+		"""
+		if rate <= 0 or amount <= 0:
+			return 0
+
+		now = time.time()
+		start = max(self.ready, now)
+		self.ready = start + float(amount) / rate
+		return start - now
+
+
+class ImportThrottle(object):
+	"""Keeps imports from getting in the way of playback.
+	Importers call acquire() before they read a file, which blocks for as long
+	as it takes to stay under the configured files per second and MB per second.
+	While any track is being streamed, the much lower streaming limits apply
+	instead, and directory scans pause between batches. All of the import
+	workers share a single throttle, so the limits apply to the importer as a whole.
+	"""
+
+	files_per_second = 0			 # files read per second when nothing is playing, 0 for unlimited
+	mb_per_second = 0				 # megabytes read per second when nothing is playing, 0 for unlimited
+	streaming_files_per_second = 2	 # files read per second while a track is streaming
+	streaming_mb_per_second = 2		 # megabytes read per second while a track is streaming
+	backoff = 0.5					 # seconds that a directory scan pauses per batch while a track is streaming
+	niceness = 10					 # added to the nice value of the parser processes
+	idle_io = True					 # whether parser processes use the idle io scheduling class
+
+	def __init__(self):
+		self.files_per_second = getSetting('MUSIK_IMPORT_FILES_PER_SECOND', self.files_per_second)
+		self.mb_per_second = getSetting('MUSIK_IMPORT_MB_PER_SECOND', self.mb_per_second)
+		self.streaming_files_per_second = getSetting('MUSIK_IMPORT_STREAMING_FILES_PER_SECOND', self.streaming_files_per_second)
+		self.streaming_mb_per_second = getSetting('MUSIK_IMPORT_STREAMING_MB_PER_SECOND', self.streaming_mb_per_second)
+		self.backoff = getSetting('MUSIK_IMPORT_STREAM_BACKOFF', self.backoff)
+		self.niceness = getSetting('MUSIK_IMPORT_NICE', self.niceness)
+		self.idle_io = getSetting('MUSIK_IMPORT_IDLE_IO', self.idle_io)
+
+		self.lock = threading.Lock()
+		self.streams = 0
+		self.files = RateLimit()
+		self.bytes = RateLimit()
+
+	def streamStarted(self):
+		with self.lock:
+			self.streams += 1
+
+	def streamFinished(self):
+		with self.lock:
+			self.streams = max(self.streams - 1, 0)
+
+	def isStreaming(self):
+		return self.streams > 0
+
+	def acquire(self, files=1, size=0):
+		"""Blocks until the importer may read the specified number of files
+		totalling size bytes. Returns the number of seconds spent waiting.
+		"""
+		with self.lock:
+			if self.streams > 0:
+				files_per_second, mb_per_second = self.streaming_files_per_second, self.streaming_mb_per_second
+			else:
+				files_per_second, mb_per_second = self.files_per_second, self.mb_per_second
+
+			delay = max(self.files.reserve(files, files_per_second),
+				self.bytes.reserve(size, mb_per_second * 1024 * 1024))
+
+		if delay > 0:
+			time.sleep(delay)
+		return delay
+
+	def pause(self):
+		"""Gives way to playback between batches of a directory scan"""
+		if self.isStreaming() and self.backoff > 0:
+			time.sleep(self.backoff)
+
+
+# the throttle that is shared by the web application and the import workers
+importThrottle = ImportThrottle()
@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from musik import initLogging
+from musik.db import DatabaseWrapper, LibraryRoot, Track
+from musik.library.scanner import isMimeTypeSupported
+from musik.library.search import unindexTracks
+from musik.library.summary import refreshAlbums, refreshArtists
+from musik.library.taskqueue import importQueue, isSameOrInside
+from musik.util import getSetting, startsWith
+
+# inotify support is optional. Without it, changes are only picked up when a
+# directory is imported again.
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
+
+
+# set whenever a library root is added, so that a running watcher starts watching it
+rootsChanged = threading.Event()
+
+
+def addRoot(session, uri):
+	"""Registers the specified directory as a library root, unless it is already
+	covered by an existing root. Roots nested inside the new one are removed,
+	since the new root covers them. The session is not committed.
+	Returns True if a new root was added.
+	"""
+	uri = os.path.abspath(uri)
+	for root in session.query(LibraryRoot).all():
+		if isSameOrInside(uri, root.uri):
+			return False
+		if isSameOrInside(root.uri, uri):
+			session.delete(root)
+
+	session.add(LibraryRoot(uri))
+	rootsChanged.set()
+	return True
+
+
+class ChangeCollector(pyinotify.ProcessEvent if pyinotify != None else object):
+	"""Records filesystem events as pending changes keyed by path.
+	Every event for a path replaces the previous one and restarts its quiet
+	period, so a burst of writes to the same file collapses into one change.
+	"""
+
+	def my_init(self, changes=None):
+		self.changes = changes
+
+	def record(self, path, action, directory, source=None):
+		self.changes[path] = (action, source, directory, time.time())
+
+	def process_IN_CLOSE_WRITE(self, event):
+		self.record(event.pathname, 'changed', event.dir)
+
+	def process_IN_CREATE(self, event):
+		# files are picked up when they are closed, but directories that are
+		# created or moved in with files already inside them need a scan
+		if event.dir:
+			self.record(event.pathname, 'changed', event.dir)
+
+	def process_IN_MOVED_TO(self, event):
+		source = getattr(event, 'src_pathname', None)
+		if source != None:
+			# the move happened inside a watched tree, so it doesn't need a delete
+			self.changes.pop(source, None)
+			self.record(event.pathname, 'moved', event.dir, source)
+		else:
+			self.record(event.pathname, 'changed', event.dir)
+
+	def process_IN_MOVED_FROM(self, event):
+		# if the destination is watched as well, process_IN_MOVED_TO turns this into a move
+		self.record(event.pathname, 'deleted', event.dir)
+
+	def process_IN_DELETE(self, event):
+		self.record(event.pathname, 'deleted', event.dir)
+
+
+class WatcherThread(threading.Thread):
+	"""Watches every library root for changes using inotify and keeps the library
+	in sync: new and modified files are queued for import, while moved and
+	deleted files update or remove their Track rows directly.
+	Changes are debounced, so a file is only acted on once it has been quiet
+	for a little while.
+	"""
+
+	running = True		 # whether or not the thread should continue to run
+	sa_session = None	 # database session
+	log = None			 # logging instance
+
+	debounce = 2.0		 # seconds that a path has to be quiet before it is processed
+
+	def __init__(self):
+		"""Creates a new instance of WatcherThread and connects to the database"""
+		super(WatcherThread, self).__init__(name=__name__)
+		self.log = initLogging(__name__)
+		self.debounce = getSetting('MUSIK_WATCH_DEBOUNCE', self.debounce)
+		self.changes = {}
+		self.watched = set()
+
+		db = DatabaseWrapper()
+		self.sa_session = db.get_session()
+
+	def run(self):
+		"""Processes filesystem events until the thread is stopped"""
+		if pyinotify == None:
+			self.log.warning(u'pyinotify is not installed. Library roots will not be watched for changes.')
+			return
+
+		manager = pyinotify.WatchManager()
+		mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+		notifier = pyinotify.Notifier(manager, ChangeCollector(changes=self.changes), timeout=int(self.debounce * 500))
+
+		try:
+			rootsChanged.set()
+			while self.running:
+				if notifier.check_events():
+					notifier.read_events()
+					notifier.process_events()
+
+				try:
+					if rootsChanged.is_set():
+						rootsChanged.clear()
+						self.watchRoots(manager, mask)
+
+					self.flush()
+				except OperationalError as e:
+					# e.g. the database is locked. The pending changes are kept, so
+					# they are retried, along with the roots, after a short wait.
+					self.log.warning(u'Could not update the library, retrying: %s', unicode(e))
+					self.sa_session.rollback()
+					rootsChanged.set()
+					time.sleep(self.debounce)
+		finally:
+			notifier.stop()
+			if self.sa_session != None:
+				self.sa_session.close()
+				self.sa_session = None
+
+	def watchRoots(self, manager, mask):
+		"""Adds a recursive watch for every library root that isn't watched yet"""
+		for root in self.sa_session.query(LibraryRoot).all():
+			if root.uri in self.watched or not os.path.isdir(root.uri):
+				continue
+
+			self.log.info(u'Watching library root %s for changes', root.uri)
+			result = manager.add_watch(root.uri, mask, rec=True, auto_add=True)
+			failed = [path for path, wd in result.items() if wd < 0]
+			if len(failed) > 0:
+				self.log.error(u'Could not watch %d directories below %s. You may need to raise fs.inotify.max_user_watches.', len(failed), root.uri)
+			self.watched.add(root.uri)
+		self.sa_session.commit()
+
+	def flush(self):
+		"""Acts on every pending change that has been quiet for the debounce period"""
+		cutoff = time.time() - self.debounce
+		ready = [(path, change) for path, change in self.changes.items() if change[3] <= cutoff]
+		if len(ready) == 0:
+			return
+
+		imports = []
+		for path, (action, source, directory, when) in ready:
+			if action == 'deleted':
+				self.removeTracks(path, directory)
+			elif action == 'moved':
+				if self.moveTracks(source, path, directory) == 0:
+					# nothing was known about the old location, so treat it as new
+					imports.append(path)
+			elif os.path.isdir(path) or isMimeTypeSupported(path):
+				imports.append(path)
+
+		self.sa_session.commit()
+
+		if len(imports) > 0:
+			self.log.info(u'Queueing %d changed paths for import', len(imports))
+			importQueue.enqueueMany(self.sa_session, imports)
+
+		# only forget the changes once they are in the database. If anything fails
+		# before this, they are processed again, which is safe: removing and moving
+		# tracks a second time finds nothing left to do.
+		for path, change in ready:
+			if self.changes.get(path) == change:
+				del self.changes[path]
+
+	def removeTracks(self, path, directory=True):
+		"""Removes the tracks for the specified file, or every track below the specified directory"""
+		if directory:
+			query = self.sa_session.query(Track).filter((Track.uri == path) | startsWith(Track.uri, path + os.sep))
+		else:
+			query = self.sa_session.query(Track).filter(Track.uri == path)
+		affected = query.with_entities(Track.id, Track.album_id, Track.artist_id).all()
+		removed = query.delete(synchronize_session=False)
+		if removed > 0:
+			self.log.info(u'Removed %d tracks for deleted path %s', removed, path)
+			refreshAlbums(self.sa_session, set(album_id for (id, album_id, artist_id) in affected if album_id != None))
+			refreshArtists(self.sa_session, set(artist_id for (id, album_id, artist_id) in affected if artist_id != None))
+			unindexTracks(self.sa_session, [id for (id, album_id, artist_id) in affected])
+		return removed
+
+	def moveTracks(self, source, destination, directory=True):
+		"""Points the tracks for a moved file or directory at their new location"""
+		moved = self.sa_session.query(Track).filter(Track.uri == source).update({'uri': destination}, synchronize_session=False)
+
+		# for directories, swap the old prefix for the new one in every uri below it
+		if directory:
+			prefix = source + os.sep
+			moved += self.sa_session.query(Track).filter(startsWith(Track.uri, prefix)).update(
+				{'uri': destination + os.sep + func.substr(Track.uri, len(prefix) + 1)}, synchronize_session=False)
+
+		if moved > 0:
+			self.log.info(u'Updated %d tracks moved from %s to %s', moved, source, destination)
+		return moved
+
+	def stop(self):
+		"""Cleans up the thread"""
+		self.log.info(u'%s.stop has been called', self.getName())
+		self.running = False
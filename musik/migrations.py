@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+
+from musik import initLogging
+
+
+def addColumns(cursor, table, columns):
+	"""Adds the (name, type) columns that the table doesn't have yet"""
+	existing = set(row[1] for row in cursor.execute('PRAGMA table_info(%s)' % table).fetchall())
+	for (name, definition) in columns:
+		if name not in existing:
+			cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, definition))
+
+
+def createIndex(cursor, name, table, columns, where=None):
+	"""Creates the index if it doesn't exist yet"""
+	sql = 'CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (name, table, ', '.join(columns))
+	if where != None:
+		sql += ' WHERE ' + where
+	cursor.execute(sql)
+
+
+def migrateImportTasks(cursor):
+	addColumns(cursor, 'import_tasks', (
+		('kind', 'VARCHAR'),
+		('priority', 'INTEGER'),
+		('worker', 'VARCHAR'),
+		('lease_expires', 'DATETIME'),
+		('attempts', 'INTEGER'),
+		('quarantined', 'DATETIME'),
+	))
+	cursor.execute('UPDATE import_tasks SET attempts = 0 WHERE attempts IS NULL')
+	cursor.execute('UPDATE import_tasks SET priority = 0 WHERE priority IS NULL')
+
+
+def migrateLibrary(cursor):
+	addColumns(cursor, 'tracks', (
+		('bitrate', 'INTEGER'),
+		('file_size', 'BIGINT'),
+		('file_mtime', 'FLOAT'),
+		('file_inode', 'BIGINT'),
+		('file_device', 'BIGINT'),
+		('audio_hash', 'VARCHAR'),
+	))
+	addColumns(cursor, 'albums', (
+		('art_hash', 'VARCHAR'),
+	))
+
+
+def createLookupIndexes(cursor):
+	# the lookups that the importer makes for every file
+	createIndex(cursor, 'ix_tracks_uri', 'tracks', ('uri', ))
+	createIndex(cursor, 'ix_tracks_file_inode', 'tracks', ('file_inode', ))
+	createIndex(cursor, 'ix_tracks_audio_hash', 'tracks', ('audio_hash', ))
+	createIndex(cursor, 'ix_artists_name', 'artists', ('name', ))
+	createIndex(cursor, 'ix_artists_musicbrainz_artistid', 'artists', ('musicbrainz_artistid', ))
+	createIndex(cursor, 'ix_albums_title_artist_id', 'albums', ('title', 'artist_id'))
+	createIndex(cursor, 'ix_albums_musicbrainz_albumid', 'albums', ('musicbrainz_albumid', ))
+	createIndex(cursor, 'ix_discs_album_id_discnumber', 'discs', ('album_id', 'discnumber'))
+	createIndex(cursor, 'ix_discs_musicbrainz_discid', 'discs', ('musicbrainz_discid', ))
+	createIndex(cursor, 'ix_import_tasks_uri', 'import_tasks', ('uri', ))
+
+	# workers look for the next pending task in claim order. Once a task has
+	# started, it drops out of the partial index, so the index stays as small as
+	# the queue no matter how many tasks have been completed.
+	if sqlite3.sqlite_version_info >= (3, 8, 0):
+		createIndex(cursor, 'ix_import_tasks_pending', 'import_tasks', ('priority DESC', 'created', 'id'),
+			'started IS NULL AND quarantined IS NULL')
+	else:
+		createIndex(cursor, 'ix_import_tasks_pending', 'import_tasks', ('started', 'priority DESC', 'created', 'id'))
+
+	# let the query planner know what the new indexes look like
+	cursor.execute('ANALYZE')
+
+
+def addSummaries(cursor):
+	addColumns(cursor, 'albums', (
+		('artist_name', 'VARCHAR'),
+		('year', 'INTEGER'),
+		('track_count', 'INTEGER'),
+		('disc_count', 'INTEGER'),
+		('duration', 'BIGINT'),
+	))
+	addColumns(cursor, 'artists', (
+		('album_count', 'INTEGER'),
+		('track_count', 'INTEGER'),
+	))
+
+	# the summaries are refreshed through these, and the list pages are sorted by the sort names
+	createIndex(cursor, 'ix_tracks_album_id', 'tracks', ('album_id', ))
+	createIndex(cursor, 'ix_tracks_artist_id', 'tracks', ('artist_id', ))
+	createIndex(cursor, 'ix_albums_artist_id', 'albums', ('artist_id', ))
+	createIndex(cursor, 'ix_albums_title_sort', 'albums', ('title_sort', ))
+	createIndex(cursor, 'ix_artists_name_sort', 'artists', ('name_sort', ))
+
+	# fill in the summaries of the existing library. This is written out rather
+	# than taken from musik.library.summary, so the migration never changes.
+	cursor.execute("""UPDATE albums SET
+		track_count = (SELECT count(tracks.id) FROM tracks WHERE tracks.album_id = albums.id),
+		duration = (SELECT coalesce(sum(tracks.length), 0) FROM tracks WHERE tracks.album_id = albums.id),
+		disc_count = (SELECT count(discs.id) FROM discs WHERE discs.album_id = albums.id),
+		artist_name = (SELECT artists.name FROM artists WHERE artists.id = albums.artist_id),
+		year = (SELECT CAST(substr(min(tracks.date), 1, 4) AS INTEGER) FROM tracks WHERE tracks.album_id = albums.id)""")
+	cursor.execute("""UPDATE artists SET
+		album_count = (SELECT count(albums.id) FROM albums WHERE albums.artist_id = artists.id),
+		track_count = (SELECT count(tracks.id) FROM tracks WHERE tracks.artist_id = artists.id)""")
+	cursor.execute('ANALYZE')
+
+
+def createSearchIndex(cursor):
+	# unicode61 folds case and diacritics beyond ASCII, but not every SQLite is built with it
+	try:
+		cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts4(title, artist, album, genre, tokenize=unicode61, prefix='2,3')")
+	except sqlite3.OperationalError:
+		cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts4(title, artist, album, genre, prefix='2,3')")
+
+	# index the existing library. The docid of a row is id * 4 + kind, where
+	# the kind is 0 for tracks, 1 for albums and 2 for artists.
+	cursor.execute('DELETE FROM search_index')
+	cursor.execute("""INSERT INTO search_index (docid, title, artist, album, genre)
+		SELECT tracks.id * 4, tracks.title, artists.name, albums.title, tracks.genre
+		FROM tracks
+		LEFT OUTER JOIN artists ON artists.id = tracks.artist_id
+		LEFT OUTER JOIN albums ON albums.id = tracks.album_id""")
+	cursor.execute("""INSERT INTO search_index (docid, title, artist, album, genre)
+		SELECT albums.id * 4 + 1, albums.title, albums.artist_name, NULL, NULL FROM albums""")
+	cursor.execute("""INSERT INTO search_index (docid, title, artist, album, genre)
+		SELECT artists.id * 4 + 2, NULL, artists.name, NULL, NULL FROM artists""")
+
+
+def indexTrackTitles(cursor):
+	# the track list pages are sorted by title
+	createIndex(cursor, 'ix_tracks_title_sort', 'tracks', ('title_sort', ))
+	cursor.execute('ANALYZE')
+
+
+# Every change to the schema of an existing database is a migration. Migrations
+# are applied in order, each in its own transaction, and the version of the
+# last one is stored in the database's user_version. Tables that don't exist
+# yet are created by create_all beforehand, so migrations have to cope with
+# tables that are already up to date.
+# Never change a migration once it has been released; add a new one instead.
+MIGRATIONS = (
+	(1, u'Lease, retry and prioritize import tasks', migrateImportTasks),
+	(2, u'Record file fingerprints, audio hashes and album art', migrateLibrary),
+	(3, u'Index the importer lookups and the pending import tasks', createLookupIndexes),
+	(4, u'Summarize albums and artists for the list pages', addSummaries),
+	(5, u'Index tracks, albums and artists for full text search', createSearchIndex),
+	(6, u'Index the sort titles of tracks for the track list pages', indexTrackTitles),
+)
+
+# migrations are only ever run by one thread at a time
+lock = threading.Lock()
+
+
+def schemaVersion(connection):
+	return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(engine):
+	"""Brings the schema of the database up to date by applying every migration
+	that it hasn't seen yet. Returns the number of migrations that were applied.
+	"""
+	with lock:
+		raw = engine.raw_connection()
+		try:
+			connection = raw.connection
+			if schemaVersion(connection) >= MIGRATIONS[-1][0]:
+				return 0
+
+			log = initLogging(__name__)
+
+			# pysqlite commits before every DDL statement unless it is told to
+			# stay out of transaction management
+			isolation_level = connection.isolation_level
+			connection.isolation_level = None
+			applied = 0
+			try:
+				for (version, description, migration) in MIGRATIONS:
+					cursor = connection.cursor()
+					# BEGIN IMMEDIATE takes the write lock, so another process that is
+					# migrating at the same time waits for us and then skips ahead
+					cursor.execute('BEGIN IMMEDIATE')
+					try:
+						if schemaVersion(connection) >= version:
+							cursor.execute('COMMIT')
+							continue
+
+						log.info(u'Migrating the database to version %d: %s', version, description)
+						migration(cursor)
+						cursor.execute('PRAGMA user_version = %d' % version)
+						cursor.execute('COMMIT')
+						applied += 1
+					except:
+						cursor.execute('ROLLBACK')
+						raise
+			finally:
+				connection.isolation_level = isolation_level
+			return applied
+		finally:
+			raw.close()
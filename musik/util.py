@@ -1,3 +1,9 @@
+import itertools
+import os
+
+from sqlalchemy import and_
+
+
 class EasygoingDictionary(dict):
 	"""A dictionary that returns None if you try to access a non-existent key.
 	"""
@@ -5,3 +11,49 @@ class EasygoingDictionary(dict):
 		if not key in self:
 			return None
 		return super(EasygoingDictionary, self).__getitem__(key)
+
+
+def getSetting(name, default):
+	"""Reads a setting from the environment, falling back to default if it is not set.
+	The value is coerced to the type of default so that callers always get back
+	the type that they expect.
+	"""
+	value = os.environ.get(name)
+	if value == None or value == '':
+		return default
+
+	if type(default) == bool:
+		return value.lower() in ('1', 'true', 'yes', 'on')
+	if default == None:
+		return value
+	return type(default)(value)
+
+
+def chunks(seq, size=500):
+	"""Yields the items of the sequence, or of any iterable, in lists of up to size
+	items, taking no more items from it than the next list needs. Lists of keys
+	are looked up with IN a chunk at a time, which keeps the statements short and
+	under SQLite's limit of 999 bound parameters.
+	"""
+	iterator = iter(seq)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if len(chunk) == 0:
+			return
+		yield chunk
+
+
+def startsWith(column, prefix):
+	"""Returns a condition that matches the values of the column that start with
+	the prefix. Unlike LIKE, which column.startswith() compiles to, it is case
+	sensitive and has no wildcards, so it is safe for paths with % and _ in them.
+	It is a range of the values from the prefix up to the prefix with its last
+	character incremented, so that an index on the column can be used.
+	"""
+	if isinstance(prefix, str):
+		prefix = prefix.decode('utf-8')
+	if prefix == u'':
+		return column != None
+	# text sorts by its UTF-8 bytes, which sort the same way as the characters do
+	end = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+	return and_(column >= prefix, column < end)
@@ -2,10 +2,22 @@ import json
 import os
 
 import cherrypy
+from sqlalchemy import func
 
 from musik import initLogging
 from musik.web import streaming
-from musik.db import Album, Artist, ImportTask, Track, Disc
+from musik.web.expansion import expand, includeKeys, requestedIncludes
+from musik.web.paging import paginate
+from musik.web.projection import requestedFields
+from musik.web.serialize import fetchRows, layoutFor
+from musik.db import Album, Artist, ImportTask, Track, Disc, MetadataConflict
+from musik.library.artwork import artCache, imageType, THUMBNAIL_SIZES
+from musik.library.search import matchingIds, rebuild, search, KIND_ALBUM, KIND_ARTIST, KIND_NAMES, KIND_TRACK
+from musik.library.stats import importStats
+from musik.library.summary import refreshAlbums, refreshArtists
+from musik.library.taskqueue import importQueue, KIND_FILE, PRIORITY_INTERACTIVE
+from musik.library.throttle import importThrottle
+from musik.library.watcher import addRoot
 
 
 class Import:
@@ -18,33 +30,109 @@ class Import:
 		if not path or not os.path.isdir(path):
 			raise cherrypy.HTTPError("404 Not Found", "Couldn't find the path " + str(path) + " on the target system")
 
-		task = ImportTask(path)
-		cherrypy.request.db.add(task)
+		# watch the directory for changes once it has been imported
+		addRoot(cherrypy.request.db, path)
+
+		# commits the task and wakes up the importer right away
+		importQueue.enqueue(cherrypy.request.db, path)
 
 		# this is an http 200 ok with no data
 		return json.dumps(None)
 
 	@cherrypy.expose
-	def status(self):
-		# gets the number of outstanding importer tasks
-		numtasks = cherrypy.request.db.query(ImportTask).filter(ImportTask.started == None).filter(ImportTask.completed == None).count()
+	def status(self, window=None):
+		"""Returns the progress of the importer as JSON: pending, running and completed
+		task counts, the average time per file, the number of files imported per second
+		over the last window seconds (5 minutes by default), the estimated number of
+		seconds until the queue is empty, and the uris that are currently being processed.
+		The numbers come from counters that the importer maintains in memory, so this is cheap to poll.
+		"""
+		cherrypy.response.headers['Content-Type'] = 'application/json'
+
+		if window != None:
+			try:
+				window = int(window)
+			except ValueError:
+				raise cherrypy.HTTPError("400 Bad Request", "Invalid window " + window)
+			if window <= 0:
+				raise cherrypy.HTTPError("400 Bad Request", "Invalid window " + str(window))
+
+		return json.dumps(importStats.snapshot(window))
 
-		# get the currently processing task
-		currentTask = cherrypy.request.db.query(ImportTask).filter(ImportTask.started != None).filter(ImportTask.completed == None).first()
+	@cherrypy.expose
+	def summaries(self):
+		"""Rebuilds the album and artist summaries that the list pages are rendered
+		from, e.g. after the database has been edited by hand. The importer keeps
+		them up to date otherwise. Returns the number of albums and artists.
+		"""
+		cherrypy.response.headers['Content-Type'] = 'application/json'
+
+		session = cherrypy.request.db
+		refreshAlbums(session)
+		refreshArtists(session)
+		session.commit()
+
+		return json.dumps({
+			'albums': session.query(func.count(Album.id)).scalar(),
+			'artists': session.query(func.count(Artist.id)).scalar(),
+		})
+
+	@cherrypy.expose
+	def searchindex(self):
+		"""Rebuilds the full text search index from the library. The importer keeps it
+		up to date otherwise. Returns the number of tracks, albums and artists.
+		"""
+		cherrypy.response.headers['Content-Type'] = 'application/json'
 
-		ret = u''
-		if (currentTask != None):
-			ret += u'The importer is currently processing %s.<br />' % unicode(currentTask.uri)
+		session = cherrypy.request.db
+		rebuild(session)
+		session.commit()
 
-		#TODO: calculate estimated completion time by multiplying average job time by number of outstanding items
+		return json.dumps({
+			'tracks': session.query(func.count(Track.id)).scalar(),
+			'albums': session.query(func.count(Album.id)).scalar(),
+			'artists': session.query(func.count(Artist.id)).scalar(),
+		})
 
-		#TODO: return JSON instead of text
-		if numtasks == 0:
-			ret += u'There are no tasks currently pending'
-		else:
-			ret += u'There are %d tasks currently pending' % numtasks
 
-		return ret
+class Art:
+	@cherrypy.expose
+	def default(self, art_hash, size=THUMBNAIL_SIZES[0]):
+		"""Serves the album art with the specified hash at the specified size, straight
+		from the art cache. The url is derived from the contents of the image, so it
+		can be cached forever.
+		"""
+		size = int(size)
+		if size not in THUMBNAIL_SIZES or not art_hash.isalnum():
+			raise cherrypy.HTTPError("404 Not Found", "Album art is available in sizes " + ', '.join(str(s) for s in THUMBNAIL_SIZES))
+
+		path = artCache.path(art_hash, size)
+		if path == None:
+			self.requeue(cherrypy.request.db, art_hash)
+			raise cherrypy.HTTPError("404 Not Found", "Couldn't find album art " + art_hash)
+		artCache.touch(path)
+
+		etag = '"%s-%d"' % (art_hash, size)
+		cherrypy.response.headers['ETag'] = etag
+		cherrypy.response.headers['Cache-Control'] = 'public, max-age=31536000'
+		if cherrypy.request.headers.get('If-None-Match') == etag:
+			cherrypy.response.status = 304
+			return ''
+
+		with open(path, 'rb') as f:
+			data = f.read()
+		cherrypy.response.headers['Content-Type'] = imageType(data) or 'application/octet-stream'
+		return data
+
+	def requeue(self, session, art_hash):
+		"""Queues a file of an album that uses the album art with the specified hash,
+		after the art has been evicted from the art cache. Audio files are never
+		opened here: the importer parses the file again, which puts the art back
+		in the cache, or forgets it if the file doesn't have it anymore.
+		"""
+		row = session.query(Track.uri).join(Album, Track.album_id == Album.id).filter(Album.art_hash == art_hash).first()
+		if row != None:
+			importQueue.enqueueMany(session, [row[0]], KIND_FILE, PRIORITY_INTERACTIVE)
 
 
 class OggStream:
@@ -71,6 +159,8 @@ class OggStream:
 			audio stream to end, and the client player to choke. Ideally, we would notify
 			the user of the error as well.
 			"""
+			# the importer backs off for as long as anything is playing
+			importThrottle.streamStarted()
 			try:
 				self.log.info(u'OggStream.track trying to open %s for streaming' % unicode(uri))
 				self.stream = streaming.GstAudioFile(uri)
@@ -91,6 +181,7 @@ class OggStream:
 				if self.stream is not None:
 					self.stream.close()
 					self.stream = None
+				importThrottle.streamFinished()
 
 		return yield_data()
 	track._cp_config = {'response.stream': True}
@@ -99,10 +190,14 @@ class OggStream:
 # defines an api with a dynamic url scheme composed of /<tag>/<value>/ pairs
 # these pairs are assembled into an SQL query. Each term is combined with the AND operator.
 # unknown <tag> elements are ignored.
+# lists are returned a page at a time. The limit, cursor and count tags control
+# the paging, see musik.web.paging. The fields tag picks the fields that are returned,
+# and the include tag embeds related objects.
 class API:
 	log = None
 	importmedia = Import()
 	stream = OggStream()
+	art = Art()
 
 	def __init__(self):
 		self.log = initLogging(__name__)
@@ -121,19 +216,52 @@ class API:
 
 		#figure out data type the user is requesting
 		if params[0] == 'albums':
-			return json.dumps(self.queryAlbums(query))
+			return self.queryAlbums(query)
 		if params[0] == 'artists':
-			return json.dumps(self.queryArtists(query))
+			return self.queryArtists(query)
 		if params[0] == 'tracks':
-			return json.dumps(self.queryTracks(query))
+			return self.queryTracks(query)
 		if params[0] == 'discs':
-			return json.dumps(self.queryDiscs(query))
+			return self.queryDiscs(query)
+		if params[0] == 'conflicts':
+			return self.queryConflicts(query)
+		if params[0] == 'tasks':
+			return self.queryTasks(query)
+		if params[0] == 'duplicates':
+			return json.dumps(self.queryDuplicates(query))
+		if params[0] == 'search':
+			return json.dumps(self.querySearch(query))
+
+	def filterMatches(self, q, id_column, kind, value, columns=None):
+		"""Restricts the query to the rows whose entries in the search index match
+		every word of the value as a prefix, in the specified columns or in any of them.
+		"""
+		ids = matchingIds(kind, value, columns)
+		if ids == None:
+			return q
+		return q.filter(id_column.in_(ids))
+
+	def page(self, q, model, order, params):
+		"""Returns a page of the results of the query as JSON, see musik.web.paging.
+		Only the columns of the requested fields are selected, e.g. /fields/id,title,
+		or all of them by default. The rows are fetched as tuples and written straight
+		to JSON, see musik.web.serialize, so no instances of the model are created.
+		The include parameter embeds related objects, e.g. /include/artist,album, see
+		musik.web.expansion.
+		"""
+		session = cherrypy.request.db
+		layout = layoutFor(model, requestedFields(model, params))
+		includes = requestedIncludes(model, params)
+
+		extra = [column.key for column in order] + includeKeys(model, includes)
+		rows = paginate(layout.select(q, extra), order, params, lambda q: fetchRows(session, q))
+		return layout.encodeRows(rows, expand(session, model, rows, includes))
 
 	def queryAlbums(self, params):
 		"""Assembles an album query by appending query parameters as filters.
 		The result is a query that satisfies all of the parameters that were
 		passed on the url string.
-		Returns the results of the query sorted by title_sort property
+		Returns a page of the results of the query as JSON, sorted by title_sort property, see page
 		"""
 		self.log.info(u'queryAlbums called with params %s' % unicode(params))
 
@@ -146,7 +274,7 @@ class API:
 			if key == 'id':
 				q = q.filter(Album.id == value)
 			elif key == 'title':
-				q = q.filter(Album.title.like('%' + value + '%'))
+				q = self.filterMatches(q, Album.id, KIND_ALBUM, value, ('title', ))
 			elif key == 'title_sort':
 				q = q.filter(Album.title_sort.like('%' + value + '%'))
 			elif key == 'artist_id':
@@ -169,17 +297,20 @@ class API:
 				q = q.filter(Album.organization.like('%' + value + '%'))
 			elif key == 'releasecountry':
 				q = q.filter(Album.releasecountry.like('%' + value + '%'))
+			elif key == 'artist_name':
+				q = self.filterMatches(q, Album.id, KIND_ALBUM, value, ('artist', ))
+			elif key == 'search':
+				q = self.filterMatches(q, Album.id, KIND_ALBUM, value)
+			elif key == 'year':
+				q = q.filter(Album.year == value)
 
-		album_list = []
-		for a in q.order_by(Album.title_sort).all():
-			album_list.append(a.as_dict())
-		return album_list
+		return self.page(q, Album, (Album.title_sort, Album.id), params)
 
 	def queryDiscs(self, params):
 		"""Assembles an disc query by appending query parameters as filters.
 		The result is a query that satisfies all of the parameters that were
 		passed on the url string.
-		Returns the results of the query sorted by id property
+		Returns a page of the results of the query as JSON, sorted by id property, see page
 		TODO: sort by album
 		"""
 		self.log.info(u'queryDiscs called with params %s' % unicode(params))
@@ -201,16 +332,13 @@ class API:
 			elif key == 'musicbrainz_discid':
 				q = q.filter(Disc.musicbrainz_discid.like('%' + value + '%'))
 
-		disc_list = []
-		for d in q.order_by(Disc.id).all():
-			disc_list.append(d.as_dict())
-		return disc_list
+		return self.page(q, Disc, (Disc.id, ), params)
 
 	def queryArtists(self, params):
 		"""Assembles an artist query by appending query parameters as filters.
 		The result is a query that satisfies all of the parameters that were
 		passed on the url string.
-		Returns the results of the query sorted by name_sort property
+		Returns a page of the results of the query as JSON, sorted by name_sort property, see page
 		"""
 		self.log.info(u'queryArtists called with params %s' % unicode(params))
 
@@ -223,22 +351,21 @@ class API:
 			if key == 'id':
 				q = q.filter(Artist.id == value)
 			elif key == 'name':
-				q = q.filter(Artist.name.like('%' + value + '%'))
+				q = self.filterMatches(q, Artist.id, KIND_ARTIST, value, ('artist', ))
 			elif key == 'name_sort':
 				q = q.filter(Artist.name_sort.like('%' + value + '%'))
 			elif key == 'musicbrainz_artistid':
 				q = q.filter(Artist.musicbrainz_artistid.like('%' + value + '%'))
+			elif key == 'search':
+				q = self.filterMatches(q, Artist.id, KIND_ARTIST, value)
 
-		artist_list = []
-		for a in q.order_by(Artist.name_sort).all():
-			artist_list.append(a.as_dict())
-		return artist_list
+		return self.page(q, Artist, (Artist.name_sort, Artist.id), params)
 
 	def queryTracks(self, params):
 		"""Assembles an track query by appending query parameters as filters.
 		The result is a query that satisfies all of the parameters that were
 		passed on the url string.
-		Returns the results of the query sorted by title_sort property
+		Returns a page of the results of the query as JSON, sorted by title_sort property, see page
 		"""
 		self.log.info(u'queryTracks called with params %s' % unicode(params))
 
@@ -277,7 +404,7 @@ class API:
 			elif key == 'encodedby':
 				q = q.filter(Track.encodedby.like('%' + value + '%'))
 			elif key == 'genre':
-				q = q.filter(Track.genre.like('%' + value + '%'))
+				q = self.filterMatches(q, Track.id, KIND_TRACK, value, ('genre', ))
 			elif key == 'isrc':
 				q = q.filter(Track.isrc.like('%' + value + '%'))
 			elif key == 'length':
@@ -297,7 +424,7 @@ class API:
 			elif key == 'performer_id':
 				q = q.filter(Track.performer_id == value)
 			elif key == 'title':
-				q = q.filter(Track.title.like('%' + value + '%'))
+				q = self.filterMatches(q, Track.id, KIND_TRACK, value, ('title', ))
 			elif key == 'title_sort':
 				q = q.filter(Track.title_sort.like('%' + value + '%'))
 			elif key == 'tracknumber':
@@ -310,8 +437,132 @@ class API:
 				q = q.filter(Track.playcount == value)
 			elif key == 'rating':
 				q = q.filter(Track.rating == value)
+			elif key == 'search':
+				q = self.filterMatches(q, Track.id, KIND_TRACK, value)
+
+		return self.page(q, Track, (Track.title_sort, Track.id), params)
+
+	def queryConflicts(self, params):
+		"""Assembles a metadata conflict query by appending query parameters as filters.
+		The result is a query that satisfies all of the parameters that were
+		passed on the url string.
+		Returns a page of the results of the query as JSON, sorted by entity, entity_id and field, see page
+		"""
+		self.log.info(u'queryConflicts called with params %s' % unicode(params))
+
+		q = cherrypy.request.db.query(MetadataConflict)
+
+		for d in params:
+			key = d.keys()[0]
+			value = d[key]
+
+			if key == 'id':
+				q = q.filter(MetadataConflict.id == value)
+			elif key == 'entity':
+				q = q.filter(MetadataConflict.entity == value)
+			elif key == 'entity_id':
+				q = q.filter(MetadataConflict.entity_id == value)
+			elif key == 'field':
+				q = q.filter(MetadataConflict.field == value)
+			elif key == 'uri':
+				q = q.filter(MetadataConflict.uri.like('%' + value + '%'))
+
+		return self.page(q, MetadataConflict,
+			(MetadataConflict.entity, MetadataConflict.entity_id, MetadataConflict.field, MetadataConflict.id), params)
+
+	def queryTasks(self, params):
+		"""Assembles an import task query by appending query parameters as filters.
+		The result is a query that satisfies all of the parameters that were
+		passed on the url string. The state parameter is one of pending, running,
+		completed or quarantined.
+		Returns a page of the results of the query as JSON, sorted by id property, see page
+		"""
+		self.log.info(u'queryTasks called with params %s' % unicode(params))
+
+		q = cherrypy.request.db.query(ImportTask)
+
+		for d in params:
+			key = d.keys()[0]
+			value = d[key]
+
+			if key == 'id':
+				q = q.filter(ImportTask.id == value)
+			elif key == 'uri':
+				q = q.filter(ImportTask.uri.like('%' + value + '%'))
+			elif key == 'kind':
+				q = q.filter(ImportTask.kind == value)
+			elif key == 'worker':
+				q = q.filter(ImportTask.worker == value)
+			elif key == 'state':
+				if value == 'pending':
+					q = q.filter(ImportTask.started == None).filter(ImportTask.quarantined == None)
+				elif value == 'running':
+					q = q.filter(ImportTask.started != None).filter(ImportTask.completed == None).filter(ImportTask.quarantined == None)
+				elif value == 'completed':
+					q = q.filter(ImportTask.completed != None)
+				elif value == 'quarantined':
+					q = q.filter(ImportTask.quarantined != None)
+				else:
+					raise cherrypy.HTTPError("400 Bad Request", "Unknown state " + value)
+
+		return self.page(q, ImportTask, (ImportTask.id, ), params)
+
+	def queryDuplicates(self, params):
+		"""Finds groups of tracks with identical audio, i.e. the same audio hash.
+		The only supported parameter is audio_hash, which limits the result to a single group.
+		Returns a page of groups sorted by audio hash, each with its tracks sorted by uri
+		"""
+		self.log.info(u'queryDuplicates called with params %s' % unicode(params))
+
+		db = cherrypy.request.db
+		groups = db.query(Track.audio_hash).filter(Track.audio_hash != None)
+
+		for d in params:
+			key = d.keys()[0]
+			value = d[key]
+
+			if key == 'audio_hash':
+				groups = groups.filter(Track.audio_hash == value)
+
+		groups = groups.group_by(Track.audio_hash).having(func.count(Track.id) > 1)
+		hashes = [group.audio_hash for group in paginate(groups, (Track.audio_hash, ), params)]
+		if len(hashes) == 0:
+			return []
+		q = db.query(Track).filter(Track.audio_hash.in_(hashes))
+
+		duplicate_list = []
+		for t in q.order_by(Track.audio_hash, Track.uri).all():
+			if len(duplicate_list) == 0 or duplicate_list[-1]['audio_hash'] != t.audio_hash:
+				duplicate_list.append({'audio_hash': t.audio_hash, 'tracks': []})
+			duplicate_list[-1]['tracks'].append(t.as_dict())
+		return duplicate_list
+
+	def querySearch(self, params):
+		"""Searches the titles, artists, albums and genres of the whole library at once.
+		Supported parameters are q, the search terms, kind, one of track, album or
+		artist, and limit, the number of results (50 by default, at most 500).
+		Every word of the terms matches as a prefix, so /api/search/q/dark sid finds
+		The Dark Side of the Moon.
+		Returns a list of tracks, albums and artists, most relevant first
+		"""
+		self.log.info(u'querySearch called with params %s' % unicode(params))
+
+		terms = u''
+		kind = None
+		limit = 50
+		kinds = dict((name, kind) for (kind, name) in KIND_NAMES.items())
+
+		for d in params:
+			key = d.keys()[0]
+			value = d[key]
+
+			if key == 'q':
+				terms = value
+			elif key == 'kind':
+				if value not in kinds:
+					raise cherrypy.HTTPError("400 Bad Request", "Unknown kind " + value)
+				kind = kinds[value]
+			elif key == 'limit':
+				limit = max(1, min(int(value), 500))
 
-		track_list = []
-		for a in q.order_by(Track.title_sort).all():
-			track_list.append(a.as_dict())
-		return track_list
+		return search(cherrypy.request.db, terms, kind, limit)
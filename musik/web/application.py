@@ -89,6 +89,25 @@ class Musik:
 
 		return json.loads(r.content)
 
+	def _api_page(self, url, cursor=None):
+		"""Requests a page of a list from the api, starting at the specified cursor.
+		Returns the page and the cursor of the next page, which is None on the last page.
+		"""
+		if cursor != None:
+			url += 'cursor/' + cursor
+		self.log.info(u'_api_page was called with url %s' % url)
+
+		r = requests.get(url)
+
+		if r.status_code != 200:
+			self.log.error(u'_api_page to url %s returned status code %d' % (url, int(r.status_code)))
+			return (False, None)
+		elif r.headers['content-type'] != 'application/json':
+			self.log.error(u'_api_page to url %s returned an unsupported content-type %s' % (url, r.headers['content-type']))
+			return (False, None)
+
+		return (json.loads(r.content), r.headers.get('x-next-cursor'))
+
 	def _render(self, template_names, **kwargs):
 		"""Renders the specified template.
 		template_names arg can be a single template name or a list of templates that
@@ -151,40 +170,40 @@ class Musik:
 		return self._render("index.html")
 
 	@cherrypy.expose
-	def albums(self, id=None):
-		"""Renders the albums template.
+	def albums(self, id=None, cursor=None):
+		"""Renders the albums template, a page at a time.
 		"""
 		if id == None:
 			self.log.info(u'albums was called with no id')
 
 			#TODO: make this url configurable!
-			albums = self._api_request('http://localhost:8080/api/albums/')
+			(albums, next_cursor) = self._api_page('http://localhost:8080/api/albums/', cursor)
 			if albums:
-				return self._render("albums.html", **{"albums": albums, })
+				return self._render("albums.html", **{"albums": albums, "next_cursor": next_cursor, })
 		else:
 			self.log.info(u'albums was called with id %d' % int(id))
 
 			#TODO: make this url configurable!
-			albums = self._api_request('http://localhost:8080/api/albums/id/' + id)
+			albums = self._api_request('http://localhost:8080/api/albums/id/' + id + '/include/artist,tracks')
 			if albums:
 				return self._render("album.html", **{"album": albums[0], })
 
 	@cherrypy.expose
-	def artists(self, id=None):
-		"""Renders the artists template.
+	def artists(self, id=None, cursor=None):
+		"""Renders the artists template, a page at a time.
 		"""
 		if id == None:
 			self.log.info(u'artists was called with no id')
 
 			#TODO: make this url configurable!
-			artists = self._api_request('http://localhost:8080/api/artists/')
+			(artists, next_cursor) = self._api_page('http://localhost:8080/api/artists/', cursor)
 			if artists:
-				return self._render("artists.html", **{"artists": artists, })
+				return self._render("artists.html", **{"artists": artists, "next_cursor": next_cursor, })
 		else:
 			self.log.info(u'artists was called with id %d' % int(id))
 
 			#TODO: make this url configurable!
-			artists = self._api_request('http://localhost:8080/api/artists/id/' + id)
+			artists = self._api_request('http://localhost:8080/api/artists/id/' + id + '/include/albums')
 			if artists:
 				return self._render("artist.html", **{"artist": artists[0], })
 
@@ -0,0 +1,117 @@
+import cherrypy
+
+from musik.db import Album, Artist, Disc, Track
+from musik.util import chunks
+from musik.web.paging import max_page_size
+from musik.web.serialize import fetchRows, layoutFor
+
+# The relations that the include parameter can embed, by model. Each relation
+# is (related model, key column of the model, key column of the related model,
+# whether there are many related objects, the order of many related objects).
+RELATIONS = {
+	Track: {
+		'artist': (Artist, 'artist_id', 'id', False, None),
+		'album_artist': (Artist, 'album_artist_id', 'id', False, None),
+		'arranger': (Artist, 'arranger_id', 'id', False, None),
+		'author': (Artist, 'author_id', 'id', False, None),
+		'composer': (Artist, 'composer_id', 'id', False, None),
+		'conductor': (Artist, 'conductor_id', 'id', False, None),
+		'lyricist': (Artist, 'lyricist_id', 'id', False, None),
+		'performer': (Artist, 'performer_id', 'id', False, None),
+		'album': (Album, 'album_id', 'id', False, None),
+		'disc': (Disc, 'disc_id', 'id', False, None),
+	},
+	Album: {
+		'artist': (Artist, 'artist_id', 'id', False, None),
+		'discs': (Disc, 'id', 'album_id', True, (Disc.discnumber, Disc.id)),
+		'tracks': (Track, 'id', 'album_id', True, (Track.tracknumber, Track.id)),
+	},
+	Disc: {
+		'album': (Album, 'album_id', 'id', False, None),
+		'tracks': (Track, 'id', 'disc_id', True, (Track.tracknumber, Track.id)),
+	},
+	Artist: {
+		'albums': (Album, 'id', 'artist_id', True, (Album.title_sort, Album.id)),
+		'tracks': (Track, 'id', 'artist_id', True, (Track.title_sort, Track.id)),
+	},
+}
+
+
+def requestedIncludes(model, params):
+	"""Returns the names of the relations that the include parameter asks for,
+	e.g. /include/artist,album. Raises an HTTP 400 error for relations that the
+	model doesn't have.
+	Relations to many objects, e.g. the tracks of an album, can only be included
+	when a single row is looked up by id, otherwise one page could hold the
+	whole library. Including them anywhere else is an HTTP 400 error as well.
+	"""
+	includes = []
+	single = False
+	for d in params:
+		key = d.keys()[0]
+		if key == 'include':
+			includes = [name.strip() for name in d[key].split(',') if name.strip() != '']
+		elif key == 'id':
+			single = True
+
+	relations = RELATIONS.get(model, {})
+	for name in includes:
+		if name not in relations:
+			raise cherrypy.HTTPError("400 Bad Request", "Unknown relation " + name)
+		if relations[name][3] and not single:
+			raise cherrypy.HTTPError("400 Bad Request", "Relation " + name + " can only be included when looking up a single id, e.g. /id/1/include/" + name)
+	return includes
+
+
+def includeKeys(model, includes):
+	"""Returns the names of the columns that the included relations are looked up by"""
+	return [RELATIONS[model][name][1] for name in includes]
+
+
+def expand(session, model, rows, includes):
+	"""Returns a list with a dictionary of the included relations of every row, for
+	musik.web.serialize.Layout.encodeRows, with the related objects as JSON.
+	Related objects are loaded in batches with IN, and relations to the same
+	model share their batch, so a page costs one statement per related model
+	(per 500 keys) no matter how many rows it has.
+	"""
+	if len(includes) == 0 or len(rows) == 0:
+		return None
+
+	# collect the keys that every related model and key column is looked up by
+	lookups = {}
+	for name in includes:
+		(related, local, remote, many, order) = RELATIONS[model][name]
+		keys = lookups.setdefault((related, remote, many, order), set())
+		keys.update(getattr(row, local) for row in rows)
+
+	loaded = {}
+	for ((related, remote, many, order), keys) in lookups.items():
+		keys = [key for key in keys if key != None]
+		layout = layoutFor(related)
+		# the key column is selected after the columns of the layout
+		position = len(layout.names) if remote not in layout.names else layout.names.index(remote)
+		objects = {}
+		for chunk in chunks(keys):
+			q = layout.select(session.query(related), (remote, )).filter(getattr(related, remote).in_(chunk))
+			if order != None:
+				q = q.order_by(*order)
+			if many:
+				# there is only ever one row to include many objects for, see requestedIncludes
+				q = q.limit(max_page_size)
+			for row in fetchRows(session, q):
+				if many:
+					objects.setdefault(row[position], []).append(layout.encode(row))
+				else:
+					objects[row[position]] = layout.encode(row)
+		if many:
+			objects = dict((key, '[' + ', '.join(values) + ']') for (key, values) in objects.items())
+		loaded[(related, remote, many, order)] = objects
+
+	embedded = [{} for row in rows]
+	for name in includes:
+		(related, local, remote, many, order) = RELATIONS[model][name]
+		objects = loaded[(related, remote, many, order)]
+		for (row, result) in zip(rows, embedded):
+			result[name] = objects.get(getattr(row, local), '[]' if many else 'null')
+	return embedded
@@ -0,0 +1,93 @@
+import base64
+import json
+
+import cherrypy
+from sqlalchemy import and_, or_
+
+from musik.util import getSetting
+
+# the number of rows in a page if the client doesn't ask for a limit, and the most that it can ask for
+page_size = getSetting('MUSIK_API_PAGE_SIZE', 200)
+max_page_size = getSetting('MUSIK_API_MAX_PAGE_SIZE', 1000)
+
+
+def encodeCursor(values):
+	"""Returns an opaque cursor for the sort key values of the last row of a page"""
+	return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decodeCursor(cursor, columns):
+	"""Returns the sort key values in the specified cursor. Raises an HTTP 400
+	error if the cursor wasn't made for the specified sort columns.
+	"""
+	try:
+		values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+	except (TypeError, ValueError):
+		raise cherrypy.HTTPError("400 Bad Request", "Invalid cursor " + str(cursor))
+	if type(values) != list or len(values) != len(columns):
+		raise cherrypy.HTTPError("400 Bad Request", "Invalid cursor " + str(cursor))
+	return values
+
+
+def after(columns, values):
+	"""Returns a condition that matches the rows that sort after the specified
+	sort key values, when sorted by the specified columns in ascending order.
+	SQLite sorts NULL before everything else, and the last column has to be unique.
+	"""
+	column = columns[0]
+	value = values[0]
+	if len(columns) == 1:
+		return column > value
+
+	rest = after(columns[1:], values[1:])
+	if value == None:
+		return or_(and_(column == None, rest), column != None)
+	# SQLite can't start an index scan from an OR, so bound the first column on its own
+	return and_(column >= value, or_(column > value, and_(column == value, rest)))
+
+
+def paginate(q, columns, params, fetch=None):
+	"""Returns a page of the results of the query, sorted by the specified columns.
+	Pages are addressed by keyset: the cursor holds the sort key values of the last
+	row of the previous page, so every page is one index range scan no matter how
+	deep into the results it is, and rows that are added or removed in between
+	never shift a page. The last column has to be unique, e.g. the id.
+	Supported parameters are limit, the number of rows in the page, cursor, from the
+	X-Next-Cursor header of the previous page, and count, which when true returns
+	the number of rows in all of the pages in the X-Total-Count header.
+	The rows are fetched with q.all(), or with fetch(q) if it is specified.
+	"""
+	limit = page_size
+	cursor = None
+	count = False
+
+	for d in params:
+		key = d.keys()[0]
+		value = d[key]
+
+		if key == 'limit':
+			try:
+				limit = int(value)
+			except ValueError:
+				raise cherrypy.HTTPError("400 Bad Request", "Invalid limit " + value)
+		elif key == 'cursor':
+			cursor = value
+		elif key == 'count':
+			count = value.lower() in ('1', 'true', 'yes')
+
+	limit = max(1, min(limit, max_page_size))
+
+	if count:
+		cherrypy.response.headers['X-Total-Count'] = str(q.count())
+
+	if cursor != None:
+		q = q.filter(after(columns, decodeCursor(cursor, columns)))
+
+	# fetch one row more than the page holds to find out whether there is another page
+	q = q.order_by(*columns).limit(limit + 1)
+	rows = fetch(q) if fetch != None else q.all()
+	if len(rows) > limit:
+		rows = rows[:limit]
+		last = rows[-1]
+		cherrypy.response.headers['X-Next-Cursor'] = encodeCursor([getattr(last, column.key) for column in columns])
+	return rows
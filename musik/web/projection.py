@@ -0,0 +1,23 @@
+import cherrypy
+
+
+def requestedFields(model, params):
+	"""Returns the names of the fields of the model that the fields parameter asks
+	for, e.g. /fields/id,title, or None if it isn't there and every field is wanted.
+	Raises an HTTP 400 error for fields that the model doesn't have.
+	"""
+	fields = None
+	for d in params:
+		key = d.keys()[0]
+		if key == 'fields':
+			fields = [name.strip() for name in d[key].split(',') if name.strip() != '']
+
+	if fields == None or len(fields) == 0:
+		return None
+
+	columns = model.__table__.columns
+	derived = getattr(model, 'derived_fields', {})
+	for name in fields:
+		if name not in columns and name not in derived:
+			raise cherrypy.HTTPError("400 Bad Request", "Unknown field " + name)
+	return fields
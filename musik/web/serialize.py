@@ -0,0 +1,138 @@
+from json.encoder import encode_basestring_ascii
+import threading
+
+from sqlalchemy.types import Boolean, DateTime, Float, Integer
+
+
+def encodeString(value):
+	if value is None:
+		return 'null'
+	return encode_basestring_ascii(value)
+
+
+def encodeInteger(value):
+	if value is None:
+		return 'null'
+	try:
+		return str(int(value))
+	except (TypeError, ValueError):
+		# SQLite doesn't enforce column types, and older libraries have text like
+		# '1/5' in tracknumber. Pass it on the way as_dict() does
+		return encodeString(unicode(value))
+
+
+def encodeFloat(value):
+	if value is None:
+		return 'null'
+	try:
+		return repr(float(value))
+	except (TypeError, ValueError):
+		return encodeString(unicode(value))
+
+
+def encodeBoolean(value):
+	if value is None:
+		return 'null'
+	return 'true' if value else 'false'
+
+
+def encodeDateTime(value):
+	if value is None:
+		return 'null'
+	return '"' + value.isoformat() + '"'
+
+
+def encoderFor(column):
+	"""Returns the function that encodes the values of the column as JSON"""
+	if isinstance(column.type, Boolean):
+		return encodeBoolean
+	if isinstance(column.type, DateTime):
+		return encodeDateTime
+	if isinstance(column.type, Float):
+		return encodeFloat
+	if isinstance(column.type, Integer):
+		# BigInteger is an Integer as well
+		return encodeInteger
+	return encodeString
+
+
+class Layout(object):
+	"""The precompiled layout of the JSON objects that the rows of a model are
+	serialized to: which columns are selected, in what order, and how each
+	value is encoded. Rows are plain tuples from a Core query, so no ORM
+	instances are created, and every object is written straight to JSON with
+	its keys encoded ahead of time.
+	"""
+
+	def __init__(self, model, fields=None):
+		self.model = model
+		table = model.__table__
+		derived = getattr(model, 'derived_fields', {})
+		if fields == None:
+			fields = [column.name for column in table.columns] + sorted(derived.keys())
+		self.fields = tuple(fields)
+
+		# the columns that the fields are read from, in the order that they are selected
+		self.names = []
+		for name in self.fields:
+			source = derived[name][0] if name in derived else name
+			if source not in self.names:
+				self.names.append(source)
+
+		self.plan = []
+		for name in self.fields:
+			key = encode_basestring_ascii(name) + ': '
+			if name in derived:
+				(source, derive) = derived[name]
+				encoder = lambda value, derive=derive: encodeString(derive(value))
+			else:
+				source = name
+				encoder = encoderFor(table.columns[name])
+			self.plan.append((key, self.names.index(source), encoder))
+
+	def select(self, q, extra=()):
+		"""Narrows the ORM query down to the columns of the layout, followed by the
+		extra columns, e.g. sort keys, which are selected but not serialized.
+		"""
+		names = list(self.names)
+		for name in extra:
+			if name not in names:
+				names.append(name)
+		return q.with_entities(*[getattr(self.model, name) for name in names])
+
+	def encode(self, row, embedded=None):
+		"""Returns the JSON object for a row of a query made by select(). Embedded
+		values are name -> JSON text pairs that are added to the object as they are.
+		"""
+		parts = [key + encoder(row[index]) for (key, index, encoder) in self.plan]
+		if embedded:
+			for (name, value) in embedded.items():
+				parts.append(encode_basestring_ascii(name) + ': ' + value)
+		return '{' + ', '.join(parts) + '}'
+
+	def encodeRows(self, rows, embedded=None):
+		"""Returns a JSON array of the objects for the rows"""
+		if embedded == None:
+			return '[' + ', '.join(self.encode(row) for row in rows) + ']'
+		return '[' + ', '.join(self.encode(row, extra) for (row, extra) in zip(rows, embedded)) + ']'
+
+
+# layouts are compiled once per model and selection of fields
+layouts = {}
+layouts_lock = threading.Lock()
+
+
+def layoutFor(model, fields=None):
+	"""Returns the layout for the specified model and fields, compiling it on first use"""
+	key = (model, tuple(fields) if fields != None else None)
+	with layouts_lock:
+		if key not in layouts:
+			layouts[key] = Layout(model, fields)
+		return layouts[key]
+
+
+def fetchRows(session, q):
+	"""Runs the statement of the ORM query through Core and returns the rows as
+	they come out of the database, without any ORM processing.
+	"""
+	return session.execute(q.statement).fetchall()